@@ -24,19 +24,50 @@
 # this import required to enable PyQt API v2
 import qgis  # pylint: disable=W0611
 
-import custom_logging  # pylint: disable=relative-import
+import os
+
+from PyQt4.QtCore import QSettings
+
+# Only the logging and the report are imported when QGIS starts, the
+# dialogs, the extraction and Sentry are imported when they are first used.
+# pylint: disable=relative-import
+from stream_report import RunReport, report_stage
+import custom_logging
+# pylint: enable=relative-import
+
+
+def startup_report():
+    """Return the report timing the plugin startup, if it is enabled.
+
+    Set the SFE_STARTUP_TIMING environment variable or enable the
+    'stream-feature-extractor/startup-timing' QSettings option to write the
+    time spent in every startup stage to the log.
+
+    :returns: A new report, None if the timing is not enabled.
+    :rtype: RunReport, None
+    """
+    flag = QSettings().value(
+        'stream-feature-extractor/startup-timing', False, type=bool)
+    if 'SFE_STARTUP_TIMING' in os.environ or flag:
+        return RunReport()
+    return None
 
 
 SENTRY_URL = (
     'http://b257c02328384628a50de20d257cf06e:'
     'ab515d8c88b746d484351321b0111b44@sentry.linfiniti.com/10')
-custom_logging.setup_logger(SENTRY_URL)
+STARTUP_REPORT = startup_report()
+with report_stage(STARTUP_REPORT, 'setup_logger'):
+    custom_logging.setup_logger(SENTRY_URL)
 
 
 # noinspection PyPep8Naming
 def classFactory(iface):  # pylint: disable=invalid-name
     """load StreamFeatureExtractor class from file StreamFeatureExtractor."""
-    # pylint: disable=relative-import
-    from stream_feature_extractor import StreamFeatureExtractor
-    # pylint: enable=relative-import
-    return StreamFeatureExtractor(iface)
+    with report_stage(STARTUP_REPORT, 'import_plugin'):
+        # pylint: disable=relative-import
+        from stream_feature_extractor import StreamFeatureExtractor
+        # pylint: enable=relative-import
+    with report_stage(STARTUP_REPORT, 'create_plugin'):
+        plugin = StreamFeatureExtractor(iface, STARTUP_REPORT)
+    return plugin
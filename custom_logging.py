@@ -28,12 +28,6 @@ third_party_path = os.path.abspath(
     os.path.join(os.path.dirname(__file__), 'third_party'))
 if third_party_path not in sys.path:
     sys.path.append(third_party_path)
-# pylint: disable=F0401
-# noinspection PyUnresolvedReferences
-from raven.handlers.logging import SentryHandler
-# noinspection PyUnresolvedReferences
-from raven import Client
-# pylint: enable=F0401
 LOGGER = logging.getLogger('SFE')
 
 
@@ -68,6 +62,50 @@ class QgsLogHandler(logging.Handler):
             QgsMessageLog.logMessage(message, 'QGIS', 0)
 
 
+class LazySentryHandler(logging.Handler):
+    """A Sentry logging handler importing raven on the first message.
+
+    Importing raven and creating its client slows down the start of QGIS,
+    even though most sessions never log an error.
+    """
+
+    def __init__(self, sentry_url, level=logging.NOTSET):
+        """Constructor.
+
+        :param sentry_url: Url to sentry api for remote logging.
+        :type sentry_url: str
+
+        :param level: Logging level of the handler.
+        :type level: int
+        """
+        logging.Handler.__init__(self, level=level)
+        self.sentry_url = sentry_url
+        self.sentry_handler = None
+
+    def emit(self, record):
+        """Send the message to Sentry, creating the client if needed.
+
+        :param record: logging record containing whatever info needs to be
+                logged.
+        :type record: logging.LogRecord
+        """
+        if self.sentry_handler is None:
+            # pylint: disable=F0401
+            # noinspection PyUnresolvedReferences
+            from raven.handlers.logging import SentryHandler
+            # noinspection PyUnresolvedReferences
+            from raven import Client
+            # pylint: enable=F0401
+            from sentry_transport import batched_dsn
+            # The events are sent from a bounded queue in batches, without
+            # blocking the exit of QGIS, see BatchingHTTPTransport.
+            self.sentry_handler = SentryHandler(
+                Client(batched_dsn(self.sentry_url)))
+            self.sentry_handler.setFormatter(self.formatter)
+            self.sentry_handler.setLevel(self.level)
+        self.sentry_handler.emit(record)
+
+
 def add_logging_handler_once(logger, handler):
     """A helper to add a handler to a logger, ensuring there are no duplicates.
 
@@ -148,9 +186,9 @@ def setup_logger(sentry_url, log_file=None):
 
     qgis_handler = QgsLogHandler()
 
-    # Sentry handler - this is optional hence the localised import
-    # It will only log if pip install raven. If raven is available
-    # logging messages will be sent to the sentry host.
+    # Sentry handler - raven is only imported when the first error is
+    # logged, see LazySentryHandler. Logging messages will be sent to the
+    # sentry host.
     # We will only log exceptions. You need to either:
     #  * Set env var 'SENTRY' present (value can be anything)
     #  * Enable the 'plugins/use_sentry' QSettings option
@@ -158,8 +196,7 @@ def setup_logger(sentry_url, log_file=None):
     settings = QtCore.QSettings()
     flag = settings.value('stream-feature-extractor/sentry-logging', False)
     if 'SENTRY' in os.environ or flag:
-        client = Client(sentry_url)
-        sentry_handler = SentryHandler(client)
+        sentry_handler = LazySentryHandler(sentry_url)
         sentry_handler.setFormatter(formatter)
         sentry_handler.setLevel(logging.ERROR)
         if add_logging_handler_once(logger, sentry_handler):
@@ -177,19 +214,22 @@ def setup_logger(sentry_url, log_file=None):
     add_logging_handler_once(logger, qgis_handler)
 
 
-def temp_dir(sub_dir='work'):
+def temp_dir(sub_dir='work', dated=True):
     r"""Obtain the temporary working directory for the operating system.
 
     :param sub_dir: Optional argument which will cause an additional
         subdirectory to be created.
     :type sub_dir: str
 
+    :param dated: If True, the folder is placed in a folder named after the
+        current date, so a new one is used every day. Set it to False for
+        data that should be kept longer. Defaults to True.
+    :type dated: bool
+
     :returns: Path to the temporary folder placed in the system temp dir.
     :rtype: str
     """
     user = getpass.getuser().replace(' ', '_')
-    current_date = date.today()
-    date_string = current_date.isoformat()
 
     # Following 4 lines are a workaround for tempfile.tempdir()
     # unreliabilty
@@ -198,8 +238,12 @@ def temp_dir(sub_dir='work'):
     new_directory = os.path.dirname(filename)
     os.remove(filename)
 
-    temp_path = os.path.join(
-        new_directory, date_string, user, sub_dir)
+    if dated:
+        date_string = date.today().isoformat()
+        temp_path = os.path.join(
+            new_directory, date_string, user, sub_dir)
+    else:
+        temp_path = os.path.join(new_directory, user, sub_dir)
 
     if not os.path.exists(temp_path):
         # Ensure that the dir is world writable
@@ -0,0 +1,270 @@
+# coding=utf-8
+"""**Benchmark of the feature extraction on synthetic stream networks.**
+
+Times every stage of identify_features on generated networks of growing
+size and writes the results to a JSON file. Given a baseline file written
+by an earlier run, the stages that got slower than the tolerance are
+reported and the script exits with status 1, e.g.::
+
+    python scripts/benchmark.py --output benchmark.json \\
+        --baseline benchmark_baseline.json
+
+The networks are memory layers unless --directory is given, then they are
+written to shapefiles there and read back, so the time spent reading the
+lines from a file based layer is measured too.
+
+Run it from the plugin directory with QGIS in the PYTHONPATH.
+"""
+
+import os
+import sys
+import json
+import platform
+import argparse
+from datetime import datetime
+from timeit import default_timer
+
+PAR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if PAR_DIR not in sys.path:
+    sys.path.append(PAR_DIR)
+
+from qgis.core import (
+    QGis,
+    QgsApplication,
+    QgsVectorLayer,
+    QgsVectorFileWriter)
+
+from stream_cli import silent_callback
+from stream_utilities import identify_features
+from stream_report import RunReport
+from test.synthetic_network import generate_network, create_network_layer
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+# Stages faster than this (seconds) are too noisy to compare
+MINIMUM_DURATION = 0.05
+
+
+def parse_arguments(argv=None):
+    """Parse the command line arguments.
+
+    :param argv: The arguments, without the program name. If None,
+        sys.argv is used.
+    :type argv: list
+
+    :returns: The parsed arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark identify_features on synthetic networks.')
+    parser.add_argument(
+        '-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+        help='Number of lines of the networks.')
+    parser.add_argument('--vertices', type=int, default=5)
+    parser.add_argument('--braiding', type=float, default=0.05)
+    parser.add_argument('--near-miss', type=float, default=0.05)
+    parser.add_argument(
+        '--crossing', type=float, default=0.01,
+        help='Fraction of the lines crossing another line.')
+    parser.add_argument(
+        '--self-crossing', type=float, default=0.01,
+        help='Fraction of the lines crossing themselves.')
+    parser.add_argument('--threshold', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '-d', '--directory',
+        help='Benchmark shapefiles written in this directory instead of '
+             'memory layers.')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=1,
+        help='Run every size several times and keep the fastest stages, '
+             'and the report of the fastest run.')
+    parser.add_argument(
+        '-o', '--output', default='benchmark.json',
+        help='The JSON file the results are written to.')
+    parser.add_argument(
+        '-b', '--baseline',
+        help='A JSON file of an earlier run to compare the results with.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='Allowed slowdown compared to the baseline. Defaults to 0.25.')
+    return parser.parse_args(argv)
+
+
+def file_layer(layer, directory, name):
+    """Write a layer to a shapefile and open it.
+
+    :param layer: A vector layer.
+    :type layer: QgsVectorLayer
+
+    :param directory: The directory of the shapefile.
+    :type directory: str
+
+    :param name: The name of the shapefile, without extension.
+    :type name: str
+
+    :returns: The shapefile layer.
+    :rtype: QgsVectorLayer
+    """
+    path = os.path.join(directory, '%s.shp' % name)
+    QgsVectorFileWriter.writeAsVectorFormat(
+        layer, path, 'UTF-8', layer.crs(), 'ESRI Shapefile')
+    return QgsVectorLayer(path, name, 'ogr')
+
+
+def time_stages(layer, threshold):
+    """Run identify_features and return the cost of each of its stages.
+
+    :param layer: A vector line layer.
+    :type layer: QgsVectorLayer
+
+    :param threshold: Distance threshold for node snapping.
+    :type threshold: float
+
+    :returns: Tuple of a dictionary of stage name to wall time (seconds)
+        and the run report.
+    :rtype: tuple
+    """
+    report = RunReport()
+    identify_features(layer, threshold, silent_callback, report=report)
+    stages = dict(
+        (stage.name, stage.wall_time) for stage in report.stages)
+    stages['total'] = sum(stage.wall_time for stage in report.stages)
+    return stages, report
+
+
+def run_benchmark(arguments):
+    """Run the benchmark for every size.
+
+    :param arguments: The parsed arguments.
+    :type arguments: argparse.Namespace
+
+    :returns: The results, ready to be written as JSON.
+    :rtype: dict
+    """
+    results = []
+    for size in arguments.sizes:
+        start = default_timer()
+        lines = generate_network(
+            size,
+            vertices_per_line=arguments.vertices,
+            braiding=arguments.braiding,
+            near_miss=arguments.near_miss,
+            crossing=arguments.crossing,
+            self_crossing=arguments.self_crossing,
+            seed=arguments.seed)
+        layer = create_network_layer(lines)
+        del lines
+        if arguments.directory:
+            layer = file_layer(layer, arguments.directory, 'network_%i' % size)
+        setup = default_timer() - start
+
+        best_stages = None
+        best_total = None
+        best_report = None
+        for _ in range(arguments.repeat):
+            stages, report = time_stages(layer, arguments.threshold)
+            if best_total is None or stages['total'] < best_total:
+                best_total = stages['total']
+                best_report = report
+            if best_stages is None:
+                best_stages = stages
+            else:
+                for name, duration in stages.items():
+                    best_stages[name] = min(best_stages[name], duration)
+        print '%9i lines: %.3f s (setup %.3f s)' % (
+            size, best_stages['total'], setup)
+        results.append({
+            'lines': size,
+            'stages': best_stages,
+            'report': best_report.as_dict()})
+
+    return {
+        'metadata': {
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'qgis': QGis.QGIS_VERSION,
+            'platform': platform.platform(),
+            'vertices': arguments.vertices,
+            'braiding': arguments.braiding,
+            'near_miss': arguments.near_miss,
+            'crossing': arguments.crossing,
+            'self_crossing': arguments.self_crossing,
+            'threshold': arguments.threshold,
+            'seed': arguments.seed,
+            'provider': 'ogr' if arguments.directory else 'memory',
+            'repeat': arguments.repeat},
+        'results': results}
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results with a baseline.
+
+    Only the sizes and stages found in both are compared, and stages faster
+    than MINIMUM_DURATION in the baseline are skipped.
+
+    :param results: The results of run_benchmark.
+    :type results: dict
+
+    :param baseline: The results of an earlier run.
+    :type baseline: dict
+
+    :param tolerance: Allowed slowdown, e.g. 0.25 for 25%.
+    :type tolerance: float
+
+    :returns: List of (lines, stage, baseline duration, duration) of the
+        stages that got slower.
+    :rtype: list
+    """
+    baseline_stages = dict(
+        (result['lines'], result['stages'])
+        for result in baseline['results'])
+    slowdowns = []
+    for result in results['results']:
+        old_stages = baseline_stages.get(result['lines'])
+        if old_stages is None:
+            continue
+        for name, duration in sorted(result['stages'].items()):
+            old_duration = old_stages.get(name)
+            if old_duration is None or old_duration < MINIMUM_DURATION:
+                continue
+            if duration > old_duration * (1 + tolerance):
+                slowdowns.append(
+                    (result['lines'], name, old_duration, duration))
+    return slowdowns
+
+
+def main(argv=None):
+    """Run the benchmark and compare it with the baseline if given.
+
+    :param argv: The arguments, without the program name. If None,
+        sys.argv is used.
+    :type argv: list
+
+    :returns: Exit status, 1 if a stage got slower than the baseline.
+    :rtype: int
+    """
+    arguments = parse_arguments(argv)
+    application = QgsApplication([], False)
+    application.initQgis()
+    try:
+        results = run_benchmark(arguments)
+    finally:
+        application.exitQgis()
+
+    with open(arguments.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print 'Results written to %s' % arguments.output
+
+    if not arguments.baseline:
+        return 0
+    with open(arguments.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    slowdowns = compare(results, baseline, arguments.tolerance)
+    for lines, name, old_duration, duration in slowdowns:
+        print '%9i lines: %s got slower, %.3f s instead of %.3f s' % (
+            lines, name, duration, old_duration)
+    return 1 if slowdowns else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,400 @@
+# coding=utf-8
+"""
+Persistent cache of extraction results.
+
+The results of identify_features are stored on disk, keyed by a hash of the
+input geometries, the threshold and the plugin version. Running the
+extraction again on an unchanged layer then only reads the stored layers::
+
+    cache = ResultCache()
+    intermediate_layer, output_layer = identify_features_cached(
+        cache, layer, threshold, callback)
+
+Every result is a gzip compressed JSON file. The least recently used files
+are removed when the cache grows over its size limit. The directory can be
+shared, e.g. on a network drive, as the files are written atomically.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import gzip
+import json
+import struct
+import hashlib
+import logging
+import ConfigParser
+from tempfile import mkstemp
+
+from PyQt4.QtCore import QVariant
+
+from qgis.core import (
+    QgsField,
+    QgsFeature,
+    QgsGeometry,
+    QgsPoint)
+
+from custom_logging import temp_dir
+from stream_utilities import (
+    tr, feature_request, identify_features, output_fields)
+from stream_report import report_stage
+from stream_output import MemorySink
+
+LOGGER = logging.getLogger('QGIS')
+
+# Bump it when the format of the cache files changes
+CACHE_FORMAT = 1
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+CACHE_EXTENSION = '.json.gz'
+
+
+def plugin_version():
+    """Return the version of the plugin from metadata.txt.
+
+    :returns: The version, e.g. '1.0.4'.
+    :rtype: str
+    """
+    file_path = os.path.join(os.path.dirname(__file__), 'metadata.txt')
+    parser = ConfigParser.ConfigParser()
+    parser.read(file_path)
+    return parser.get('general', 'version')
+
+
+def content_key(layer, threshold):
+    """Return the cache key of an extraction.
+
+    The key is a hash of the id and WKB of every feature in the order of the
+    data provider, the crs, the threshold and the plugin version. Attributes
+    are not used by the extraction, so they are left out.
+
+    :param layer: A vector line layer.
+    :type layer: QgsVectorLayer
+
+    :param threshold: Distance threshold for node snapping.
+    :type threshold: float
+
+    :returns: Hexadecimal SHA-1 digest.
+    :rtype: str
+    """
+    content = hashlib.sha1()
+    content.update('%s;%s;%r;%s;' % (
+        CACHE_FORMAT,
+        plugin_version(),
+        float(threshold),
+        layer.crs().authid()))
+    data_provider = layer.dataProvider()
+    for feature in data_provider.getFeatures(
+            feature_request(data_provider, [])):
+        geometry = feature.geometry()
+        if geometry is None:
+            content.update(struct.pack('<qi', feature.id(), -1))
+            continue
+        wkb = geometry.asWkb()
+        content.update(struct.pack('<qi', feature.id(), len(wkb)))
+        content.update(wkb)
+    return content.hexdigest()
+
+
+def layer_to_dict(layer):
+    """Return the content of a point layer, ready to be written as JSON.
+
+    :param layer: A point layer.
+    :type layer: QgsVectorLayer
+
+    :returns: Dictionary with the name, crs, fields (name and QVariant type)
+        and features (x, y and attributes) of the layer.
+    :rtype: dict
+    """
+    features = []
+    for feature in layer.getFeatures():
+        point = feature.geometry().asPoint()
+        features.append([point.x(), point.y(), feature.attributes()])
+    return {
+        'name': layer.name(),
+        'crs': layer.crs().authid(),
+        'fields': [
+            [field.name(), field.type()]
+            for field in layer.dataProvider().fields()],
+        'features': features}
+
+
+def layer_from_dict(data, sink=None, fields=None):
+    """Create a point layer from the result of layer_to_dict.
+
+    :param data: The content of the layer.
+    :type data: dict
+
+    :param sink: Optional sink receiving the features, see stream_output.
+        Defaults to a MemorySink.
+    :type sink: MemorySink, FileSink
+
+    :param fields: The attributes of the layer. Defaults to the fields
+        stored in data.
+    :type fields: list of QgsField
+
+    :returns: A point layer.
+    :rtype: QgsVectorLayer
+    """
+    if sink is None:
+        sink = MemorySink()
+    if fields is None:
+        fields = [
+            QgsField(name, QVariant.Type(field_type))
+            for name, field_type in data['fields']]
+    sink.open(data['name'], data['crs'], fields)
+    for x, y, attributes in data['features']:
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry.fromPoint(QgsPoint(x, y)))
+        feature.setAttributes(attributes)
+        sink.add_feature(feature)
+    return sink.close()
+
+
+class ResultCache(object):
+    """Directory of extraction results, with least recently used eviction.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        """Constructor.
+
+        :param directory: The cache directory. Defaults to a 'cache' folder
+            in the temporary directory of the user, see temp_dir.
+        :type directory: str
+
+        :param max_bytes: Maximum size of all the cached files.
+        :type max_bytes: int
+        """
+        if directory is None:
+            directory = temp_dir('cache', dated=False)
+        elif not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        """Return the path of the file of a key.
+
+        :param key: The cache key, see content_key.
+        :type key: str
+
+        :returns: Path of the file.
+        :rtype: str
+        """
+        return os.path.join(self.directory, key + CACHE_EXTENSION)
+
+    def get(
+            self,
+            key,
+            intermediate_sink=None,
+            output_sink=None,
+            create_intermediate=True):
+        """Return the cached layers of a key.
+
+        :param key: The cache key, see content_key.
+        :type key: str
+
+        :param intermediate_sink: Optional sink receiving the nodes of the
+            intermediate layer, see stream_output.
+        :type intermediate_sink: MemorySink, FileSink
+
+        :param output_sink: Optional sink receiving the identified features.
+        :type output_sink: MemorySink, FileSink
+
+        :param create_intermediate: If False, None is returned instead of
+            the intermediate layer. Defaults to True.
+        :type create_intermediate: bool
+
+        :returns: Tuple of the intermediate layer and the output layer, or
+            None if the key is not in the cache or if its intermediate layer
+            is needed but was not stored.
+        :rtype: tuple, None
+        """
+        path = self.path(key)
+        try:
+            with gzip.open(path, 'rb') as cache_file:
+                data = json.loads(cache_file.read())
+        except (IOError, ValueError, EOFError) as e:
+            if os.path.exists(path):
+                LOGGER.debug('Removing unreadable cache file %s: %s' % (
+                    path, e))
+                self._remove(path)
+            self.misses += 1
+            return None
+        if create_intermediate and data['intermediate'] is None:
+            self.misses += 1
+            return None
+
+        # Mark it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        intermediate_layer = None
+        if create_intermediate:
+            intermediate_layer = layer_from_dict(
+                data['intermediate'], intermediate_sink)
+        output_layer = layer_from_dict(
+            data['output'], output_sink, output_fields())
+        return intermediate_layer, output_layer
+
+    def put(self, key, intermediate_layer, output_layer):
+        """Store the layers of a key, then evict old files if needed.
+
+        :param key: The cache key, see content_key.
+        :type key: str
+
+        :param intermediate_layer: The intermediate layer, None if it was
+            not created.
+        :type intermediate_layer: QgsVectorLayer, None
+
+        :param output_layer: The output layer.
+        :type output_layer: QgsVectorLayer
+        """
+        data = {
+            'intermediate': None,
+            'output': layer_to_dict(output_layer)}
+        if intermediate_layer is not None:
+            data['intermediate'] = layer_to_dict(intermediate_layer)
+        # Write to a temporary file first, so other processes never read a
+        # partly written file.
+        handle, temp_path = mkstemp(
+            suffix='.tmp', prefix=key, dir=self.directory)
+        os.close(handle)
+        try:
+            with gzip.open(temp_path, 'wb') as cache_file:
+                # NULL values can not be written as JSON
+                cache_file.write(json.dumps(
+                    data, separators=(',', ':'), default=lambda x: None))
+            path = self.path(key)
+            if os.path.exists(path):
+                self._remove(path)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            LOGGER.debug('Failed to write the cache file of %s: %s' % (
+                key, e))
+            self._remove(temp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files over the size limit."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        """Remove a file, ignoring errors, e.g. if it is already removed.
+
+        :param path: Path of the file.
+        :type path: str
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def identify_features_cached(
+        cache,
+        input_layer,
+        threshold=0,
+        callback=None,
+        cancel_token=None,
+        report=None,
+        extract=None,
+        intermediate_sink=None,
+        output_sink=None,
+        create_intermediate=True):
+    """Return the cached result of identify_features, or compute and store it.
+
+    :param cache: The result cache.
+    :type cache: ResultCache
+
+    :param input_layer: A vector line layer.
+    :type input_layer: QGISVectorLayer
+
+    :param threshold: Distance threshold for node snapping. Defaults to 0.
+    :type threshold: float
+
+    :param callback: A function to all to indicate progress. The function
+        should accept params 'current' (int) and 'maximum' (int). Defaults to
+        None.
+    :type callback: function
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :param report: Optional run report, see identify_features. The cache
+        stage is recorded in it too.
+    :type report: RunReport
+
+    :param extract: Function used instead of identify_features on a cache
+        miss, with the same arguments, e.g. identify_features_parallel.
+    :type extract: function
+
+    :param intermediate_sink: Optional sink receiving the nodes of the
+        intermediate layer, see identify_features.
+    :type intermediate_sink: MemorySink, FileSink
+
+    :param output_sink: Optional sink receiving the identified features,
+        see identify_features.
+    :type output_sink: MemorySink, FileSink
+
+    :param create_intermediate: If False, the intermediate layer is not
+        created and None is returned instead. Defaults to True.
+    :type create_intermediate: bool
+
+    :returns: A tuple of an intermediate layer that contains nodes and Map
+        layer (memory layer) containing identified features.
+    :rtype: tuple
+    """
+    if extract is None:
+        extract = identify_features
+    with report_stage(report, 'cache') as stage:
+        if callback is not None:
+            callback(
+                current=0, maximum=1, message=tr('Looking for a result...'))
+        key = content_key(input_layer, threshold)
+        result = cache.get(
+            key, intermediate_sink, output_sink, create_intermediate)
+        stage.count('hit', int(result is not None))
+    if result is not None:
+        LOGGER.debug('Using the cached result %s' % key)
+        return result
+
+    intermediate_layer, output_layer = extract(
+        input_layer,
+        threshold,
+        callback=callback,
+        cancel_token=cancel_token,
+        report=report,
+        intermediate_sink=intermediate_sink,
+        output_sink=output_sink,
+        create_intermediate=create_intermediate)
+    cache.put(key, intermediate_layer, output_layer)
+    return intermediate_layer, output_layer
@@ -0,0 +1,264 @@
+# coding=utf-8
+"""
+Command line batch extractor for stream features.
+
+Runs the full extraction on one or more line datasets without creating any
+map canvas or dialog and writes the results to disk, e.g.::
+
+    python stream_cli.py --threshold 1 --output results/ rivers_*.shp
+
+QGIS is only imported once the arguments are parsed, so the script starts
+quickly and --help does not need QGIS at all. Make sure QGIS_PREFIX_PATH
+is set in your env if needed.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import sys
+import argparse
+import traceback
+from functools import partial
+
+# Output drivers by file extension
+DRIVERS = {
+    '.shp': 'ESRI Shapefile',
+    '.gpkg': 'GPKG',
+    '.sqlite': 'SQLite',
+    '.geojson': 'GeoJSON'
+}
+
+
+def parse_arguments(argv=None):
+    """Parse the command line arguments.
+
+    :param argv: The arguments, without the program name. If None,
+        sys.argv is used.
+    :type argv: list
+
+    :returns: The parsed arguments.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description='Extract stream features (wells, sinks, confluences '
+                    'etc.) from line datasets.')
+    parser.add_argument(
+        'inputs', nargs='+', metavar='INPUT',
+        help='A vector line dataset readable by OGR.')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='The output file, or the output directory if there are '
+             'several inputs.')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0,
+        help='Distance threshold for node snapping. Defaults to 0.')
+    parser.add_argument(
+        '-f', '--format', default='.shp', choices=sorted(DRIVERS),
+        help='Output format, used when writing to a directory. Defaults '
+             'to .shp.')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help='Number of processes, 0 for one per CPU. Defaults to 1.')
+    parser.add_argument(
+        '--cache', nargs='?', const='', metavar='DIRECTORY',
+        help='Reuse the results of unchanged inputs, stored in DIRECTORY '
+             'or in the temporary directory of the user.')
+    parser.add_argument(
+        '--intermediate', action='store_true',
+        help='Also write the intermediate nodes layer.')
+    parser.add_argument(
+        '--store', action='store_true',
+        help='Keep the intermediate nodes and their attributes in a SQLite '
+             'file instead of memory. The vertices of the lines are still '
+             'read into memory. With --intermediate, this file is the '
+             'intermediate layer.')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help='Do not print the progress.')
+    arguments = parser.parse_args(argv)
+    if arguments.store and arguments.processes != 1:
+        parser.error('--store only works with a single process.')
+    if arguments.store and arguments.cache is not None:
+        # The cache holds the whole result in memory
+        parser.error('--store can not be used with --cache.')
+    return arguments
+
+
+def output_paths(input_path, output, extension, to_directory):
+    """Return the paths to write the results of an input to.
+
+    :param input_path: Path to the input dataset.
+    :type input_path: str
+
+    :param output: The output file or directory.
+    :type output: str
+
+    :param extension: The output extension used for a directory.
+    :type extension: str
+
+    :param to_directory: True if output is a directory.
+    :type to_directory: bool
+
+    :returns: Tuple of the features path and the intermediate layer path.
+    :rtype: tuple
+    """
+    if to_directory:
+        basename = os.path.splitext(os.path.basename(input_path))[0]
+        features_path = os.path.join(
+            output, '%s_features%s' % (basename, extension))
+    else:
+        features_path = output
+    base, extension = os.path.splitext(features_path)
+    intermediate_path = '%s_intermediate%s' % (base, extension)
+    return features_path, intermediate_path
+
+
+def silent_callback(current, maximum, message=None):
+    """Progress callback that does nothing, used with --quiet.
+
+    :param current: Current progress.
+    :type current: int
+
+    :param maximum: Maximum range (point at which task is complete.
+    :type maximum: int
+
+    :param message: Optional message to display in the progress bar
+    :type message: str, QString
+    """
+    pass
+
+
+def driver_name(path):
+    """Return the OGR driver writing a file, chosen by its extension.
+
+    :param path: Output path.
+    :type path: str
+
+    :returns: The driver name, 'ESRI Shapefile' for unknown extensions.
+    :rtype: str
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return DRIVERS.get(extension, 'ESRI Shapefile')
+
+
+def main(argv=None):
+    """Run the extraction for every input given on the command line.
+
+    :param argv: The arguments, without the program name. If None,
+        sys.argv is used.
+    :type argv: list
+
+    :returns: Exit status, 0 if every input was processed.
+    :rtype: int
+    """
+    arguments = parse_arguments(argv)
+    to_directory = (
+        len(arguments.inputs) > 1 or os.path.isdir(arguments.output))
+    if to_directory and not os.path.exists(arguments.output):
+        os.makedirs(arguments.output)
+
+    # Import QGIS only now so that argument errors are reported quickly
+    from qgis.core import QgsApplication, QgsVectorLayer
+    from stream_utilities import (
+        identify_features, is_line_layer, console_progress_callback)
+    from stream_parallel import identify_features_parallel
+    from stream_cache import ResultCache, identify_features_cached
+    from stream_output import FileSink
+    from stream_store import NodeStore
+
+    if arguments.quiet:
+        callback = silent_callback
+    else:
+        callback = console_progress_callback
+
+    if arguments.processes == 1:
+        extract = identify_features
+    else:
+        extract = partial(
+            identify_features_parallel, processes=arguments.processes or None)
+    cache = None
+    if arguments.cache is not None:
+        cache = ResultCache(arguments.cache or None)
+
+    # Reuse the application of the process if there is one, e.g. when main
+    # is called from a script or a test, and only exit the one created here.
+    application = QgsApplication.instance()
+    own_application = application is None
+    if own_application:
+        application = QgsApplication([], False)
+        application.initQgis()
+    status = 0
+    try:
+        for input_path in arguments.inputs:
+            name = os.path.splitext(os.path.basename(input_path))[0]
+            layer = QgsVectorLayer(input_path, name, 'ogr')
+            if not layer.isValid() or not is_line_layer(layer):
+                sys.stderr.write(
+                    '%s is not a valid line dataset.\n' % input_path)
+                status = 1
+                continue
+
+            store = None
+            # An input that fails is reported and the next ones are still
+            # processed.
+            # noinspection PyBroadException
+            try:
+                features_path, intermediate_path = output_paths(
+                    input_path, arguments.output, arguments.format,
+                    to_directory)
+                # The features are written to the files while they are
+                # created
+                output_sink = FileSink(
+                    features_path, driver_name(features_path))
+                intermediate_sink = None
+                input_extract = extract
+                if arguments.store:
+                    intermediate_path = '%s.sqlite' % os.path.splitext(
+                        intermediate_path)[0]
+                    store = NodeStore(
+                        intermediate_path if arguments.intermediate else None)
+                    input_extract = partial(extract, intermediate_store=store)
+                elif arguments.intermediate:
+                    intermediate_sink = FileSink(
+                        intermediate_path, driver_name(intermediate_path))
+                if cache is None:
+                    input_extract(
+                        layer,
+                        arguments.threshold,
+                        callback=callback,
+                        intermediate_sink=intermediate_sink,
+                        output_sink=output_sink,
+                        create_intermediate=arguments.intermediate)
+                else:
+                    identify_features_cached(
+                        cache,
+                        layer,
+                        arguments.threshold,
+                        callback=callback,
+                        extract=input_extract,
+                        intermediate_sink=intermediate_sink,
+                        output_sink=output_sink,
+                        create_intermediate=arguments.intermediate)
+            except Exception:  # pylint: disable=W0703
+                sys.stderr.write('Failed to process %s:\n%s' % (
+                    input_path, traceback.format_exc()))
+                status = 1
+                continue
+            finally:
+                if store is not None:
+                    store.close()
+    finally:
+        if own_application:
+            application.exitQgis()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -36,19 +36,19 @@ from PyQt4.QtCore import (
     QTranslator,
     qVersion,
     QCoreApplication,
+    QThread,
     QUrl)
 from PyQt4.QtGui import (
     QAction,
     QIcon,
-    QProgressBar)
+    QProgressBar,
+    QPushButton)
 from qgis.core import QgsMapLayerRegistry
 from qgis.gui import QgsMessageBar
-# Initialize Qt resources from file resources.py
-import resources_rc
-# Import the code for the dialog
-from stream_utilities import is_line_layer, identify_features
-from stream_options_dialog import OptionsDialog
-from stream_help_dialog import HelpDialog
+# The resources, the dialogs and the extraction are imported when they are
+# first used, to keep the start of QGIS fast.
+from stream_output import is_line_layer
+from stream_report import report_stage
 
 MENU_GROUP_LABEL = u'Stream feature extractor'
 MENU_RUN_LABEL = u'Extract from current layer'
@@ -58,13 +58,17 @@ LOGGER = logging.getLogger('QGIS')
 class StreamFeatureExtractor:
     """QGIS Plugin Implementation."""
 
-    def __init__(self, iface):
+    def __init__(self, iface, startup_report=None):
         """Constructor.
 
         :param iface: An interface instance that will be passed to this class
             which provides the hook by which you can manipulate the QGIS
             application at run time.
         :type iface: QgsInterface
+
+        :param startup_report: Optional report timing the plugin startup,
+            it is written to the log once the GUI is initialised.
+        :type startup_report: RunReport
         """
         # Enable remote debugging - should normally be commented out.
         # pydevd.settrace(
@@ -94,6 +98,10 @@ class StreamFeatureExtractor:
         self.options_action = None
         self.help_action = None
         self.message_bar = None
+        self.worker = None
+        self.thread = None
+        self.load_intermediate_layer = False
+        self.startup_report = startup_report
 
         # Declare instance attributes
 
@@ -198,6 +206,17 @@ class StreamFeatureExtractor:
     # noinspection PyPep8Naming
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
+        with report_stage(self.startup_report, 'init_gui'):
+            self._init_gui()
+        if self.startup_report is not None:
+            LOGGER.info('Stream feature extractor startup timing:')
+            self.startup_report.log()
+            self.startup_report = None
+
+    def _init_gui(self):
+        """Create the actions, see initGui."""
+        # Initialize Qt resources from file resources.py, for the icon
+        import resources_rc  # pylint: disable=W0611
         self.menu = u'Stream feature extractor'
         icon_path = ':/plugins/StreamFeatureExtractor/icon.svg'
         self.run_action = self.add_action(
@@ -253,7 +272,14 @@ class StreamFeatureExtractor:
         QgsMapLayerRegistry.instance().addMapLayer(nodes)
 
     def run(self):
-        """Run method that performs all the real work."""
+        """Run method that performs all the real work.
+
+        The extraction runs in an ExtractorWorker on a separate thread, so
+        QGIS stays responsive and the user can cancel it.
+        """
+        from stream_worker import ExtractorWorker
+        from stream_cache import ResultCache
+
         message_bar = self.iface.messageBar().createMessage(
             self.tr('Extracting stream features'),
             self.tr('Please stand by while calculation is in progress.'),
@@ -261,12 +287,10 @@ class StreamFeatureExtractor:
 
         progress_bar = QProgressBar()
         progress_bar.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        # Need to implement a separate worker thread if we want cancel
-        #cancel_button = QPushButton()
-        #cancel_button.setText(self.tr('Cancel'))
-        #cancel_button.clicked.connect(worker.kill)
+        cancel_button = QPushButton()
+        cancel_button.setText(self.tr('Cancel'))
         message_bar.layout().addWidget(progress_bar)
-        #message_bar.layout().addWidget(cancel_button)
+        message_bar.layout().addWidget(cancel_button)
         self.iface.messageBar().pushWidget(
             message_bar, self.iface.messageBar().INFO)
         self.message_bar = message_bar
@@ -292,32 +316,65 @@ class StreamFeatureExtractor:
         settings = QSettings()
         distance = settings.value(
             'stream-feature-extractor/search-distance', 0, type=float)
-        load_intermediate_layer = settings.value(
+        self.load_intermediate_layer = settings.value(
             'stream-feature-extractor/load-intermediate-layer',
             False,
             type=bool)
-        # noinspection PyBroadException
-        try:
-            intermediate_layer, nodes = identify_features(
-                self.iface.activeLayer(),
-                threshold=distance,
-                callback=progress_callback)
-        except Exception:
-            LOGGER.exception('A failure occurred calling identify_features.')
-            self.iface.messageBar().popWidget(message_bar)
-            self.iface.messageBar().pushMessage(
-                self.tr('Feature extraction error.'),
-                self.tr('Please check logs for details.'),
-                level=QgsMessageBar.CRITICAL,
-                duration=5)
-            return
-
-        # Get rid of the message bar again.
-        self.iface.messageBar().popWidget(message_bar)
+        cache = None
+        if settings.value(
+                'stream-feature-extractor/result-cache', False, type=bool):
+            cache = ResultCache()
+
+        # The intermediate layer is only built when it is shown
+        worker = ExtractorWorker(
+            self.iface.activeLayer(),
+            distance,
+            cache,
+            self.load_intermediate_layer)
+        thread = QThread(self.iface.mainWindow())
+        worker.moveToThread(thread)
+        worker.progress.connect(progress_callback)
+        worker.finished.connect(self.extraction_finished)
+        worker.error.connect(self.extraction_error)
+        worker.cancelled.connect(self.extraction_cancelled)
+        # Not connected to worker.kill: the worker lives in the thread that
+        # runs the extraction, a slot of the worker would only be called once
+        # the extraction is over. The token is cancelled from this thread.
+        cancel_button.clicked.connect(
+            lambda: worker.cancel_token.cancel())
+        thread.started.connect(worker.run)
+        self.worker = worker
+        self.thread = thread
+        self.run_action.setEnabled(False)
+        thread.start()
+
+    def _stop_worker(self):
+        """Stop the worker thread and get rid of the message bar."""
+        self.thread.quit()
+        self.thread.wait()
+        self.worker.deleteLater()
+        self.thread.deleteLater()
+        self.worker = None
+        self.thread = None
+        self.iface.messageBar().popWidget(self.message_bar)
+        self.message_bar = None
+        self.layer_changed(self.iface.activeLayer())
+
+    def extraction_finished(self, intermediate_layer, nodes):
+        """Load the extraction results into the map.
+
+        :param intermediate_layer: The intermediate layer, None if it is not
+            shown.
+        :type intermediate_layer: QgsVectorLayer, None
+
+        :param nodes: The layer containing the identified features.
+        :type nodes: QgsVectorLayer
+        """
+        self._stop_worker()
 
         self._load_nodes_with_style(nodes)
 
-        if load_intermediate_layer:
+        if intermediate_layer is not None:
             QgsMapLayerRegistry.instance().addMapLayer(intermediate_layer)
 
         #QgsMapLayerRegistry.instance().addMapLayers([layer])
@@ -327,6 +384,29 @@ class StreamFeatureExtractor:
             level=QgsMessageBar.INFO,
             duration=10)
 
+    def extraction_error(self, message):
+        """Tell the user the extraction failed.
+
+        :param message: The error message.
+        :type message: str
+        """
+        self._stop_worker()
+        LOGGER.debug('Feature extraction error: %s' % message)
+        self.iface.messageBar().pushMessage(
+            self.tr('Feature extraction error.'),
+            self.tr('Please check logs for details.'),
+            level=QgsMessageBar.CRITICAL,
+            duration=5)
+
+    def extraction_cancelled(self):
+        """Tell the user the extraction has been cancelled."""
+        self._stop_worker()
+        self.iface.messageBar().pushMessage(
+            self.tr('Extraction cancelled.'),
+            '',
+            level=QgsMessageBar.INFO,
+            duration=5)
+
     def show_help(self):
         """Display application help to the user."""
         locale_path = os.path.join(
@@ -341,6 +421,7 @@ class StreamFeatureExtractor:
             help_file = 'file:///%s/help/en/index.html' % os.path.dirname(
                 __file__)
         LOGGER.debug('Opening this help file:\n%s' % help_file)
+        from stream_help_dialog import HelpDialog
         results_dialog = HelpDialog()
         results_dialog.web_view.load(QUrl(help_file))
         results_dialog.exec_()
@@ -348,6 +429,7 @@ class StreamFeatureExtractor:
     @staticmethod
     def show_options():
         """Show dialog with plugin options."""
+        from stream_options_dialog import OptionsDialog
         # show the dialog
         dialog = OptionsDialog()
         result = dialog.exec_()
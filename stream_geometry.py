@@ -0,0 +1,1340 @@
+# coding=utf-8
+"""
+Geometry core of the feature extraction, independent of QGIS.
+
+The algorithms work on coordinates given as lists or numpy arrays and
+(x, y) tuples, so they can be imported and run without starting QGIS, e.g.
+in worker processes or in tests. stream_utilities adapts them to QGIS
+layers and features.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from __future__ import division
+
+import heapq
+import struct
+from array import array
+from math import sqrt, floor
+
+import numpy
+
+from stream_report import report_stage
+
+
+class ExtractionCancelled(Exception):
+    """Raised when an extraction is cancelled through its CancellationToken."""
+    pass
+
+
+class CancellationToken(object):
+    """Cooperative cancellation flag shared with a running extraction.
+
+    The token is cancelled from another thread (e.g. by a cancel button) and
+    the long running loops call check() to stop as soon as possible.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.cancelled = False
+
+    def cancel(self):
+        """Request the extraction to stop."""
+        self.cancelled = True
+
+    def check(self):
+        """Raise ExtractionCancelled if the token has been cancelled.
+
+        :raises: ExtractionCancelled
+        """
+        if self.cancelled:
+            raise ExtractionCancelled('The extraction has been cancelled.')
+
+
+def list_to_str(the_list, sep=','):
+    """Convert a list to str. If empty, return empty string.
+
+    :param the_list: A list.
+    :type the_list: list
+
+    :param sep: Separator for each element in the result.
+    :type sep: str
+
+    :returns: String represent the_list.
+    :rtype: str
+    """
+    if len(the_list) > 0:
+        return sep.join([str(x) for x in the_list])
+    else:
+        return ''
+
+
+def str_to_list(the_str, sep=',', the_type=None):
+    """Convert the_str to list.
+
+    :param the_str: String represents a list.
+    :type the_str: str
+
+    :param sep: Separator for each element in the_str.
+    :type sep: str
+
+    :param the_type: Type of the element.
+    :type the_type: type
+
+    :returns: List from the_str.
+    :rtype: list
+    """
+    if len(the_str) == 0:
+        return []
+    the_list = the_str.split(sep)
+    if the_type is None:
+        return the_list
+    else:
+        try:
+            return [the_type(x) for x in the_list]
+        except TypeError:
+            raise TypeError('%s is not valid type' % the_type)
+
+
+def to_list(values):
+    """Convert a sequence or a numpy array to a list of python values.
+
+    :param values: A sequence.
+    :type values: list, tuple, numpy.ndarray
+
+    :returns: List of the values.
+    :rtype: list
+    """
+    if isinstance(values, numpy.ndarray):
+        return values.tolist()
+    return list(values)
+
+
+class NodeArrays(object):
+    """Columnar representation of the nodes of a vector line layer.
+
+    Every line is represented by its id and the coordinates of its first and
+    last point, each held in a contiguous numpy array.
+    """
+
+    def __init__(self, line_ids, start_x, start_y, end_x, end_y):
+        """Constructor.
+
+        :param line_ids: The id of every line.
+        :type line_ids: numpy.ndarray
+
+        :param start_x: X coordinate of the first point of every line.
+        :type start_x: numpy.ndarray
+
+        :param start_y: Y coordinate of the first point of every line.
+        :type start_y: numpy.ndarray
+
+        :param end_x: X coordinate of the last point of every line.
+        :type end_x: numpy.ndarray
+
+        :param end_y: Y coordinate of the last point of every line.
+        :type end_y: numpy.ndarray
+        """
+        self.line_ids = line_ids
+        self.start_x = start_x
+        self.start_y = start_y
+        self.end_x = end_x
+        self.end_y = end_y
+
+    def __len__(self):
+        return len(self.line_ids)
+
+    def endpoints(self):
+        """Return the nodes as interleaved upstream and downstream arrays.
+
+        The position of a node in the arrays is the id given to it by
+        create_nodes_layer: the upstream node of the i-th line is 2 * i and
+        its downstream node is 2 * i + 1.
+
+        :returns: Tuple of line_ids, xs, ys and upstream (True for an upstream
+            node) arrays.
+        :rtype: tuple
+        """
+        line_ids = numpy.repeat(self.line_ids, 2)
+        xs = numpy.column_stack((self.start_x, self.end_x)).ravel()
+        ys = numpy.column_stack((self.start_y, self.end_y)).ravel()
+        upstream = numpy.tile(numpy.array([True, False]), len(self))
+        return line_ids, xs, ys, upstream
+
+
+class NodeGrid(object):
+    """Uniform grid hash for finding nodes near a location.
+
+    Points are bucketed in a single pass by
+    ``(floor(x / threshold), floor(y / threshold))`` so every point within
+    threshold of a location lies in the 3x3 block of cells around it. With a
+    threshold of 0 the points are bucketed by their exact coordinates.
+
+    A point is considered nearby when it falls inside the square of
+    ``2 * threshold`` centred on the location, the same test as the
+    QgsRectangle filter used by get_nearby_nodes.
+
+    The points are identified by their index in xs and ys. A grid created
+    with NodeGrid.empty identifies them by any sortable key instead, and
+    points can be added to it and removed from it.
+    """
+
+    def __init__(self, xs, ys, threshold):
+        """Constructor.
+
+        :param xs: X coordinates of the points, or of the keys of the points
+            if it is a dictionary.
+        :type xs: list, numpy.ndarray, dict
+
+        :param ys: Y coordinates of the points, or of the keys of the points
+            if it is a dictionary.
+        :type ys: list, numpy.ndarray, dict
+
+        :param threshold: Distance threshold.
+        :type threshold: float
+        """
+        if isinstance(xs, dict):
+            self.xs = xs
+            self.ys = ys
+            keys = list(xs)
+        else:
+            self.xs = to_list(xs)
+            self.ys = to_list(ys)
+            keys = range(len(self.xs))
+        self.threshold = threshold
+        self.cells = {}
+        for key in keys:
+            cell = self.cell(self.xs[key], self.ys[key])
+            self.cells.setdefault(cell, []).append(key)
+
+    @classmethod
+    def empty(cls, threshold):
+        """Return an empty grid, the points are added with add.
+
+        :param threshold: Distance threshold.
+        :type threshold: float
+
+        :returns: The grid.
+        :rtype: NodeGrid
+        """
+        return cls({}, {}, threshold)
+
+    def __contains__(self, key):
+        return key in self.xs
+
+    def __getitem__(self, key):
+        return self.xs[key], self.ys[key]
+
+    def cell(self, x, y):
+        """Return the key of the cell that contains (x, y).
+
+        :param x: X coordinate.
+        :type x: float
+
+        :param y: Y coordinate.
+        :type y: float
+
+        :returns: The cell key.
+        :rtype: tuple
+        """
+        if self.threshold > 0:
+            return (
+                int(floor(x / self.threshold)),
+                int(floor(y / self.threshold)))
+        return x, y
+
+    def nearby(self, x, y):
+        """Return indexes of all points within threshold of (x, y).
+
+        :param x: X coordinate.
+        :type x: float
+
+        :param y: Y coordinate.
+        :type y: float
+
+        :returns: Sorted list of point indexes, or keys with a grid created
+            by NodeGrid.empty.
+        :rtype: list
+        """
+        threshold = self.threshold
+        if threshold <= 0:
+            return list(self.cells.get((x, y), []))
+
+        xs = self.xs
+        ys = self.ys
+        min_column, min_row = self.cell(x - threshold, y - threshold)
+        max_column, max_row = self.cell(x + threshold, y + threshold)
+        result = []
+        for column in range(min_column, max_column + 1):
+            for row in range(min_row, max_row + 1):
+                for index in self.cells.get((column, row), []):
+                    if (abs(xs[index] - x) <= threshold and
+                            abs(ys[index] - y) <= threshold):
+                        result.append(index)
+        result.sort()
+        return result
+
+    def add(self, key, x, y):
+        """Add a point to a grid created by NodeGrid.empty.
+
+        :param key: The key of the point.
+        :type key: tuple
+
+        :param x: X coordinate.
+        :type x: float
+
+        :param y: Y coordinate.
+        :type y: float
+        """
+        self.xs[key] = x
+        self.ys[key] = y
+        self.cells.setdefault(self.cell(x, y), []).append(key)
+
+    def remove(self, key):
+        """Remove a point from a grid created by NodeGrid.empty.
+
+        :param key: The key of the point.
+        :type key: tuple
+
+        :returns: The (x, y) coordinates of the point.
+        :rtype: tuple
+        """
+        x = self.xs.pop(key)
+        y = self.ys.pop(key)
+        cell = self.cell(x, y)
+        self.cells[cell].remove(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+        return x, y
+
+    def components(self, seeds):
+        """Return the points connected to the seeds by nearby points.
+
+        :param seeds: Indexes or keys of points in the grid.
+        :type seeds: iterable
+
+        :returns: Set of indexes or keys, the union of the clusters of the
+            seeds.
+        :rtype: set
+        """
+        result = set(seeds)
+        stack = list(result)
+        while stack:
+            key = stack.pop()
+            for nearby in self.nearby(self.xs[key], self.ys[key]):
+                if nearby not in result:
+                    result.add(nearby)
+                    stack.append(nearby)
+        return result
+
+
+class Adjacency(object):
+    """Nearby nodes of every node, in compressed sparse row form.
+
+    The nearby nodes of all the nodes are held in a single neighbours array.
+    The nearby nodes of node i are ``neighbours[offsets[i]:offsets[i + 1]]``,
+    so no list or string is built per node.
+    """
+
+    def __init__(self, offsets, neighbours):
+        """Constructor.
+
+        :param offsets: Start of the nearby nodes of every node in
+            neighbours, followed by the length of neighbours.
+        :type offsets: numpy.ndarray
+
+        :param neighbours: The nearby nodes of all the nodes.
+        :type neighbours: numpy.ndarray
+        """
+        self.offsets = offsets
+        self.neighbours = neighbours
+
+    @classmethod
+    def from_lists(cls, lists):
+        """Create an Adjacency from the list of nearby nodes of every node.
+
+        :param lists: List of lists of node indexes.
+        :type lists: list
+
+        :returns: The adjacency.
+        :rtype: Adjacency
+        """
+        offsets = numpy.zeros(len(lists) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(x) for x in lists])
+        neighbours = array('l')
+        for x in lists:
+            neighbours.extend(x)
+        return cls(offsets, numpy.array(neighbours, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """Return the nearby nodes of a node.
+
+        :param index: The node.
+        :type index: int
+
+        :returns: View of the nearby nodes in neighbours.
+        :rtype: numpy.ndarray
+        """
+        return self.neighbours[self.offsets[index]:self.offsets[index + 1]]
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Adjacency) and
+            numpy.array_equal(self.offsets, other.offsets) and
+            numpy.array_equal(self.neighbours, other.neighbours))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def counts(self):
+        """Return the number of nearby nodes of every node.
+
+        :returns: The counts.
+        :rtype: numpy.ndarray
+        """
+        return numpy.diff(self.offsets)
+
+    def rows(self):
+        """Return the node of every item of neighbours.
+
+        :returns: Array as long as neighbours.
+        :rtype: numpy.ndarray
+        """
+        return numpy.repeat(numpy.arange(len(self)), self.counts())
+
+    def lists(self):
+        """Return the nearby nodes of every node as lists.
+
+        :returns: List of lists of node indexes.
+        :rtype: list
+        """
+        neighbours = self.neighbours.tolist()
+        offsets = self.offsets.tolist()
+        return [
+            neighbours[offsets[index]:offsets[index + 1]]
+            for index in range(len(self))]
+
+    def strings(self, sep=','):
+        """Return the nearby nodes of every node as strings.
+
+        The strings are only needed for the attributes of the intermediate
+        layer, see list_to_str.
+
+        :param sep: Separator for each node in the strings.
+        :type sep: str
+
+        :returns: List of strings.
+        :rtype: list
+        """
+        return [list_to_str(x, sep) for x in self.lists()]
+
+
+def associate_nodes(
+        xs, ys, upstream, threshold, callback=None, cancel_token=None):
+    """Find the nearby upstream and downstream nodes of every node.
+
+    Nodes are identified by their position in the arrays.
+
+    :param xs: X coordinates of the nodes.
+    :type xs: list, numpy.ndarray
+
+    :param ys: Y coordinates of the nodes.
+    :type ys: list, numpy.ndarray
+
+    :param upstream: True for an upstream node, False for a downstream node.
+    :type upstream: list, numpy.ndarray
+
+    :param threshold: Distance threshold.
+    :type threshold: float
+
+    :param callback: A function to all to indicate progress. The function
+        should accept params 'current' (int) and 'maximum' (int). Defaults to
+        None.
+    :type callback: function
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :returns: Tuple of up_nodes, down_nodes, up_num and down_num. up_nodes
+        and down_nodes are the Adjacency of the nearby node positions of
+        every node. up_num and down_num count them, including the node
+        itself.
+    :rtype: tuple
+    """
+    grid = NodeGrid(xs, ys, threshold)
+    xs = grid.xs
+    ys = grid.ys
+    upstream = to_list(upstream)
+
+    node_count = len(xs)
+    up_offsets = array('l', [0])
+    down_offsets = array('l', [0])
+    up_neighbours = array('l')
+    down_neighbours = array('l')
+    for index in range(node_count):
+        if cancel_token is not None:
+            cancel_token.check()
+        if callback is not None:
+            if (index + 1) % 100 == 0:
+                callback(current=index + 1, maximum=node_count)
+        for nearby_index in grid.nearby(xs[index], ys[index]):
+            if nearby_index == index:
+                continue
+            if upstream[nearby_index]:
+                up_neighbours.append(nearby_index)
+            else:
+                down_neighbours.append(nearby_index)
+        up_offsets.append(len(up_neighbours))
+        down_offsets.append(len(down_neighbours))
+
+    if callback:
+        callback(current=node_count, maximum=node_count)
+
+    up_nodes = Adjacency(
+        numpy.array(up_offsets, dtype=numpy.int64),
+        numpy.array(up_neighbours, dtype=numpy.int64))
+    down_nodes = Adjacency(
+        numpy.array(down_offsets, dtype=numpy.int64),
+        numpy.array(down_neighbours, dtype=numpy.int64))
+    is_upstream = numpy.array(upstream, dtype=bool)
+    up_num = (up_nodes.counts() + is_upstream).astype(numpy.int32)
+    down_num = (down_nodes.counts() + ~is_upstream).astype(numpy.int32)
+    return up_nodes, down_nodes, up_num, down_num
+
+
+# Attributes used to mark the node types, in the order they are reported.
+NODE_ATTRIBUTES = [
+    'well',
+    'sink',
+    'branch',
+    'confluence',
+    'pseudo',
+    'watershed',
+    'unclear_bi']
+
+
+# The rule of every node type, computed from the up_num and down_num arrays
+NODE_RULES = {
+    'well': lambda up_num, down_num: (up_num == 1) & (down_num == 0),
+    'sink': lambda up_num, down_num: (up_num == 0) & (down_num > 0),
+    'branch': lambda up_num, down_num: (1 <= down_num) & (down_num < up_num),
+    'confluence': lambda up_num, down_num: (
+        (1 <= up_num) & (up_num < down_num)),
+    'pseudo': lambda up_num, down_num: (up_num == 1) & (down_num == 1),
+    'watershed': lambda up_num, down_num: (up_num > 1) & (down_num == 0),
+    'unclear_bi': lambda up_num, down_num: (
+        (up_num > 1) & (up_num == down_num))
+}
+
+
+def classify_nodes(up_num, down_num, report=None):
+    """Compute all node type flags from the node counts in a single pass.
+
+    See the identify_* functions for the definition of every node type.
+
+    :param up_num: Number of upstream nodes of every node.
+    :type up_num: list, numpy.ndarray
+
+    :param down_num: Number of downstream nodes of every node.
+    :type down_num: list, numpy.ndarray
+
+    :param report: Optional run report, every rule is recorded as a
+        rule_<attribute> stage.
+    :type report: RunReport
+
+    :returns: Dictionary of node type attribute (see NODE_ATTRIBUTES) to an
+        array holding 1 for the nodes of that type, otherwise 0.
+    :rtype: dict
+    """
+    up_num = numpy.asarray(up_num)
+    down_num = numpy.asarray(down_num)
+    flags = {}
+    for attribute in NODE_ATTRIBUTES:
+        with report_stage(report, 'rule_%s' % attribute) as stage:
+            rule = NODE_RULES[attribute]
+            flags[attribute] = rule(up_num, down_num).astype(numpy.int32)
+            stage.count('nodes', int(flags[attribute].sum()))
+    return flags
+
+
+class AssociatedNodes(object):
+    """The nodes of the lines with their nearby nodes and node types.
+
+    This is the content of the intermediate layer, kept in arrays so the
+    output points can be found without building or reading the layer.
+    Node i is the i-th node of NodeArrays.endpoints, i.e. the node with id i
+    in the intermediate layer.
+    """
+
+    def __init__(self, nodes, up_nodes, down_nodes, up_num, down_num, flags):
+        """Constructor.
+
+        :param nodes: The end points of the lines.
+        :type nodes: NodeArrays
+
+        :param up_nodes: Nearby upstream nodes of every node.
+        :type up_nodes: Adjacency
+
+        :param down_nodes: Nearby downstream nodes of every node.
+        :type down_nodes: Adjacency
+
+        :param up_num: Number of upstream nodes of every node.
+        :type up_num: numpy.ndarray
+
+        :param down_num: Number of downstream nodes of every node.
+        :type down_num: numpy.ndarray
+
+        :param flags: The node type flags, see classify_nodes.
+        :type flags: dict
+        """
+        self.nodes = nodes
+        _, self.xs, self.ys, self.upstream = nodes.endpoints()
+        self.up_nodes = up_nodes
+        self.down_nodes = down_nodes
+        self.up_num = up_num
+        self.down_num = down_num
+        self.flags = flags
+
+    def __len__(self):
+        return len(self.xs)
+
+    def representatives(self):
+        """Return the nodes that stand for their group of nearby nodes.
+
+        The nodes are visited in order and a node is skipped when it is a
+        nearby node of a node visited before, so every group of nearby
+        nodes is reported once.
+
+        :returns: Sorted list of node indexes.
+        :rtype: list
+        """
+        expired = numpy.zeros(len(self), dtype=bool)
+        result = []
+        for index in range(len(self)):
+            if expired[index]:
+                continue
+            result.append(index)
+            expired[self.up_nodes[index]] = True
+            expired[self.down_nodes[index]] = True
+        return result
+
+
+def between(a, b, c):
+    """True if c is between a and b."""
+    if a < b < c:
+        return True
+    if c < b < a:
+        return True
+    return False
+
+
+def point_in_line(point, line):
+    """True if a point is in a line that has only two vertices."""
+    x_point = point[0]
+    y_point = point[1]
+    x1_line = line[0][0]
+    y1_line = line[0][1]
+    x2_line = line[1][0]
+    y2_line = line[1][1]
+    return (between(x1_line, x_point, x2_line)
+            and between(y1_line, y_point, y2_line))
+
+
+def deduplicate_points(points, precision=0):
+    """Return the points without duplicates, keeping the first occurrence.
+
+    Points are compared by their coordinates rounded to a multiple of
+    precision, using a set of (x, y) keys.
+
+    :param points: List of QgsPoint or (x, y) tuples.
+    :type points: list
+
+    :param precision: The size of the grid the coordinates are rounded to
+        before comparing them. If 0, the exact coordinates are compared.
+        Defaults to 0.
+    :type precision: float
+
+    :returns: List of unique points.
+    :rtype: list
+    """
+    seen = set()
+    result = []
+    for point in points:
+        if precision > 0:
+            key = (
+                int(round(point[0] / precision)),
+                int(round(point[1] / precision)))
+        else:
+            key = (point[0], point[1])
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(point)
+    return result
+
+
+def monotone_chains(vertices):
+    """Split a polyline into chains of segments monotone in x and y.
+
+    Two segments of the same chain can not cross each other, so only
+    segments from different chains need to be compared when looking for
+    self intersections.
+
+    :param vertices: The vertices of the line as (x, y) pairs.
+    :type vertices: list
+
+    :returns: List of chains. A chain is a list of segment indexes (segment i
+        goes from vertex i to vertex i + 1) sorted by increasing x.
+    :rtype: list
+    """
+    chains = []
+    chain = []
+    x_direction = 0
+    y_direction = 0
+    for i in range(len(vertices) - 1):
+        dx = vertices[i + 1][0] - vertices[i][0]
+        dy = vertices[i + 1][1] - vertices[i][1]
+        segment_x_direction = (dx > 0) - (dx < 0)
+        segment_y_direction = (dy > 0) - (dy < 0)
+        if (segment_x_direction * x_direction < 0 or
+                segment_y_direction * y_direction < 0):
+            chains.append((chain, x_direction))
+            chain = []
+            x_direction = 0
+            y_direction = 0
+        chain.append(i)
+        x_direction = x_direction or segment_x_direction
+        y_direction = y_direction or segment_y_direction
+    if chain:
+        chains.append((chain, x_direction))
+    return [
+        chain[::-1] if x_direction < 0 else chain
+        for chain, x_direction in chains]
+
+
+class IntervalGrid(object):
+    """Uniform grid hash of intervals for finding the overlapping ones.
+
+    An interval is stored in every cell of size cell_size it covers, so the
+    intervals overlapping a query are found in the cells the query covers.
+    Intervals can be added and removed, as the active chains of a sweep.
+    """
+
+    def __init__(self, cell_size):
+        """Constructor.
+
+        :param cell_size: Size of the cells, should be about the size of
+            the intervals.
+        :type cell_size: float
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+        self.intervals = {}
+
+    def cell_range(self, low, high):
+        """Return the indexes of the cells covered by an interval.
+
+        :param low: Start of the interval.
+        :type low: float
+
+        :param high: End of the interval.
+        :type high: float
+
+        :returns: The cell indexes.
+        :rtype: range
+        """
+        return range(
+            int(floor(low / self.cell_size)),
+            int(floor(high / self.cell_size)) + 1)
+
+    def add(self, key, low, high):
+        """Add an interval.
+
+        :param key: The key of the interval.
+        :type key: int
+
+        :param low: Start of the interval.
+        :type low: float
+
+        :param high: End of the interval.
+        :type high: float
+        """
+        self.intervals[key] = low, high
+        for cell in self.cell_range(low, high):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        """Remove an interval.
+
+        :param key: The key of the interval.
+        :type key: int
+        """
+        low, high = self.intervals.pop(key)
+        for cell in self.cell_range(low, high):
+            keys = self.cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+
+    def overlapping(self, low, high):
+        """Return the keys of the intervals overlapping [low, high].
+
+        :param low: Start of the query.
+        :type low: float
+
+        :param high: End of the query.
+        :type high: float
+
+        :returns: Sorted list of keys.
+        :rtype: list
+        """
+        result = set()
+        for cell in self.cell_range(low, high):
+            for key in self.cells.get(cell, ()):
+                interval = self.intervals[key]
+                if interval[0] <= high and interval[1] >= low:
+                    result.add(key)
+        return sorted(result)
+
+
+def self_intersection_candidates(vertices):
+    """Return the pairs of segments of a line that may intersect.
+
+    The line is split into monotone chains and the chains are swept along
+    the x axis. The chains still overlapping the sweep line are expired
+    from a heap ordered by their max x and are indexed by their y range in
+    an IntervalGrid, so a chain is only compared to the chains whose
+    bounding box overlaps its own. Within two such chains, the segments are
+    matched with a window moving along x. This makes it
+    O(n log n + c + k), where c is the number of segments of the pairs of
+    chains with overlapping bounding boxes and k the number of candidates,
+    instead of comparing every pair of segments or of chains.
+
+    Adjacent segments, which always share a vertex, are not candidates.
+
+    :param vertices: The vertices of the line as (x, y) pairs.
+    :type vertices: list
+
+    :returns: Sorted list of (i, j) pairs of segment indexes with i < j
+        (segment i goes from vertex i to vertex i + 1).
+    :rtype: list
+    """
+    candidates = []
+    if len(vertices) <= 2:
+        return candidates
+
+    xs = [vertex[0] for vertex in vertices]
+    ys = [vertex[1] for vertex in vertices]
+
+    def x_range(segment):
+        """Return the min and max x of a segment."""
+        return min(xs[segment], xs[segment + 1]), max(
+            xs[segment], xs[segment + 1])
+
+    def y_overlaps(segment_1, segment_2):
+        """True if the y ranges of two segments overlap."""
+        return (
+            min(ys[segment_1], ys[segment_1 + 1]) <=
+            max(ys[segment_2], ys[segment_2 + 1]) and
+            min(ys[segment_2], ys[segment_2 + 1]) <=
+            max(ys[segment_1], ys[segment_1 + 1]))
+
+    chains = []
+    for segments in monotone_chains(vertices):
+        # A monotone chain is bounded by its first and last vertices
+        first = min(segments)
+        last = max(segments) + 1
+        chains.append((
+            min(xs[first], xs[last]),
+            max(xs[first], xs[last]),
+            min(ys[first], ys[last]),
+            max(ys[first], ys[last]),
+            segments))
+    chains.sort(key=lambda chain: chain[0])
+
+    # Cells about as high as the chains, so a chain covers a few cells
+    cell_size = sum(chain[3] - chain[2] for chain in chains) / len(chains)
+    if cell_size <= 0:
+        cell_size = max(max(ys) - min(ys), 1.0)
+    active_grid = IntervalGrid(cell_size)
+    # (max x, index) of the active chains
+    active_heap = []
+    for index, chain in enumerate(chains):
+        min_x, max_x, min_y, max_y, segments = chain
+        while active_heap and active_heap[0][0] < min_x:
+            active_grid.remove(heapq.heappop(active_heap)[1])
+        for active_index in active_grid.overlapping(min_y, max_y):
+            # Both chains are sorted by x, so the segments of the active
+            # chain that overlap a segment of this chain in x form a window
+            # that only moves forward.
+            active_segments = chains[active_index][4]
+            start = 0
+            for segment in segments:
+                segment_min_x, segment_max_x = x_range(segment)
+                while (start < len(active_segments) and
+                        x_range(active_segments[start])[1] < segment_min_x):
+                    start += 1
+                j = start
+                while (j < len(active_segments) and
+                        x_range(active_segments[j])[0] <= segment_max_x):
+                    other = active_segments[j]
+                    j += 1
+                    if abs(other - segment) < 2:
+                        continue
+                    if y_overlaps(segment, other):
+                        candidates.append(
+                            (min(segment, other), max(segment, other)))
+        heapq.heappush(active_heap, (max_x, index))
+        active_grid.add(index, min_y, max_y)
+
+    candidates.sort()
+    return candidates
+
+
+def find_self_intersections(vertices):
+    """Return all self intersection points of a line given by its vertices.
+
+    Only the pairs of segments given by self_intersection_candidates are
+    compared.
+
+    As in the QGIS geometry validator, parallel segments are ignored and an
+    intersection must be strictly between the vertices of both segments
+    (see point_in_line).
+
+    :param vertices: The vertices of the line as (x, y) pairs.
+    :type vertices: list
+
+    :returns: List of (x, y) tuples of the intersection points, ordered by
+        the segments they belong to.
+    :rtype: list
+    """
+    self_intersections = []
+    xs = [vertex[0] for vertex in vertices]
+    ys = [vertex[1] for vertex in vertices]
+    for i, j in self_intersection_candidates(vertices):
+        v = (xs[i + 1] - xs[i], ys[i + 1] - ys[i])
+        w = (xs[j + 1] - xs[j], ys[j + 1] - ys[j])
+        d = v[1] * w[0] - v[0] * w[1]
+        if d == 0:
+            # Continue to the next part of line
+            continue
+
+        dx = xs[j] - xs[i]
+        dy = ys[j] - ys[i]
+
+        k = (dy * w[0] - dx * w[1]) / float(d)
+
+        intersection = xs[i] + v[0] * k, ys[i] + v[1] * k
+        if not point_in_line(intersection, vertices[i:i + 2]):
+            continue
+        if not point_in_line(intersection, vertices[j:j + 2]):
+            continue
+        self_intersections.append(intersection)
+
+    return self_intersections
+
+
+def segment_center(vertices):
+    """Return the point halfway along a line.
+
+    :param vertices: The vertices of the line as (x, y) pairs.
+    :type vertices: list
+
+    :returns: The (x, y) tuple of the center, None if there is no vertex.
+    :rtype: tuple, None
+    """
+    vertex_count = len(vertices)
+
+    if vertex_count < 1:
+        return None
+
+    part_lengths = []
+    for i in range(vertex_count - 1):
+        dx = vertices[i][0] - vertices[i + 1][0]
+        dy = vertices[i][1] - vertices[i + 1][1]
+        part_lengths.append(sqrt(dx * dx + dy * dy))
+
+    segment_count = len(part_lengths)
+    line_length = sum(part_lengths)
+    half_length = 0.5 * line_length
+
+    current_length = 0
+    i = 0
+    add_length = 0
+    while current_length <= half_length and i < segment_count:
+        add_length = part_lengths[i]
+        current_length += add_length
+        i += 1
+
+    current_length -= add_length
+    delta_length = half_length - current_length
+    i -= 1
+
+    if add_length > 0:
+        ratio = float(delta_length) / float(add_length)
+
+        center_x = vertices[i][0]
+        center_x += ratio * (vertices[i + 1][0] - vertices[i][0])
+
+        center_y = vertices[i][1]
+        center_y += ratio * (vertices[i + 1][1] - vertices[i][1])
+    else:
+        try:
+            center_x = vertices[i][0]
+            center_y = vertices[i][1]
+        except IndexError:
+            return None
+
+    return center_x, center_y
+
+
+def flatten_lines(lines):
+    """Return the vertices of lines stored one after the other.
+
+    :param lines: The vertices of every line as lists of (x, y) pairs.
+    :type lines: list
+
+    :returns: Tuple of the xs and ys arrays of all the vertices and the
+        offsets array: the vertices of line i are at the positions
+        offsets[i] to offsets[i + 1] (excluded).
+    :rtype: tuple
+    """
+    offsets = numpy.zeros(len(lines) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(vertices) for vertices in lines])
+    xs = numpy.fromiter(
+        (vertex[0] for vertices in lines for vertex in vertices),
+        dtype=numpy.float64, count=offsets[-1])
+    ys = numpy.fromiter(
+        (vertex[1] for vertices in lines for vertex in vertices),
+        dtype=numpy.float64, count=offsets[-1])
+    return xs, ys, offsets
+
+
+# WKB header of a line string: byte order, geometry type and vertex count
+LINE_WKB_HEADER = struct.Struct('<BII')
+
+
+def wkb_line_coordinates(wkb):
+    """Decode the coordinates of a WKB line string without creating points.
+
+    Only the little endian 2D line strings, by far the most common, are
+    decoded.
+
+    :param wkb: The WKB of a geometry.
+    :type wkb: str
+
+    :returns: Array of the x and y of every vertex, one after the other,
+        None if the WKB is not a little endian 2D line string.
+    :rtype: numpy.ndarray
+    """
+    if len(wkb) < LINE_WKB_HEADER.size:
+        return None
+    byte_order, geometry_type, count = LINE_WKB_HEADER.unpack_from(wkb)
+    if byte_order != 1 or geometry_type != 2:
+        return None
+    return numpy.frombuffer(
+        wkb, dtype='<f8', count=2 * count, offset=LINE_WKB_HEADER.size)
+
+
+class LineVertices(object):
+    """The vertices of lines stored one after the other, see flatten_lines.
+
+    The vertices are decoded once and shared by all the line based rules.
+    """
+
+    def __init__(self, xs, ys, offsets):
+        """Constructor.
+
+        :param xs: X coordinates of the vertices.
+        :type xs: numpy.ndarray
+
+        :param ys: Y coordinates of the vertices.
+        :type ys: numpy.ndarray
+
+        :param offsets: The vertices of line i are at the positions
+            offsets[i] to offsets[i + 1] (excluded).
+        :type offsets: numpy.ndarray
+        """
+        self.xs = xs
+        self.ys = ys
+        self.offsets = offsets
+
+    @classmethod
+    def from_coordinates(cls, coordinates):
+        """Create the vertices from the coordinates of every line.
+
+        :param coordinates: The coordinates of every line, as arrays of the
+            x and y of every vertex, see wkb_line_coordinates.
+        :type coordinates: list
+
+        :returns: The vertices.
+        :rtype: LineVertices
+        """
+        offsets = numpy.zeros(len(coordinates) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(
+            [len(line) // 2 for line in coordinates])
+        if offsets[-1]:
+            interleaved = numpy.concatenate(coordinates)
+        else:
+            interleaved = numpy.zeros(0, dtype=numpy.float64)
+        return cls(
+            numpy.array(interleaved[0::2], dtype=numpy.float64),
+            numpy.array(interleaved[1::2], dtype=numpy.float64),
+            offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self):
+        """Return the number of vertices of every line.
+
+        :returns: Integer array.
+        :rtype: numpy.ndarray
+        """
+        return numpy.diff(self.offsets)
+
+    def line(self, index):
+        """Return the vertices of a line.
+
+        :param index: The position of the line.
+        :type index: int
+
+        :returns: List of (x, y) pairs.
+        :rtype: list
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return zip(self.xs[start:end].tolist(), self.ys[start:end].tolist())
+
+    def lines(self):
+        """Generate the vertices of every line, see line.
+
+        :returns: Generator of lists of (x, y) pairs.
+        :rtype: generator
+        """
+        for index in range(len(self)):
+            yield self.line(index)
+
+    def wkb(self, index):
+        """Return a line as a WKB line string.
+
+        :param index: The position of the line.
+        :type index: int
+
+        :returns: The WKB, little endian.
+        :rtype: str
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        coordinates = numpy.empty(2 * (end - start), dtype='<f8')
+        coordinates[0::2] = self.xs[start:end]
+        coordinates[1::2] = self.ys[start:end]
+        return (
+            LINE_WKB_HEADER.pack(1, 2, end - start) +
+            coordinates.tostring())
+
+    def bounding_box(self, index):
+        """Return the bounding box of a line.
+
+        :param index: The position of the line, it must have vertices.
+        :type index: int
+
+        :returns: Tuple (x_min, y_min, x_max, y_max).
+        :rtype: tuple
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        xs = self.xs[start:end]
+        ys = self.ys[start:end]
+        return (
+            float(xs.min()), float(ys.min()),
+            float(xs.max()), float(ys.max()))
+
+    def end_points(self):
+        """Return the first and the last vertex of the lines with vertices.
+
+        :returns: Tuple of the boolean array of the lines with vertices and
+            the arrays of the x and y of their first and last vertices.
+        :rtype: tuple
+        """
+        has_vertices = self.counts() > 0
+        first = self.offsets[:-1][has_vertices]
+        last = self.offsets[1:][has_vertices] - 1
+        return (
+            has_vertices,
+            self.xs[first], self.ys[first], self.xs[last], self.ys[last])
+
+
+def _positions_along(line_xs, line_ys, fractions):
+    """Return the points at fractions of the length of lines.
+
+    All the lines have the same number of vertices, see line_positions.
+
+    :param line_xs: X coordinates, one row of vertices per line.
+    :type line_xs: numpy.ndarray
+
+    :param line_ys: Y coordinates, one row of vertices per line.
+    :type line_ys: numpy.ndarray
+
+    :param fractions: The fractions of the line length.
+    :type fractions: numpy.ndarray
+
+    :returns: Tuple of x and y arrays, one row per line and one column per
+        fraction.
+    :rtype: tuple
+    """
+    line_count, vertex_count = line_xs.shape
+    segment_count = vertex_count - 1
+    if segment_count == 0:
+        return (
+            numpy.repeat(line_xs, len(fractions), axis=1),
+            numpy.repeat(line_ys, len(fractions), axis=1))
+
+    # The same operations as segment_center, so the results are identical:
+    # the lengths are summed in order along every row.
+    dx = line_xs[:, :-1] - line_xs[:, 1:]
+    dy = line_ys[:, :-1] - line_ys[:, 1:]
+    part_lengths = numpy.sqrt(dx * dx + dy * dy)
+    cumulative = numpy.zeros((line_count, vertex_count))
+    cumulative[:, 1:] = numpy.cumsum(part_lengths, axis=1)
+    line_length = cumulative[:, -1]
+
+    rows = numpy.arange(line_count)
+    xs = numpy.empty((line_count, len(fractions)))
+    ys = numpy.empty((line_count, len(fractions)))
+    for column, fraction in enumerate(fractions):
+        target = fraction * line_length
+        # Binary search of the last segment starting at or before target,
+        # over all the lines at once
+        low = numpy.zeros(line_count, dtype=numpy.int64)
+        high = numpy.full(line_count, segment_count, dtype=numpy.int64)
+        while True:
+            active = high - low > 1
+            if not active.any():
+                break
+            middle = (low + high) // 2
+            before = cumulative[rows, middle] <= target
+            low = numpy.where(active & before, middle, low)
+            high = numpy.where(active & ~before, middle, high)
+
+        add_length = part_lengths[rows, low]
+        current_length = cumulative[rows, low + 1] - add_length
+        delta_length = target - current_length
+        start_x = line_xs[rows, low]
+        start_y = line_ys[rows, low]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratio = delta_length / add_length
+            xs[:, column] = numpy.where(
+                add_length > 0,
+                start_x + ratio * (line_xs[rows, low + 1] - start_x),
+                start_x)
+            ys[:, column] = numpy.where(
+                add_length > 0,
+                start_y + ratio * (line_ys[rows, low + 1] - start_y),
+                start_y)
+    return xs, ys
+
+
+def line_positions(xs, ys, offsets, fractions=(0.5,), cancel_token=None):
+    """Return the points at fractions of the length of every line.
+
+    The lines with the same number of vertices are computed together with
+    numpy: the cumulative lengths of their segments, then a binary search
+    of the segment holding every position. A fraction of 0.5 gives the
+    points of segment_center.
+
+    :param xs: X coordinates of the vertices, see flatten_lines.
+    :type xs: numpy.ndarray
+
+    :param ys: Y coordinates of the vertices.
+    :type ys: numpy.ndarray
+
+    :param offsets: The vertices of line i are at the positions offsets[i]
+        to offsets[i + 1] (excluded).
+    :type offsets: numpy.ndarray
+
+    :param fractions: The fractions of the line length, between 0 and 1,
+        e.g. [0.25, 0.5, 0.75]. Defaults to the center.
+    :type fractions: list
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :returns: Tuple of x and y arrays, one row per line and one column per
+        fraction. The rows of the lines without vertex are NaN.
+    :rtype: tuple
+    """
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    fractions = numpy.asarray(fractions, dtype=numpy.float64)
+
+    vertex_counts = numpy.diff(offsets)
+    shape = (len(vertex_counts), len(fractions))
+    position_xs = numpy.full(shape, numpy.nan)
+    position_ys = numpy.full(shape, numpy.nan)
+    for vertex_count in numpy.unique(vertex_counts):
+        if cancel_token is not None:
+            cancel_token.check()
+        if vertex_count == 0:
+            continue
+        lines = numpy.flatnonzero(vertex_counts == vertex_count)
+        indexes = offsets[lines, numpy.newaxis] + numpy.arange(vertex_count)
+        position_xs[lines], position_ys[lines] = _positions_along(
+            xs[indexes], ys[indexes], fractions)
+    return position_xs, position_ys
+
+
+def cluster_points(xs, ys, threshold):
+    """Group the points that are closer than threshold to each other.
+
+    Nearby points are found with a NodeGrid and merged with a disjoint set
+    (union find), so the clusters are transitive: a chain of points that
+    are each within threshold of the next one forms a single cluster.
+
+    :param xs: X coordinates of the points.
+    :type xs: list, numpy.ndarray
+
+    :param ys: Y coordinates of the points.
+    :type ys: list, numpy.ndarray
+
+    :param threshold: Distance threshold.
+    :type threshold: float
+
+    :returns: List holding for every point the index of the first point of
+        its cluster.
+    :rtype: list
+    """
+    grid = NodeGrid(xs, ys, threshold)
+    xs = grid.xs
+    ys = grid.ys
+    parents = list(range(len(xs)))
+
+    def find(index):
+        """Return the root of index, halving the path on the way."""
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for index in range(len(xs)):
+        for nearby_index in grid.nearby(xs[index], ys[index]):
+            if nearby_index <= index:
+                continue
+            root = find(index)
+            nearby_root = find(nearby_index)
+            # The lowest index is always the root of a cluster
+            if root < nearby_root:
+                parents[nearby_root] = root
+            elif nearby_root < root:
+                parents[root] = nearby_root
+
+    return [find(index) for index in range(len(xs))]
@@ -0,0 +1,477 @@
+# coding=utf-8
+"""
+Incremental feature extraction following the edits of the input layer.
+
+IncrementalExtractor runs the extraction once and keeps its state: the
+nodes, and the points found for every line and every pair of lines. It then
+listens to the edit signals of the input layer. On update, only the edited
+lines and the nodes and points within the threshold of them are computed
+again, and the output layer is patched: the features of the changed
+clusters are deleted and the new ones are added.
+
+The output holds the same points and types as identify_features run on the
+edited layer, when the new lines come last in the data provider. The id
+attribute of the new features continues after the highest id instead.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from PyQt4.QtCore import QObject, pyqtSignal
+
+from qgis.core import (
+    QgsFeature,
+    QgsGeometry,
+    QgsPoint,
+    QgsSpatialIndex)
+
+from stream_utilities import (
+    tr,
+    feature_request,
+    NODE_ATTRIBUTES,
+    NODE_RULES,
+    NodeGrid,
+    node_type_names,
+    find_self_intersections,
+    identify_segment_center,
+    line_end_points,
+    line_intersection_points,
+    create_features_layer,
+    create_output_feature)
+
+# The first item of the key of every point, the points are sorted by their
+# key in the same order as the output points of identify_features.
+NODE_POINT = 0
+SELF_INTERSECTION_POINT = 1
+SEGMENT_CENTER_POINT = 2
+INTERSECTION_POINT = 3
+
+
+class IncrementalExtractor(QObject):
+    """Keep the output of the extraction up to date with the input layer."""
+
+    # number of deleted and added output features
+    updated = pyqtSignal(int, int)
+
+    def __init__(self, input_layer, threshold=0, auto_update=True):
+        """Constructor, the extraction is run for the whole layer.
+
+        :param input_layer: A vector line layer.
+        :type input_layer: QgsVectorLayer
+
+        :param threshold: Distance threshold for node snapping. Defaults to 0.
+        :type threshold: float
+
+        :param auto_update: If True, update is called when the editing of
+            the layer stops. Defaults to True.
+        :type auto_update: bool
+        """
+        QObject.__init__(self)
+        self.layer = input_layer
+        self.threshold = threshold
+        self.auto_update = auto_update
+        self.output_layer = create_features_layer(
+            input_layer.crs().authid())
+        self.type_names = node_type_names()
+
+        # Lines: fid -> order in the data provider, geometry, end points and
+        # keys of their self intersections, segment center and intersections
+        self.orders = {}
+        self.fids = {}
+        self.next_order = 0
+        self.geometries = {}
+        self.endpoints = {}
+        self.line_points = {}
+        self.spatial_index = QgsSpatialIndex()
+        # Nodes, keyed by (order of the line, 0 upstream or 1 downstream)
+        self.nodes = NodeGrid.empty(threshold)
+        # Output points before merging, keyed by a sortable key
+        self.points = NodeGrid.empty(threshold)
+        self.point_types = {}
+        self.new_points = set()
+        # Clusters of output points: point key -> first key of its cluster,
+        # first key -> keys of the cluster and output feature id.
+        self.clusters = {}
+        self.cluster_members = {}
+        self.output_fids = {}
+        self.next_id = 1
+
+        self.pending = set()
+        self.layer.featureAdded.connect(self.feature_changed)
+        self.layer.featureDeleted.connect(self.feature_changed)
+        self.layer.geometryChanged.connect(self.geometry_changed)
+        self.layer.committedFeaturesAdded.connect(self.features_committed)
+        if auto_update:
+            self.layer.editingStopped.connect(self.update)
+
+        features = [
+            feature for feature in self.layer.getFeatures(
+                feature_request(self.layer, []))
+            if feature.geometry() is not None]
+        self.apply([feature.id() for feature in features], features)
+
+    def disconnect_layer(self):
+        """Stop following the edits of the input layer."""
+        self.layer.featureAdded.disconnect(self.feature_changed)
+        self.layer.featureDeleted.disconnect(self.feature_changed)
+        self.layer.geometryChanged.disconnect(self.geometry_changed)
+        self.layer.committedFeaturesAdded.disconnect(
+            self.features_committed)
+        if self.auto_update:
+            self.layer.editingStopped.disconnect(self.update)
+
+    def feature_changed(self, fid):
+        """Slot for the featureAdded and featureDeleted signals.
+
+        :param fid: The id of the feature.
+        :type fid: int
+        """
+        self.pending.add(fid)
+
+    def geometry_changed(self, fid, geometry):
+        """Slot for the geometryChanged signal.
+
+        :param fid: The id of the feature.
+        :type fid: int
+
+        :param geometry: The new geometry.
+        :type geometry: QgsGeometry
+        """
+        self.pending.add(fid)
+
+    def features_committed(self, layer_id, features):
+        """Slot for the committedFeaturesAdded signal.
+
+        The features added while editing get their final id when the edits
+        are committed.
+
+        :param layer_id: The id of the layer.
+        :type layer_id: str
+
+        :param features: The committed features.
+        :type features: list
+        """
+        self.pending.update(feature.id() for feature in features)
+
+    def update(self):
+        """Apply the pending edits of the input layer to the output layer.
+
+        :returns: Tuple of the number of deleted and added output features.
+        :rtype: tuple
+        """
+        # Lines added while editing have a temporary negative id that is
+        # gone once the edits are committed.
+        fids = self.pending | set(fid for fid in self.orders if fid < 0)
+        self.pending = set()
+        features = []
+        for fid in sorted(fids):
+            request = feature_request(self.layer, []).setFilterFid(fid)
+            for feature in self.layer.getFeatures(request):
+                if feature.geometry() is not None:
+                    features.append(feature)
+        return self.apply(fids, features)
+
+    def apply(self, fids, features):
+        """Compute again the output for changed lines.
+
+        :param fids: The ids of the added, changed and deleted lines.
+        :type fids: iterable
+
+        :param features: The current features of the lines that still
+            exist, the new lines in the order of the data provider.
+        :type features: list
+
+        :returns: Tuple of the number of deleted and added output features.
+        :rtype: tuple
+        """
+        removed_points = {}
+        node_seeds = []
+        changed = set(feature.id() for feature in features)
+        for fid in fids:
+            if fid in self.orders:
+                self.remove_line(fid, removed_points, node_seeds)
+                if fid not in changed:
+                    del self.orders[fid]
+        for feature in features:
+            self.add_line(feature, node_seeds)
+        for feature in features:
+            self.add_intersections(feature.id(), changed)
+
+        self.update_nodes(node_seeds, removed_points)
+
+        # Every cluster touching a removed or a new point is computed again
+        seeds = self.new_points
+        self.new_points = set()
+        for x, y in removed_points.values():
+            seeds.update(self.points.nearby(x, y))
+        keys = self.points.components(seeds)
+        return self.update_clusters(keys, removed_points)
+
+    def add_point(self, key, point, type_name, fid=None):
+        """Add an output point before merging.
+
+        :param key: Key of the point.
+        :type key: tuple
+
+        :param point: The point.
+        :type point: QgsPoint
+
+        :param type_name: The output type of the point.
+        :type type_name: str
+
+        :param fid: The line of the point.
+        :type fid: int
+        """
+        self.points.add(key, point.x(), point.y())
+        self.point_types[key] = (point, type_name)
+        self.new_points.add(key)
+        if fid is not None:
+            self.line_points[fid].add(key)
+
+    def remove_point(self, key, removed_points):
+        """Remove an output point before merging.
+
+        :param key: Key of the point.
+        :type key: tuple
+
+        :param removed_points: Dictionary the removed key is added to, with
+            the coordinates of the point.
+        :type removed_points: dict
+        """
+        removed_points[key] = self.points.remove(key)
+        del self.point_types[key]
+        self.new_points.discard(key)
+
+    def remove_line(self, fid, removed_points, node_seeds):
+        """Remove the nodes and points of a line.
+
+        :param fid: The id of the line.
+        :type fid: int
+
+        :param removed_points: See remove_point.
+        :type removed_points: dict
+
+        :param node_seeds: List the coordinates of the removed nodes are
+            added to.
+        :type node_seeds: list
+        """
+        order = self.orders[fid]
+        geometry = self.geometries.pop(fid)
+        del self.endpoints[fid]
+        feature = QgsFeature(fid)
+        feature.setGeometry(geometry)
+        self.spatial_index.deleteFeature(feature)
+
+        for key in self.line_points.pop(fid):
+            if key not in self.point_types:
+                continue
+            self.remove_point(key, removed_points)
+            if key[0] == INTERSECTION_POINT:
+                # Also forget it in the other line of the pair
+                other = key[2] if key[2] != fid else self.fids[key[1]]
+                self.line_points.get(other, set()).discard(key)
+
+        for end in [0, 1]:
+            node = (order, end)
+            if node in self.nodes:
+                node_seeds.append(self.nodes.remove(node))
+                self.remove_node_points(node, removed_points)
+
+    def add_line(self, feature, node_seeds):
+        """Add the nodes, self intersections and segment center of a line.
+
+        :param feature: The line.
+        :type feature: QgsFeature
+
+        :param node_seeds: List the coordinates of the new nodes are added
+            to.
+        :type node_seeds: list
+        """
+        fid = feature.id()
+        if fid not in self.orders:
+            self.orders[fid] = self.next_order
+            self.fids[self.next_order] = fid
+            self.next_order += 1
+        order = self.orders[fid]
+        geometry = QgsGeometry(feature.geometry())
+        self.geometries[fid] = geometry
+        self.endpoints[fid] = line_end_points(geometry)
+        self.spatial_index.insertFeature(feature)
+        self.line_points[fid] = set()
+
+        vertices = geometry.asPolyline()
+        if len(vertices) > 0:
+            for end, vertex in [(0, vertices[0]), (1, vertices[-1])]:
+                self.nodes.add((order, end), vertex.x(), vertex.y())
+                node_seeds.append((vertex.x(), vertex.y()))
+
+        self_intersections = find_self_intersections(
+            [(vertex.x(), vertex.y()) for vertex in vertices])
+        for i, (x, y) in enumerate(self_intersections):
+            self.add_point(
+                (SELF_INTERSECTION_POINT, order, i),
+                QgsPoint(x, y),
+                tr('Self Intersection'),
+                fid)
+
+        center = identify_segment_center(feature)
+        if center is not None:
+            self.add_point(
+                (SEGMENT_CENTER_POINT, order),
+                center,
+                tr('Segment Center'),
+                fid)
+
+    def add_intersections(self, fid, changed):
+        """Add the intersections of a line with all the other lines.
+
+        :param fid: The id of the line.
+        :type fid: int
+
+        :param changed: The ids of the changed lines, a pair of changed lines
+            is computed once from the line with the lowest id.
+        :type changed: set
+        """
+        geometry = self.geometries[fid]
+        candidates = self.spatial_index.intersects(geometry.boundingBox())
+        for other in candidates:
+            other = int(other)
+            if other == fid or (other in changed and other < fid):
+                continue
+            # As in identify_intersections, from the line with the lowest fid
+            first, second = sorted([fid, other])
+            points = line_intersection_points(
+                self.geometries[first],
+                self.geometries[second],
+                self.endpoints[first],
+                self.endpoints[second])
+            for i, point in enumerate(points):
+                key = (INTERSECTION_POINT, self.orders[first], second, i)
+                self.add_point(key, point, tr('Intersection'), first)
+                self.line_points[second].add(key)
+
+    def remove_node_points(self, node, removed_points):
+        """Remove the output points of a node.
+
+        :param node: The key of the node.
+        :type node: tuple
+
+        :param removed_points: See remove_point.
+        :type removed_points: dict
+        """
+        for type_index in range(len(NODE_ATTRIBUTES)):
+            key = (NODE_POINT, node[0], node[1], type_index)
+            if key in self.point_types:
+                self.remove_point(key, removed_points)
+
+    def update_nodes(self, node_seeds, removed_points):
+        """Classify again the nodes near the seeds.
+
+        The nodes are processed in order and the nearby nodes of a node are
+        not used anymore, as in create_output_points. That depends on the
+        order, so the whole clusters of nearby nodes are processed.
+
+        :param node_seeds: Coordinates of the removed and added nodes.
+        :type node_seeds: list
+
+        :param removed_points: See remove_point.
+        :type removed_points: dict
+        """
+        seeds = set()
+        for x, y in node_seeds:
+            seeds.update(self.nodes.nearby(x, y))
+        nodes = sorted(self.nodes.components(seeds))
+
+        expired_nodes = set()
+        for node in nodes:
+            self.remove_node_points(node, removed_points)
+            x, y = self.nodes[node]
+            nearby_nodes = [
+                key for key in self.nodes.nearby(x, y) if key != node]
+            if node in expired_nodes:
+                continue
+            expired_nodes.update(nearby_nodes)
+
+            # Upstream nodes are the start (0) of their line
+            up_num = sum(1 for key in nearby_nodes if key[1] == 0)
+            down_num = len(nearby_nodes) - up_num
+            if node[1] == 0:
+                up_num += 1
+            else:
+                down_num += 1
+            point = QgsPoint(x, y)
+            for type_index, attribute in enumerate(NODE_ATTRIBUTES):
+                if NODE_RULES[attribute](up_num, down_num):
+                    self.add_point(
+                        (NODE_POINT, node[0], node[1], type_index),
+                        point,
+                        self.type_names[type_index])
+
+    def update_clusters(self, keys, removed_points):
+        """Replace the output features of the clusters of keys.
+
+        :param keys: Keys of the points of whole clusters.
+        :type keys: set
+
+        :param removed_points: The points removed since the last update.
+        :type removed_points: dict
+
+        :returns: Tuple of the number of deleted and added output features.
+        :rtype: tuple
+        """
+        old_clusters = set()
+        for key in keys | set(removed_points):
+            if key in self.clusters:
+                old_clusters.add(self.clusters[key])
+        deleted_fids = []
+        for first_key in old_clusters:
+            deleted_fids.append(self.output_fids.pop(first_key))
+            for key in self.cluster_members.pop(first_key):
+                del self.clusters[key]
+
+        new_features = []
+        first_keys = []
+        remaining = set(keys)
+        for key in sorted(keys):
+            if key not in remaining:
+                continue
+            members = sorted(self.points.components([key]))
+            remaining.difference_update(members)
+            for member in members:
+                self.clusters[member] = key
+            self.cluster_members[key] = members
+            # The self intersections and the intersections are deduplicated
+            # before the points are merged, see deduplicate_points.
+            seen = set()
+            count = 0
+            for member in members:
+                if member[0] in [SELF_INTERSECTION_POINT, INTERSECTION_POINT]:
+                    coordinates = (member[0], self.points[member])
+                    if coordinates in seen:
+                        continue
+                    seen.add(coordinates)
+                count += 1
+            point, type_name = self.point_types[key]
+            if count > 1:
+                type_name = tr('Unseparated')
+            new_features.append(
+                create_output_feature(self.next_id, point, type_name))
+            first_keys.append(key)
+            self.next_id += 1
+
+        data_provider = self.output_layer.dataProvider()
+        if deleted_fids:
+            data_provider.deleteFeatures(deleted_fids)
+        if new_features:
+            _, new_features = data_provider.addFeatures(new_features)
+            for key, feature in zip(first_keys, new_features):
+                self.output_fids[key] = feature.id()
+        self.output_layer.updateExtents()
+        self.updated.emit(len(deleted_fids), len(new_features))
+        return len(deleted_fids), len(new_features)
@@ -0,0 +1,576 @@
+# coding=utf-8
+"""
+The stream network of a line layer, built once per extraction.
+
+Reading the lines is the slowest part of small extractions and building the
+spatial index is not much cheaper, so StreamNetwork reads the layer in a
+single pass and keeps everything the feature rules need:
+
+* the vertices of every line, decoded once into a LineVertices buffer
+  shared by the line based rules, and their end points,
+* the nodes (see NodeArrays) and, once associated, their nearby nodes and
+  node types (see AssociatedNodes),
+* the line to node incidence: line i of the network has the upstream node
+  2 * i and the downstream node 2 * i + 1,
+* a spatial index of the lines and a cache of their geometries, rebuilt
+  from the vertices when they are needed.
+
+The rules are then queries on the network::
+
+    network = StreamNetwork(layer)
+    nodes = network.associate(threshold)
+    intersections = network.intersections()
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy
+
+from PyQt4.QtCore import QCoreApplication
+
+from qgis.core import (
+    QGis,
+    QgsFeature,
+    QgsGeometry,
+    QgsPoint,
+    QgsFeatureRequest,
+    QgsSpatialIndex)
+
+from stream_geometry import (
+    NodeArrays,
+    AssociatedNodes,
+    LineVertices,
+    associate_nodes,
+    classify_nodes,
+    deduplicate_points,
+    find_self_intersections,
+    line_positions,
+    wkb_line_coordinates)
+from stream_report import report_stage
+
+
+def feature_request(layer, attributes=None, geometry=True):
+    """Return a request reading only what a pass over a layer needs.
+
+    Reading fewer attributes and no geometry saves their decoding, most of
+    the cost of reading a file based layer.
+
+    :param layer: A vector layer or its data provider.
+    :type layer: QgsVectorLayer, QgsVectorDataProvider
+
+    :param attributes: The names of the attributes to read, an empty list
+        for none of them. If None, all the attributes are read. The other
+        attributes are NULL in the features.
+    :type attributes: list
+
+    :param geometry: Whether the geometry is read. Defaults to True.
+    :type geometry: bool
+
+    :returns: The request.
+    :rtype: QgsFeatureRequest
+    """
+    request = QgsFeatureRequest()
+    if not geometry:
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+    if attributes is not None:
+        # setSubsetOfAttributes adds its flag, so it comes after setFlags
+        request.setSubsetOfAttributes(
+            [layer.fieldNameIndex(attribute) for attribute in attributes])
+    return request
+
+
+class GeometryCache(object):
+    """Least recently used cache of the geometries of a layer keyed by fid.
+
+    The cache holds at most max_bytes of geometry (measured by the WKB size).
+    When it is full the least recently used geometries are evicted and
+    fetched again if they are needed later, see fetch.
+    """
+
+    def __init__(self, data_provider, max_bytes=256 * 1024 * 1024):
+        """Constructor.
+
+        :param data_provider: The data provider of the layer.
+        :type data_provider: QgsVectorDataProvider
+
+        :param max_bytes: Maximum size of the cached geometries in bytes.
+            Defaults to 256 MB.
+        :type max_bytes: int
+        """
+        self.data_provider = data_provider
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.geometries = OrderedDict()
+
+    def add(self, fid, geometry):
+        """Add a geometry to the cache, evicting old ones if it is full.
+
+        :param fid: The feature id.
+        :type fid: int
+
+        :param geometry: The geometry of the feature.
+        :type geometry: QgsGeometry
+        """
+        if fid in self.geometries:
+            self.size -= self.geometries.pop(fid).wkbSize()
+        self.geometries[fid] = geometry
+        self.size += geometry.wkbSize()
+        while self.size > self.max_bytes and len(self.geometries) > 1:
+            _, evicted_geometry = self.geometries.popitem(last=False)
+            self.size -= evicted_geometry.wkbSize()
+
+    def get(self, fid):
+        """Return the geometry of a feature, fetching it if not cached.
+
+        :param fid: The feature id.
+        :type fid: int
+
+        :returns: The geometry of the feature.
+        :rtype: QgsGeometry
+        """
+        geometry = self.geometries.pop(fid, None)
+        if geometry is not None:
+            self.hits += 1
+            # Mark it as the most recently used
+            self.geometries[fid] = geometry
+            return geometry
+
+        self.misses += 1
+        geometry = self.fetch(fid)
+        self.add(fid, geometry)
+        return geometry
+
+    def fetch(self, fid):
+        """Read the geometry of a feature from the data provider.
+
+        :param fid: The feature id.
+        :type fid: int
+
+        :returns: The geometry of the feature.
+        :rtype: QgsGeometry
+        """
+        feature = QgsFeature()
+        request = feature_request(self.data_provider, [])
+        self.data_provider.getFeatures(
+            request.setFilterFid(fid)).nextFeature(feature)
+        return QgsGeometry(feature.geometry())
+
+
+class NetworkGeometryCache(GeometryCache):
+    """GeometryCache rebuilding the geometries from the network vertices.
+
+    The layer is not read again, see StreamNetwork.geometry.
+    """
+
+    def __init__(self, network, max_bytes=256 * 1024 * 1024):
+        """Constructor.
+
+        :param network: The network of the lines.
+        :type network: StreamNetwork
+
+        :param max_bytes: Maximum size of the cached geometries in bytes.
+            Defaults to 256 MB.
+        :type max_bytes: int
+        """
+        super(NetworkGeometryCache, self).__init__(None, max_bytes)
+        self.network = network
+
+    def fetch(self, fid):
+        """Rebuild the geometry of a line from its vertices.
+
+        :param fid: The feature id.
+        :type fid: int
+
+        :returns: The geometry of the line.
+        :rtype: QgsGeometry
+        """
+        return self.network.geometry(fid)
+
+
+def line_end_points(geometry):
+    """Return the first and the last vertex of a line geometry.
+
+    :param geometry: A line geometry.
+    :type geometry: QgsGeometry
+
+    :returns: List of the two end points, empty if the geometry is not a
+        single line.
+    :rtype: list
+    """
+    vertices = geometry.asPolyline()
+    if len(vertices) > 1:
+        return [vertices[0], vertices[-1]]
+    return []
+
+
+def line_intersection_points(geometry, geometry_2, endpoints, endpoints_2):
+    """Return the intersection points of two lines.
+
+    A point is an intersection unless it is an end point of both lines.
+
+    :param geometry: The first line.
+    :type geometry: QgsGeometry
+
+    :param geometry_2: The second line.
+    :type geometry_2: QgsGeometry
+
+    :param endpoints: End points of the first line, see line_end_points.
+    :type endpoints: list
+
+    :param endpoints_2: End points of the second line.
+    :type endpoints_2: list
+
+    :returns: List of QgsPoint.
+    :rtype: list
+    """
+    intersections = []
+    if geometry.intersects(geometry_2):
+        temp_geom = geometry.intersection(geometry_2)
+        if temp_geom.type() == QGis.Point:
+            temp_list = []
+            if temp_geom.isMultipart():
+                temp_list = temp_geom.asMultiPoint()
+            else:
+                temp_list.append(temp_geom.asPoint())
+            for point in temp_list:
+                if point in endpoints and point in endpoints_2:
+                    continue
+                intersections.append(point)
+    return intersections
+
+
+class StreamNetwork(object):
+    """The lines, nodes and spatial index of a vector line layer.
+
+    Lines without geometry are skipped. Lines that are not a single line
+    (e.g. multi lines) have no vertices and no nodes but are still tested
+    for intersections, as in the layer based functions of stream_utilities.
+    """
+
+    def __init__(self, layer, cancel_token=None, report=None):
+        """Constructor, reading the layer.
+
+        :param layer: A vector line layer.
+        :type layer: QgsVectorLayer
+
+        :param cancel_token: Optional token checked while reading, to stop
+            it when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :param report: Optional run report, the read_lines stage is
+            recorded in it.
+        :type report: RunReport
+        """
+        self.authority_id = layer.crs().authid()
+        data_provider = layer.dataProvider()
+        self.geometries = NetworkGeometryCache(self)
+        self.line_index = QgsSpatialIndex()
+        # The fid of every line in the order of the data provider, its
+        # position in that order and the geometry of the lines that are not
+        # a line of two vertices or more (e.g. multi lines).
+        self.fids = []
+        self.positions = {}
+        self.other_geometries = {}
+        self.associated_nodes = None
+
+        coordinates = []
+        with report_stage(report, 'read_lines') as stage:
+            request = feature_request(data_provider, [])
+            for feature in data_provider.getFeatures(request):
+                if cancel_token is not None:
+                    cancel_token.check()
+                geometry = feature.geometry()
+                if geometry is None:
+                    continue
+                fid = feature.id()
+                line_coordinates = wkb_line_coordinates(geometry.asWkb())
+                if line_coordinates is None:
+                    line_coordinates = numpy.array(
+                        [coordinate for point in geometry.asPolyline()
+                         for coordinate in (point.x(), point.y())],
+                        dtype=numpy.float64)
+                if len(line_coordinates) < 4:
+                    self.other_geometries[fid] = QgsGeometry(geometry)
+                self.line_index.insertFeature(feature)
+                self.positions[fid] = len(self.fids)
+                self.fids.append(fid)
+                coordinates.append(line_coordinates)
+            self.vertices = LineVertices.from_coordinates(coordinates)
+            stage.count('lines', len(self.fids))
+            stage.count('vertices', len(self.vertices.xs))
+
+        has_vertices, start_x, start_y, end_x, end_y = (
+            self.vertices.end_points())
+        line_ids = numpy.array(self.fids, dtype=numpy.int64)[has_vertices]
+        # Position of the lines with nodes in the node arrays
+        self.node_positions = dict(
+            (fid, position)
+            for position, fid in enumerate(line_ids.tolist()))
+        self.nodes = NodeArrays(line_ids, start_x, start_y, end_x, end_y)
+
+        # The end points of the lines of two vertices or more
+        self.endpoints = dict((fid, []) for fid in self.fids)
+        is_line = self.vertices.counts()[has_vertices] > 1
+        for fid, x, y, x_2, y_2 in zip(
+                line_ids[is_line].tolist(),
+                start_x[is_line].tolist(),
+                start_y[is_line].tolist(),
+                end_x[is_line].tolist(),
+                end_y[is_line].tolist()):
+            self.endpoints[fid] = [QgsPoint(x, y), QgsPoint(x_2, y_2)]
+
+    def __len__(self):
+        return len(self.fids)
+
+    def geometry(self, fid):
+        """Return the geometry of a line, rebuilt from its vertices.
+
+        Prefer geometries.get, which caches the geometry.
+
+        :param fid: The feature id of the line.
+        :type fid: int
+
+        :returns: The geometry of the line.
+        :rtype: QgsGeometry
+        """
+        geometry = self.other_geometries.get(fid)
+        if geometry is None:
+            geometry = QgsGeometry()
+            geometry.fromWkb(self.vertices.wkb(self.positions[fid]))
+        return geometry
+
+    def line_nodes(self, fid):
+        """Return the upstream and downstream node of a line.
+
+        :param fid: The feature id of the line.
+        :type fid: int
+
+        :returns: Tuple of the two node indexes, None if the line has no
+            nodes.
+        :rtype: tuple, None
+        """
+        position = self.node_positions.get(fid)
+        if position is None:
+            return None
+        return 2 * position, 2 * position + 1
+
+    def node_line(self, node):
+        """Return the line of a node.
+
+        :param node: The node index.
+        :type node: int
+
+        :returns: The feature id of the line.
+        :rtype: int
+        """
+        return int(self.nodes.line_ids[node // 2])
+
+    def lines_in(self, rectangle):
+        """Return the lines with a bounding box intersecting a rectangle.
+
+        :param rectangle: The rectangle.
+        :type rectangle: QgsRectangle
+
+        :returns: Sorted list of feature ids.
+        :rtype: list
+        """
+        return sorted(int(x) for x in self.line_index.intersects(rectangle))
+
+    def associate(
+            self,
+            threshold=0,
+            callback=None,
+            cancel_token=None,
+            report=None,
+            associate=None):
+        """Find the nearby nodes and the type of every node.
+
+        :param threshold: Distance threshold for node snapping. Defaults
+            to 0.
+        :type threshold: float
+
+        :param callback: A function to all to indicate progress. The
+            function should accept params 'current' (int) and 'maximum'
+            (int). Defaults to None.
+        :type callback: function
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :param report: Optional run report, the associate_nodes and
+            rule_<attribute> stages are recorded in it.
+        :type report: RunReport
+
+        :param associate: Function used instead of associate_nodes, with the
+            same arguments and result, e.g. to run it in several processes.
+        :type associate: function
+
+        :returns: The nodes with their nearby nodes and node types, also
+            kept in associated_nodes.
+        :rtype: AssociatedNodes
+        """
+        _, xs, ys, upstream = self.nodes.endpoints()
+        if associate is None:
+            associate = associate_nodes
+        with report_stage(report, 'associate_nodes') as stage:
+            up_nodes, down_nodes, up_num, down_num = associate(
+                xs, ys, upstream, threshold, callback, cancel_token)
+            stage.count('nodes', len(xs))
+            # Every node is counted once in its own up_num or down_num
+            stage.count(
+                'nearby_nodes', int(up_num.sum() + down_num.sum()) - len(xs))
+        if callback is not None:
+            # noinspection PyTypeChecker,PyArgumentList,PyCallByClass
+            message = QCoreApplication.translate(
+                '@default', 'Classifying nodes...')
+            callback(current=1, maximum=1, message=message)
+        flags = classify_nodes(up_num, down_num, report)
+        self.associated_nodes = AssociatedNodes(
+            self.nodes, up_nodes, down_nodes, up_num, down_num, flags)
+        return self.associated_nodes
+
+    def nearby_nodes(self, node):
+        """Return the nearby nodes of a node, see associate.
+
+        :param node: The node index.
+        :type node: int
+
+        :returns: Sorted list of node indexes, without the node itself.
+        :rtype: list
+        """
+        nodes = self.associated_nodes
+        return sorted(
+            nodes.up_nodes[node].tolist() + nodes.down_nodes[node].tolist())
+
+    def self_intersections(self, precision=0, cancel_token=None):
+        """Return all self intersection points of the lines.
+
+        :param precision: Points closer than precision are considered
+            duplicates, see deduplicate_points. Defaults to 0.
+        :type precision: float
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :returns: List of QgsPoint.
+        :rtype: list
+        """
+        points = []
+        for vertices in self.vertices.lines():
+            if cancel_token is not None:
+                cancel_token.check()
+            points.extend(
+                QgsPoint(intersection[0], intersection[1])
+                for intersection in find_self_intersections(vertices))
+        return deduplicate_points(points, precision)
+
+    def segment_points(self, fractions, cancel_token=None):
+        """Return the points at fractions of the length of every line.
+
+        All the fractions are computed in one pass, see line_positions.
+
+        :param fractions: The fractions of the line length, between 0 and
+            1, e.g. [0.25, 0.5, 0.75].
+        :type fractions: list
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :returns: One list of QgsPoint per fraction, holding the point of
+            every line with vertices in the order of the lines.
+        :rtype: list
+        """
+        position_xs, position_ys = line_positions(
+            self.vertices.xs,
+            self.vertices.ys,
+            self.vertices.offsets,
+            fractions,
+            cancel_token)
+        has_vertices = self.vertices.counts() > 0
+        position_xs = position_xs[has_vertices]
+        position_ys = position_ys[has_vertices]
+        return [
+            [QgsPoint(x, y) for x, y in zip(
+                position_xs[:, column].tolist(),
+                position_ys[:, column].tolist())]
+            for column in range(len(fractions))]
+
+    def segment_centers(self, cancel_token=None):
+        """Return the linear segment center of every line.
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :returns: List of QgsPoint.
+        :rtype: list
+        """
+        return self.segment_points([0.5], cancel_token)[0]
+
+    def intersections(self, statistics=None, precision=0, cancel_token=None):
+        """Return all intersection points between the lines.
+
+        Every pair of lines with overlapping bounding boxes is tested only
+        once, from the line with the lower fid.
+
+        :param statistics: Optional dictionary that will be populated with
+            the number of pairs pruned by their bounding box (pruned_pairs),
+            the number of pairs tested exactly (tested_pairs) and the
+            geometry cache hits and misses (cache_hits, cache_misses), a
+            miss rebuilds the geometry from the vertices.
+        :type statistics: dict
+
+        :param precision: Points closer than precision are considered
+            duplicates, see deduplicate_points. Defaults to 0.
+        :type precision: float
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :returns: List of QgsPoint.
+        :rtype: list
+        """
+        intersections = []
+        hits = self.geometries.hits
+        misses = self.geometries.misses
+        tested_pairs = 0
+        for fid in self.fids:
+            if cancel_token is not None:
+                cancel_token.check()
+            geometry = self.geometries.get(fid)
+            for line_id in self.lines_in(geometry.boundingBox()):
+                if line_id <= fid:
+                    continue
+                geometry_2 = self.geometries.get(line_id)
+                tested_pairs += 1
+                intersections.extend(line_intersection_points(
+                    geometry,
+                    geometry_2,
+                    self.endpoints[fid],
+                    self.endpoints[line_id]))
+
+        if statistics is not None:
+            line_count = len(self.fids)
+            statistics['pruned_pairs'] = (
+                line_count * (line_count - 1) // 2 - tested_pairs)
+            statistics['tested_pairs'] = tested_pairs
+            statistics['cache_hits'] = self.geometries.hits - hits
+            statistics['cache_misses'] = self.geometries.misses - misses
+
+        return deduplicate_points(intersections, precision)
@@ -56,6 +56,12 @@ class OptionsDialog(QtGui.QDialog, FORM_CLASS):
                 False,
                 type=bool)
         )
+        self.use_result_cache.setChecked(
+            settings.value(
+                'stream-feature-extractor/result-cache',
+                False,
+                type=bool)
+        )
         self.sentry_logging.setChecked(
             settings.value(
                 'stream-feature-extractor/sentry-logging',
@@ -74,6 +80,10 @@ class OptionsDialog(QtGui.QDialog, FORM_CLASS):
             'stream-feature-extractor/load-intermediate-layer',
             self.show_intermediate_layer.isChecked()
         )
+        settings.setValue(
+            'stream-feature-extractor/result-cache',
+            self.use_result_cache.isChecked()
+        )
         settings.setValue(
             'stream-feature-extractor/sentry-logging',
             self.sentry_logging.isChecked()
@@ -0,0 +1,213 @@
+# coding=utf-8
+"""
+Output sinks receiving the point features of the extraction.
+
+The nodes and the identified features are handed to a sink in chunks while
+they are created. The default MemorySink builds a memory layer, a FileSink
+streams them to a GeoPackage, Shapefile etc. so that large networks are not
+held in memory twice::
+
+    sink = FileSink('features.gpkg', 'GPKG')
+    intermediate_layer, output_layer = identify_features(
+        layer, threshold, callback, output_sink=sink)
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.core import (
+    QGis,
+    QgsFields,
+    QgsMapLayer,
+    QgsVectorLayer,
+    QgsVectorFileWriter,
+    QgsCoordinateReferenceSystem)
+
+# Number of features buffered before they are written
+CHUNK_SIZE = 10000
+
+
+def is_line_layer(layer):
+    """Check if a QGIS layer is vector and its geometries are lines.
+
+    :param layer: A vector layer.
+    :type layer: QgsVectorLayer, QgsMapLayer
+
+    :returns: True if the layer contains lines, otherwise False.
+    :rtype: bool
+    """
+    try:
+        return (layer.type() == QgsMapLayer.VectorLayer) and (
+            layer.geometryType() == QGis.Line)
+    except AttributeError:
+        return False
+
+
+class OutputError(Exception):
+    """Raised when the features can not be written to a sink."""
+    pass
+
+
+class MemorySink(object):
+    """Sink building a memory layer, buffering the features in chunks.
+
+    A sink is opened once with the schema of the layer, receives the
+    features with add_feature or add_features and gives the resulting layer
+    when it is closed. Other sinks, like FileSink, keep the buffering and
+    replace open, write and layer.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        """Constructor.
+
+        :param chunk_size: Number of features buffered before they are
+            written.
+        :type chunk_size: int
+        """
+        self.chunk_size = chunk_size
+        self.name = None
+        self.buffer = []
+        self.count = 0
+        self.memory_layer = None
+
+    def open(self, name, authority_id, fields):
+        """Prepare the sink for the point features of a layer.
+
+        :param name: The name of the layer.
+        :type name: str
+
+        :param authority_id: The authority id of the layer crs.
+        :type authority_id: str
+
+        :param fields: The attributes of the features.
+        :type fields: list of QgsField
+        """
+        self.name = name
+        self.memory_layer = QgsVectorLayer(
+            'Point?crs=%s&index=yes' % authority_id, name, 'memory')
+        self.memory_layer.startEditing()
+        self.memory_layer.dataProvider().addAttributes(fields)
+        self.memory_layer.commitChanges()
+
+    def write(self, features):
+        """Write a chunk of features.
+
+        :param features: The features.
+        :type features: list of QgsFeature
+        """
+        self.memory_layer.dataProvider().addFeatures(features)
+
+    def layer(self):
+        """Return the layer of the written features, called by close.
+
+        :returns: The layer.
+        :rtype: QgsVectorLayer
+        """
+        self.memory_layer.updateExtents()
+        return self.memory_layer
+
+    def add_feature(self, feature):
+        """Add a feature, the chunk is written when it is full.
+
+        :param feature: A point feature with the attributes of the sink.
+        :type feature: QgsFeature
+        """
+        self.buffer.append(feature)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def add_features(self, features):
+        """Add several features.
+
+        :param features: Point features, can be a generator.
+        :type features: iterable
+        """
+        for feature in features:
+            self.add_feature(feature)
+
+    def flush(self):
+        """Write the buffered features."""
+        if self.buffer:
+            self.write(self.buffer)
+            self.count += len(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        """Write the remaining features and return the layer.
+
+        :returns: The layer holding all the features.
+        :rtype: QgsVectorLayer
+        """
+        self.flush()
+        return self.layer()
+
+
+class FileSink(MemorySink):
+    """Sink streaming the features to a file with a QgsVectorFileWriter.
+
+    The features are consumed as they are added, e.g. from a generator, so
+    only a chunk of them is held in memory, see create_output_layer.
+    """
+
+    def __init__(self, path, driver='ESRI Shapefile', chunk_size=CHUNK_SIZE):
+        """Constructor.
+
+        :param path: The output file, overwritten if it exists.
+        :type path: str
+
+        :param driver: The OGR driver name, e.g. 'GPKG'. Defaults to
+            'ESRI Shapefile'.
+        :type driver: str
+
+        :param chunk_size: Number of features buffered before they are
+            written.
+        :type chunk_size: int
+        """
+        super(FileSink, self).__init__(chunk_size)
+        self.path = path
+        self.driver = driver
+        self.writer = None
+
+    def open(self, name, authority_id, fields):
+        """Create the file, see MemorySink.open.
+
+        :raises: OutputError if the file can not be created.
+        """
+        self.name = name
+        qgs_fields = QgsFields()
+        for field in fields:
+            qgs_fields.append(field)
+        self.writer = QgsVectorFileWriter(
+            self.path,
+            'UTF-8',
+            qgs_fields,
+            QGis.WKBPoint,
+            QgsCoordinateReferenceSystem(authority_id),
+            self.driver)
+        if self.writer.hasError() != QgsVectorFileWriter.NoError:
+            message = self.writer.errorMessage()
+            self.writer = None
+            raise OutputError(
+                'Failed to create %s: %s' % (self.path, message))
+
+    def write(self, features):
+        """Write the features to the file, see MemorySink.write.
+
+        :raises: OutputError if a feature can not be written.
+        """
+        for feature in features:
+            if not self.writer.addFeature(feature):
+                raise OutputError('Failed to write to %s: %s' % (
+                    self.path, self.writer.errorMessage()))
+
+    def layer(self):
+        """Close the file and open it as a layer, see MemorySink.layer."""
+        # The file is completed when the writer is deleted
+        self.writer = None
+        return QgsVectorLayer(self.path, self.name, 'ogr')
@@ -0,0 +1,599 @@
+# coding=utf-8
+"""
+Spatially tiled feature extraction running in several processes.
+
+identify_features_parallel gives the same result as identify_features, but
+the node association, the self intersections and the intersections are
+computed in a process pool:
+
+* The nodes are split by a grid of tiles. Every tile also gets the nodes of
+  a halo a little wider than the threshold around it, so the nearby nodes
+  of the nodes it owns are complete.
+* The lines are split in chunks for the self intersections, they only
+  depend on a single line.
+* Every line is sent to the tiles its bounding box overlaps. A pair of
+  lines is tested by the tile that contains the lower left corner of the
+  overlap of their bounding boxes, so it is tested only once.
+
+The results are merged back in the order of the serial run. The processes
+are forked, so QGIS does not need to be initialised in them. On Windows
+this only works from a script, e.g. the command line extractor.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from functools import partial
+from math import ceil, sqrt
+from multiprocessing import Pool, cpu_count
+
+import numpy
+
+from qgis.core import QgsGeometry, QgsPoint
+
+from stream_geometry import (
+    Adjacency,
+    associate_nodes,
+    find_self_intersections,
+    deduplicate_points)
+from stream_network import StreamNetwork
+from stream_utilities import (
+    tr,
+    create_associated_nodes_layer,
+    line_end_points,
+    line_intersection_points,
+    create_output_layer)
+from stream_report import report_stage
+
+# Number of tiles per process, more tiles balance the work better
+TILES_PER_PROCESS = 4
+
+
+class TileGrid(object):
+    """Regular grid of tiles covering an extent.
+
+    The tiles are numbered row by row. Points on the border of the extent
+    belong to the tiles at the border, so every point has a tile.
+    """
+
+    def __init__(self, x_min, y_min, x_max, y_max, tile_count):
+        """Constructor.
+
+        :param x_min: Minimum x of the extent.
+        :type x_min: float
+
+        :param y_min: Minimum y of the extent.
+        :type y_min: float
+
+        :param x_max: Maximum x of the extent.
+        :type x_max: float
+
+        :param y_max: Maximum y of the extent.
+        :type y_max: float
+
+        :param tile_count: Minimum number of tiles.
+        :type tile_count: int
+        """
+        self.columns = max(1, int(ceil(sqrt(tile_count))))
+        self.rows = self.columns
+        self.x_min = float(x_min)
+        self.y_min = float(y_min)
+        self.width = (x_max - x_min) / self.columns or 1.0
+        self.height = (y_max - y_min) / self.rows or 1.0
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def column(self, x):
+        """Return the column of x.
+
+        :param x: X coordinate or array of x coordinates.
+        :type x: float, numpy.ndarray
+
+        :returns: The column or array of columns.
+        :rtype: int, numpy.ndarray
+        """
+        column = numpy.floor((numpy.asarray(x) - self.x_min) / self.width)
+        return numpy.clip(column, 0, self.columns - 1).astype(int)
+
+    def row(self, y):
+        """Return the row of y.
+
+        :param y: Y coordinate or array of y coordinates.
+        :type y: float, numpy.ndarray
+
+        :returns: The row or array of rows.
+        :rtype: int, numpy.ndarray
+        """
+        row = numpy.floor((numpy.asarray(y) - self.y_min) / self.height)
+        return numpy.clip(row, 0, self.rows - 1).astype(int)
+
+    def tile(self, x, y):
+        """Return the tile a point belongs to.
+
+        :param x: X coordinate or array of x coordinates.
+        :type x: float, numpy.ndarray
+
+        :param y: Y coordinate or array of y coordinates.
+        :type y: float, numpy.ndarray
+
+        :returns: The tile or array of tiles.
+        :rtype: int, numpy.ndarray
+        """
+        return self.row(y) * self.columns + self.column(x)
+
+    def members(self, x_min, y_min, x_max, y_max):
+        """Return the rectangles overlapping every tile.
+
+        :param x_min: Minimum x of every rectangle.
+        :type x_min: numpy.ndarray
+
+        :param y_min: Minimum y of every rectangle.
+        :type y_min: numpy.ndarray
+
+        :param x_max: Maximum x of every rectangle.
+        :type x_max: numpy.ndarray
+
+        :param y_max: Maximum y of every rectangle.
+        :type y_max: numpy.ndarray
+
+        :returns: List of (tile, indices) tuples, indices is the sorted array
+            of the rectangles overlapping the tile. Empty tiles are left out.
+        :rtype: list
+        """
+        first_column = self.column(x_min)
+        last_column = self.column(x_max)
+        first_row = self.row(y_min)
+        last_row = self.row(y_max)
+        members = []
+        for tile in range(len(self)):
+            row, column = divmod(tile, self.columns)
+            indices = numpy.nonzero(
+                (first_column <= column) & (column <= last_column) &
+                (first_row <= row) & (row <= last_row))[0]
+            if len(indices):
+                members.append((tile, indices))
+        return members
+
+
+def _associate_tile(task):
+    """Associate the nodes of a tile, run in a worker process.
+
+    :param task: Tuple of the node indices, xs, ys, upstream, a mask of the
+        nodes owned by the tile and the threshold.
+    :type task: tuple
+
+    :returns: Tuple of the indices of the owned nodes, the number and the
+        concatenated indices of their nearby upstream nodes, the same for
+        the downstream nodes, and their up_num and down_num.
+    :rtype: tuple
+    """
+    indices, xs, ys, upstream, owned, threshold = task
+    up_nodes, down_nodes, up_num, down_num = associate_nodes(
+        xs, ys, upstream, threshold)
+    result = [indices[owned]]
+    for adjacency in [up_nodes, down_nodes]:
+        # indices is sorted, so the nearby nodes stay sorted
+        result.append(adjacency.counts()[owned])
+        result.append(indices[adjacency.neighbours[owned[adjacency.rows()]]])
+    return tuple(result) + (up_num[owned], down_num[owned])
+
+
+def _place_neighbours(offsets, neighbours, indices, counts, tile_neighbours):
+    """Copy the nearby nodes found by a tile into a global Adjacency.
+
+    :param offsets: The offsets of the global Adjacency.
+    :type offsets: numpy.ndarray
+
+    :param neighbours: The neighbours array of the global Adjacency.
+    :type neighbours: numpy.ndarray
+
+    :param indices: The nodes owned by the tile.
+    :type indices: numpy.ndarray
+
+    :param counts: The number of nearby nodes of every owned node.
+    :type counts: numpy.ndarray
+
+    :param tile_neighbours: The concatenated nearby nodes.
+    :type tile_neighbours: numpy.ndarray
+    """
+    tile_offsets = numpy.cumsum(counts) - counts
+    positions = numpy.repeat(offsets[indices] - tile_offsets, counts)
+    positions += numpy.arange(len(tile_neighbours))
+    neighbours[positions] = tile_neighbours
+
+
+def associate_nodes_parallel(
+        pool,
+        tile_count,
+        xs,
+        ys,
+        upstream,
+        threshold,
+        callback=None,
+        cancel_token=None):
+    """Same as associate_nodes, with the nodes split in tiles.
+
+    :param pool: The process pool.
+    :type pool: multiprocessing.Pool
+
+    :param tile_count: Minimum number of tiles.
+    :type tile_count: int
+
+    :param xs: X coordinates of the nodes.
+    :type xs: list, numpy.ndarray
+
+    :param ys: Y coordinates of the nodes.
+    :type ys: list, numpy.ndarray
+
+    :param upstream: True for an upstream node, False for a downstream node.
+    :type upstream: list, numpy.ndarray
+
+    :param threshold: Distance threshold.
+    :type threshold: float
+
+    :param callback: A function to all to indicate progress. The function
+        should accept params 'current' (int) and 'maximum' (int). Defaults to
+        None.
+    :type callback: function
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :returns: See associate_nodes.
+    :rtype: tuple
+    """
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    upstream = numpy.asarray(upstream, dtype=bool)
+    node_count = len(xs)
+    if node_count == 0:
+        return associate_nodes(xs, ys, upstream, threshold)
+
+    grid = TileGrid(xs.min(), ys.min(), xs.max(), ys.max(), tile_count)
+    owner = grid.tile(xs, ys)
+    # The halo is a little wider than the threshold so that rounding can not
+    # leave out a nearby node. Extra nodes in the halo are harmless.
+    margin = threshold + 1e-9 * max(
+        abs(xs).max(), abs(ys).max(), threshold)
+    tasks = []
+    for tile, indices in grid.members(
+            xs - margin, ys - margin, xs + margin, ys + margin):
+        tasks.append((
+            indices,
+            xs[indices],
+            ys[indices],
+            upstream[indices],
+            owner[indices] == tile,
+            threshold))
+
+    up_num = numpy.zeros(node_count, dtype=numpy.int32)
+    down_num = numpy.zeros(node_count, dtype=numpy.int32)
+    results = []
+    for current, result in enumerate(
+            pool.imap_unordered(_associate_tile, tasks), 1):
+        if cancel_token is not None:
+            cancel_token.check()
+        if callback is not None:
+            callback(current=current, maximum=len(tasks))
+        results.append(result)
+        up_num[result[0]] = result[5]
+        down_num[result[0]] = result[6]
+
+    # The counts give the offsets, then the tiles fill their rows
+    adjacencies = []
+    for position in [1, 3]:
+        counts = numpy.zeros(node_count, dtype=numpy.int64)
+        for result in results:
+            counts[result[0]] = result[position]
+        offsets = numpy.zeros(node_count + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(counts)
+        neighbours = numpy.zeros(offsets[-1], dtype=numpy.int64)
+        for result in results:
+            _place_neighbours(
+                offsets,
+                neighbours,
+                result[0],
+                result[position],
+                result[position + 1])
+        adjacencies.append(Adjacency(offsets, neighbours))
+
+    return adjacencies[0], adjacencies[1], up_num, down_num
+
+
+def read_lines(network):
+    """Return the lines of a network in a form that can be sent to processes.
+
+    :param network: The network of a vector line layer.
+    :type network: StreamNetwork
+
+    :returns: Tuple of the list of line vertices, as lists of (x, y), and
+        the list of (fid, wkb, bounding box) of every line. The bounding box
+        is a (x_min, y_min, x_max, y_max) tuple. Both are in the order of
+        the data provider.
+    :rtype: tuple
+    """
+    vertices = network.vertices
+    lines = []
+    for position, fid in enumerate(network.fids):
+        geometry = network.other_geometries.get(fid)
+        if geometry is None:
+            # Straight from the shared vertices, no geometry is built
+            lines.append((
+                fid, vertices.wkb(position), vertices.bounding_box(position)))
+            continue
+        box = geometry.boundingBox()
+        lines.append((
+            fid,
+            geometry.asWkb(),
+            (box.xMinimum(), box.yMinimum(),
+             box.xMaximum(), box.yMaximum())))
+    return list(vertices.lines()), lines
+
+
+def _self_intersections_chunk(lines):
+    """Find the self intersections of a chunk of lines.
+
+    :param lines: List of line vertices.
+    :type lines: list
+
+    :returns: List of (x, y) self intersection points of all the lines.
+    :rtype: list
+    """
+    points = []
+    for vertices in lines:
+        points.extend(find_self_intersections(vertices))
+    return points
+
+
+def self_intersections_parallel(
+        pool, vertices, chunk_count, cancel_token=None):
+    """Same as identify_self_intersections_layer, for lines in chunks.
+
+    :param pool: The process pool.
+    :type pool: multiprocessing.Pool
+
+    :param vertices: List of line vertices, see read_lines.
+    :type vertices: list
+
+    :param chunk_count: Number of chunks.
+    :type chunk_count: int
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :returns: List of QgsPoint.
+    :rtype: list
+    """
+    size = max(1, int(ceil(len(vertices) / float(chunk_count))))
+    chunks = [
+        vertices[start:start + size]
+        for start in range(0, len(vertices), size)]
+    self_intersections = []
+    for points in pool.imap(_self_intersections_chunk, chunks):
+        if cancel_token is not None:
+            cancel_token.check()
+        self_intersections.extend(QgsPoint(x, y) for x, y in points)
+    return deduplicate_points(self_intersections)
+
+
+def _intersections_tile(task):
+    """Find the intersections of the line pairs owned by a tile.
+
+    :param task: Tuple of the tile, the TileGrid and the list of (order,
+        fid, wkb, bounding box) of the lines overlapping the tile.
+    :type task: tuple
+
+    :returns: List of (order of the line with the lowest fid, fid of the
+        other line, list of (x, y) points) of the pairs that intersect.
+    :rtype: list
+    """
+    tile, grid, lines = task
+    geometries = {}
+
+    def get_geometry(line):
+        """Return the geometry and end points of a line."""
+        fid = line[1]
+        if fid not in geometries:
+            geometry = QgsGeometry()
+            geometry.fromWkb(line[2])
+            geometries[fid] = geometry, line_end_points(geometry)
+        return geometries[fid]
+
+    results = []
+    active_lines = []
+    for line in sorted(lines, key=lambda x: x[3][0]):
+        x_min, y_min, x_max, y_max = line[3]
+        active_lines = [
+            active for active in active_lines if active[3][2] >= x_min]
+        for other in active_lines:
+            other_box = other[3]
+            if other_box[1] > y_max or other_box[3] < y_min:
+                continue
+            corner_x = max(x_min, other_box[0])
+            corner_y = max(y_min, other_box[1])
+            if grid.tile(corner_x, corner_y) != tile:
+                continue
+            # As in identify_intersections, from the line with the lowest fid
+            first, second = sorted([line, other], key=lambda x: x[1])
+            geometry, endpoints = get_geometry(first)
+            geometry_2, endpoints_2 = get_geometry(second)
+            points = line_intersection_points(
+                geometry, geometry_2, endpoints, endpoints_2)
+            if points:
+                results.append((
+                    first[0],
+                    second[1],
+                    [(point.x(), point.y()) for point in points]))
+        active_lines.append(line)
+    return results
+
+
+def intersections_parallel(pool, lines, tile_count, cancel_token=None):
+    """Same as identify_intersections, with the lines split in tiles.
+
+    :param pool: The process pool.
+    :type pool: multiprocessing.Pool
+
+    :param lines: List of (fid, wkb, bounding box), see read_lines.
+    :type lines: list
+
+    :param tile_count: Minimum number of tiles.
+    :type tile_count: int
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :returns: List of QgsPoint.
+    :rtype: list
+    """
+    if not lines:
+        return []
+    boxes = numpy.array([line[2] for line in lines], dtype=numpy.float64)
+    grid = TileGrid(
+        boxes[:, 0].min(), boxes[:, 1].min(),
+        boxes[:, 2].max(), boxes[:, 3].max(),
+        tile_count)
+    tasks = []
+    for tile, indices in grid.members(
+            boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]):
+        tile_lines = [(int(order),) + lines[order] for order in indices]
+        tasks.append((tile, grid, tile_lines))
+
+    pairs = []
+    for results in pool.imap_unordered(_intersections_tile, tasks):
+        if cancel_token is not None:
+            cancel_token.check()
+        pairs.extend(results)
+    # The order of identify_intersections: by the line with the lowest fid
+    # in the order of the data provider, then by the fid of the other line.
+    pairs.sort(key=lambda pair: pair[:2])
+    intersections = []
+    for _, _, points in pairs:
+        intersections.extend(QgsPoint(x, y) for x, y in points)
+    return deduplicate_points(intersections)
+
+
+def identify_features_parallel(
+        input_layer,
+        threshold=0,
+        processes=None,
+        callback=None,
+        cancel_token=None,
+        report=None,
+        intermediate_sink=None,
+        output_sink=None,
+        create_intermediate=True):
+    """Same as identify_features, running in several processes.
+
+    :param input_layer: A vector line layer.
+    :type input_layer: QGISVectorLayer
+
+    :param threshold: Distance threshold for node snapping. Defaults to 0.
+    :type threshold: float
+
+    :param processes: Number of processes. Defaults to the number of CPUs.
+    :type processes: int
+
+    :param callback: A function to all to indicate progress. The function
+        should accept params 'current' (int) and 'maximum' (int). Defaults to
+        None.
+    :type callback: function
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :param report: Optional run report, see identify_features.
+    :type report: RunReport
+
+    :param intermediate_sink: Optional sink receiving the nodes of the
+        intermediate layer, see identify_features.
+    :type intermediate_sink: MemorySink, FileSink
+
+    :param output_sink: Optional sink receiving the identified features,
+        see identify_features.
+    :type output_sink: MemorySink, FileSink
+
+    :param create_intermediate: If False, the intermediate layer is not
+        created and None is returned instead. Defaults to True.
+    :type create_intermediate: bool
+
+    :raises: ExtractionCancelled if cancel_token is cancelled.
+
+    :returns: A tuple of an intermediate layer that contains nodes and Map
+        layer (memory layer) containing identified features.
+    :rtype: tuple
+    """
+    if processes is None:
+        processes = cpu_count()
+    tile_count = processes * TILES_PER_PROCESS
+    authority_id = input_layer.crs().authid()
+
+    def progress(index, message):
+        """Report the progress of the steps after the intermediate layer."""
+        if callback is not None:
+            callback(current=index, maximum=4, message=message)
+
+    pool = Pool(processes)
+    try:
+        network = StreamNetwork(input_layer, cancel_token, report)
+        nodes = network.associate(
+            threshold,
+            callback,
+            cancel_token,
+            report,
+            associate=partial(associate_nodes_parallel, pool, tile_count))
+
+        with report_stage(report, 'pack_lines') as stage:
+            vertices, lines = read_lines(network)
+            stage.count('lines', len(lines))
+
+        progress(1, tr('Finding self intersections...'))
+        with report_stage(report, 'self_intersections') as stage:
+            self_intersections = self_intersections_parallel(
+                pool, vertices, tile_count, cancel_token)
+            stage.count('points', len(self_intersections))
+
+        progress(2, tr('Finding segment centers...'))
+        with report_stage(report, 'segment_centers') as stage:
+            segment_centers = network.segment_centers(cancel_token)
+            stage.count('points', len(segment_centers))
+
+        progress(3, tr('Finding intersections...'))
+        with report_stage(report, 'intersections') as stage:
+            intersections = intersections_parallel(
+                pool, lines, tile_count, cancel_token)
+            stage.count('points', len(intersections))
+        del lines
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if cancel_token is not None:
+        cancel_token.check()
+    intermediate_layer = None
+    if create_intermediate:
+        intermediate_layer = create_associated_nodes_layer(
+            authority_id, nodes, intermediate_sink, report)
+    progress(4, tr('Finding Unseparated...'))
+    output_layer = create_output_layer(
+        authority_id,
+        nodes,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold,
+        report,
+        output_sink)
+
+    return intermediate_layer, output_layer
@@ -0,0 +1,258 @@
+# coding=utf-8
+"""
+Run report recording the cost of every stage of the feature extraction.
+
+Usage::
+
+    report = RunReport()
+    intermediate_layer, output_layer = identify_features(
+        layer, threshold, callback, report=report)
+    report.log()
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import sys
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+# The resource module is not available on Windows, the peak memory is not
+# reported there.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Resident memory of the process, only available on Linux
+STATM_PATH = '/proc/self/statm'
+
+LOGGER = logging.getLogger('QGIS')
+
+
+def cpu_time():
+    """Return the CPU time (user and system) used by this process.
+
+    :returns: CPU time in seconds.
+    :rtype: float
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def process_peak_memory():
+    """Return the peak resident memory of this process since it started.
+
+    This is the peak of the whole process, not of a stage: it only grows,
+    and it includes everything the process did before the extraction.
+
+    :returns: Peak memory in KiB, or None if it is not available.
+    :rtype: int, None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Mac OS X reports bytes, Linux KiB
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def current_memory():
+    """Return the current resident memory of this process.
+
+    :returns: Resident memory in KiB, or None if it is not available.
+    :rtype: int, None
+    """
+    try:
+        with open(STATM_PATH) as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return resident_pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+
+class StageReport(object):
+    """Cost of a single stage: wall and CPU time, memory and counts.
+
+    peak_memory is the per stage peak: how far the stage raised the peak
+    resident memory of the process, so it includes the memory allocated and
+    freed again within the stage. It is 0 when the stage stayed below the
+    peak reached before it.
+    memory_delta is the change of the resident memory of the process over
+    the stage, negative if the stage freed more memory than it allocated.
+    process_peak_memory is the peak of the process when the stage ended.
+    """
+
+    def __init__(self, name):
+        """Constructor.
+
+        :param name: Name of the stage.
+        :type name: str
+        """
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = None
+        self.memory_delta = None
+        self.process_peak_memory = None
+        self.counts = OrderedDict()
+
+    def count(self, name, value):
+        """Record the number of items handled by the stage.
+
+        :param name: Name of the counter, e.g. 'nodes'.
+        :type name: str
+
+        :param value: The number of items.
+        :type value: int
+        """
+        self.counts[name] = value
+
+    def as_dict(self):
+        """Return the stage as a dictionary, e.g. to write it as JSON.
+
+        :returns: Dictionary with the name, wall_time, cpu_time,
+            peak_memory, memory_delta, process_peak_memory and counts of
+            the stage.
+        :rtype: dict
+        """
+        return {
+            'name': self.name,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_memory': self.peak_memory,
+            'memory_delta': self.memory_delta,
+            'process_peak_memory': self.process_peak_memory,
+            'counts': dict(self.counts)}
+
+    def __str__(self):
+        text = '%s: %.3f s wall, %.3f s CPU' % (
+            self.name, self.wall_time, self.cpu_time)
+        if self.peak_memory is not None:
+            text += ', peak memory +%i KiB' % self.peak_memory
+        if self.memory_delta is not None:
+            text += ', memory %+i KiB' % self.memory_delta
+        if self.process_peak_memory is not None:
+            text += ', process peak memory %i KiB' % self.process_peak_memory
+        for name, value in self.counts.items():
+            text += ', %s %s' % (name, value)
+        return text
+
+
+class NullStage(object):
+    """Stage used when no report is requested, it records nothing."""
+
+    def count(self, name, value):
+        """Ignore the counter.
+
+        :param name: Name of the counter.
+        :type name: str
+
+        :param value: The number of items.
+        :type value: int
+        """
+        pass
+
+
+class RunReport(object):
+    """Report of a run, the list of its stages in the order they ran."""
+
+    def __init__(self):
+        """Constructor."""
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager measuring the code run in a stage.
+
+        :param name: Name of the stage.
+        :type name: str
+
+        :returns: The StageReport, to record counts.
+        :rtype: StageReport
+        """
+        stage = StageReport(name)
+        self.stages.append(stage)
+        wall_start = default_timer()
+        cpu_start = cpu_time()
+        memory_start = current_memory()
+        peak_start = process_peak_memory()
+        try:
+            yield stage
+        finally:
+            stage.wall_time = default_timer() - wall_start
+            stage.cpu_time = cpu_time() - cpu_start
+            memory_end = current_memory()
+            if memory_start is not None and memory_end is not None:
+                stage.memory_delta = memory_end - memory_start
+            stage.process_peak_memory = process_peak_memory()
+            if peak_start is not None:
+                stage.peak_memory = max(
+                    0, stage.process_peak_memory - peak_start)
+
+    def get(self, name):
+        """Return the first stage with that name.
+
+        :param name: Name of the stage.
+        :type name: str
+
+        :returns: The stage or None if there is no such stage.
+        :rtype: StageReport, None
+        """
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def as_dict(self):
+        """Return the report as a dictionary, e.g. to write it as JSON.
+
+        :returns: Dictionary with the list of stages.
+        :rtype: dict
+        """
+        return {'stages': [stage.as_dict() for stage in self.stages]}
+
+    def log(self, logger=None, level=logging.INFO):
+        """Write one line per stage to a logger.
+
+        :param logger: The logger, the 'QGIS' logger (see
+            custom_logging.setup_logger) if None.
+        :type logger: logging.Logger
+
+        :param level: Logging level of the lines. Defaults to INFO.
+        :type level: int
+        """
+        if logger is None:
+            logger = LOGGER
+        for stage in self.stages:
+            logger.log(level, 'Stage %s', stage)
+
+
+@contextmanager
+def report_stage(report, name):
+    """Measure a stage in report, do nothing if report is None.
+
+    :param report: The report of the run or None.
+    :type report: RunReport, None
+
+    :param name: Name of the stage.
+    :type name: str
+
+    :returns: The stage, to record counts.
+    :rtype: StageReport, NullStage
+    """
+    if report is None:
+        yield NullStage()
+    else:
+        with report.stage(name) as stage:
+            yield stage
@@ -0,0 +1,346 @@
+# coding=utf-8
+"""
+SQLite store of the intermediate nodes, for networks with many nodes.
+
+By default the nodes with their nearby nodes and node types are kept in
+arrays and, if asked for, in a memory layer. A NodeStore keeps them in a
+SQLite file instead and the extraction runs against it in batches, so only
+a batch of nodes is held in memory at a time::
+
+    store = NodeStore('nodes.sqlite')
+    intermediate_layer, output_layer = identify_features(
+        layer, threshold, callback, intermediate_store=store)
+    store.close()
+
+Only the nodes and their attributes are kept on disk. The vertices of the
+lines are still read into memory (see StreamNetwork), as the self
+intersections, segment centers and intersections are found from them.
+
+The file has a nodes table, indexed by an R-tree, and a nearby_nodes table
+holding the nearby nodes of every node. The nodes table is registered in
+the OGR flavour of geometry_columns, so it can be opened as a layer.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import struct
+import sqlite3
+from tempfile import mkstemp
+
+from qgis.core import QgsVectorLayer, QgsCoordinateReferenceSystem
+
+from stream_geometry import NODE_ATTRIBUTES, classify_nodes
+
+# Number of nodes read or written at once
+BATCH_SIZE = 10000
+
+# WKB of a 2D point, little endian
+POINT_WKB = struct.Struct('<BIdd')
+
+SCHEMA = [
+    'CREATE TABLE nodes ('
+    'id INTEGER PRIMARY KEY, line_id INTEGER, node_type TEXT, '
+    'x REAL, y REAL, up_num INTEGER, down_num INTEGER, %s, '
+    'geometry BLOB)' % ', '.join(
+        '%s INTEGER' % attribute for attribute in NODE_ATTRIBUTES),
+    'CREATE TABLE nearby_nodes ('
+    'node INTEGER, nearby INTEGER, upstream INTEGER)',
+    'CREATE VIRTUAL TABLE nodes_index USING rtree('
+    'id, min_x, max_x, min_y, max_y)',
+    'CREATE TABLE geometry_columns ('
+    'f_table_name TEXT, f_geometry_column TEXT, geometry_type INTEGER, '
+    'coord_dimension INTEGER, srid INTEGER, geometry_format TEXT)',
+    'CREATE TABLE spatial_ref_sys ('
+    'srid INTEGER UNIQUE, auth_name TEXT, auth_srid INTEGER, srtext TEXT)']
+
+
+class NodeStore(object):
+    """SQLite file holding the nodes, their nearby nodes and node types.
+
+    Node i is the node with id i of the intermediate layer, see
+    NodeArrays.endpoints.
+    """
+
+    def __init__(self, path=None, batch_size=BATCH_SIZE):
+        """Constructor.
+
+        :param path: The SQLite file, overwritten if it exists. If None, a
+            temporary file is used and removed by close.
+        :type path: str
+
+        :param batch_size: Number of nodes read or written at once.
+        :type batch_size: int
+        """
+        self.temporary = path is None
+        if self.temporary:
+            handle, path = mkstemp(prefix='nodes_', suffix='.sqlite')
+            os.close(handle)
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.batch_size = batch_size
+        self.node_count = 0
+        self.connection = sqlite3.connect(path)
+        # The file is rebuilt from scratch if anything goes wrong
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def batches(self):
+        """Generate the id ranges of the batches of nodes.
+
+        :returns: Generator of (first id, last id + 1) tuples.
+        :rtype: generator
+        """
+        for start in range(0, self.node_count, self.batch_size):
+            yield start, min(start + self.batch_size, self.node_count)
+
+    def add_nodes(self, authority_id, nodes, cancel_token=None):
+        """Write the nodes of the lines.
+
+        :param authority_id: The authority id of the crs of the nodes.
+        :type authority_id: str
+
+        :param nodes: The end points of the lines.
+        :type nodes: NodeArrays
+
+        :param cancel_token: Optional token checked while writing, to stop
+            it when it is cancelled.
+        :type cancel_token: CancellationToken
+        """
+        line_ids, xs, ys, upstream = nodes.endpoints()
+        self.node_count = len(xs)
+        srid = self.add_crs(authority_id)
+        self.connection.execute(
+            'INSERT INTO geometry_columns VALUES (?, ?, ?, ?, ?, ?)',
+            ('nodes', 'geometry', 1, 2, srid, 'WKB'))
+
+        for start, end in self.batches():
+            if cancel_token is not None:
+                cancel_token.check()
+            rows = zip(
+                range(start, end),
+                line_ids[start:end].tolist(),
+                upstream[start:end].tolist(),
+                xs[start:end].tolist(),
+                ys[start:end].tolist())
+            self.connection.executemany(
+                'INSERT INTO nodes (id, line_id, node_type, x, y, geometry) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(node, line_id, 'upstream' if is_upstream else 'downstream',
+                  x, y, buffer(POINT_WKB.pack(1, 1, x, y)))
+                 for node, line_id, is_upstream, x, y in rows])
+            self.connection.executemany(
+                'INSERT INTO nodes_index VALUES (?, ?, ?, ?, ?)',
+                [(node, x, x, y, y) for node, _, _, x, y in rows])
+            self.connection.commit()
+        self.connection.execute(
+            'CREATE INDEX nearby_nodes_node ON nearby_nodes (node)')
+
+    def add_crs(self, authority_id):
+        """Register a crs in spatial_ref_sys.
+
+        :param authority_id: The authority id of the crs, e.g. 'EPSG:4326'.
+        :type authority_id: str
+
+        :returns: The srid of the crs, -1 if it has no numeric code.
+        :rtype: int
+        """
+        auth_name, _, code = authority_id.partition(':')
+        try:
+            srid = int(code)
+        except ValueError:
+            return -1
+        # noinspection PyArgumentList
+        srtext = QgsCoordinateReferenceSystem(authority_id).toWkt()
+        self.connection.execute(
+            'INSERT INTO spatial_ref_sys VALUES (?, ?, ?, ?)',
+            (srid, auth_name, srid, srtext))
+        return srid
+
+    def nearby(self, x, y, threshold):
+        """Return the nodes within threshold of a location.
+
+        As in NodeGrid.nearby, a node is nearby when it falls inside the
+        square of 2 * threshold centred on the location.
+
+        :param x: X coordinate.
+        :type x: float
+
+        :param y: Y coordinate.
+        :type y: float
+
+        :param threshold: Distance threshold.
+        :type threshold: float
+
+        :returns: List of (node, upstream) tuples, sorted by node.
+        :rtype: list
+        """
+        # The R-tree holds single precision boxes rounded outwards, the
+        # coordinates of the nodes decide.
+        return self.connection.execute(
+            "SELECT nodes.id, nodes.node_type = 'upstream' "
+            'FROM nodes_index JOIN nodes ON nodes.id = nodes_index.id '
+            'WHERE nodes_index.min_x <= ? AND nodes_index.max_x >= ? '
+            'AND nodes_index.min_y <= ? AND nodes_index.max_y >= ? '
+            'AND abs(nodes.x - ?) <= ? AND abs(nodes.y - ?) <= ? '
+            'ORDER BY nodes.id',
+            (x + threshold, x - threshold, y + threshold, y - threshold,
+             x, threshold, y, threshold)).fetchall()
+
+    def associate(self, threshold, callback=None, cancel_token=None):
+        """Find the nearby nodes of every node with the R-tree.
+
+        The nearby_nodes table and the up_num and down_num of the nodes
+        are filled, as associate_nodes does.
+
+        :param threshold: Distance threshold.
+        :type threshold: float
+
+        :param callback: A function to all to indicate progress. The
+            function should accept params 'current' (int) and 'maximum'
+            (int). Defaults to None.
+        :type callback: function
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :returns: The number of nearby nodes.
+        :rtype: int
+        """
+        nearby_count = 0
+        for start, end in self.batches():
+            if cancel_token is not None:
+                cancel_token.check()
+            nearby_rows = []
+            counts = []
+            for node, node_type, x, y in self.connection.execute(
+                    'SELECT id, node_type, x, y FROM nodes '
+                    'WHERE id >= ? AND id < ? ORDER BY id',
+                    (start, end)).fetchall():
+                up_num = 0
+                down_num = 0
+                for nearby, upstream in self.nearby(x, y, threshold):
+                    if upstream:
+                        up_num += 1
+                    else:
+                        down_num += 1
+                    if nearby != node:
+                        nearby_rows.append((node, nearby, upstream))
+                counts.append((up_num, down_num, node))
+            self.connection.executemany(
+                'INSERT INTO nearby_nodes VALUES (?, ?, ?)', nearby_rows)
+            self.connection.executemany(
+                'UPDATE nodes SET up_num = ?, down_num = ? WHERE id = ?',
+                counts)
+            self.connection.commit()
+            nearby_count += len(nearby_rows)
+            if callback is not None:
+                callback(current=end, maximum=self.node_count)
+        return nearby_count
+
+    def classify(self, cancel_token=None):
+        """Compute the node type flags of every node, see classify_nodes.
+
+        :param cancel_token: Optional token checked while running, to stop
+            the computation when it is cancelled.
+        :type cancel_token: CancellationToken
+
+        :returns: Dictionary of node type attribute to the number of nodes
+            of that type.
+        :rtype: dict
+        """
+        totals = dict((attribute, 0) for attribute in NODE_ATTRIBUTES)
+        statement = 'UPDATE nodes SET %s WHERE id = ?' % ', '.join(
+            '%s = ?' % attribute for attribute in NODE_ATTRIBUTES)
+        for start, end in self.batches():
+            if cancel_token is not None:
+                cancel_token.check()
+            up_num, down_num = zip(*self.connection.execute(
+                'SELECT up_num, down_num FROM nodes '
+                'WHERE id >= ? AND id < ? ORDER BY id',
+                (start, end)).fetchall())
+            flags = classify_nodes(up_num, down_num)
+            columns = []
+            for attribute in NODE_ATTRIBUTES:
+                totals[attribute] += int(flags[attribute].sum())
+                columns.append(flags[attribute].tolist())
+            columns.append(range(start, end))
+            self.connection.executemany(statement, zip(*columns))
+            self.connection.commit()
+        return totals
+
+    def neighbours(self, node):
+        """Return the nearby nodes of a node, see associate.
+
+        :param node: The node id.
+        :type node: int
+
+        :returns: Sorted list of node ids, without the node itself.
+        :rtype: list
+        """
+        return [row[0] for row in self.connection.execute(
+            'SELECT nearby FROM nearby_nodes WHERE node = ? ORDER BY nearby',
+            (node,))]
+
+    def typed_nodes(self):
+        """Generate the typed nodes, one for every group of nearby nodes.
+
+        The nodes are visited in order, as AssociatedNodes.representatives
+        does. Only the nearby nodes of a batch and the nearby nodes not
+        visited yet are held in memory.
+
+        :returns: Generator of (x, y, type index) tuples, the type index is
+            the position of the type in NODE_ATTRIBUTES.
+        :rtype: generator
+        """
+        expired = set()
+        for start, end in self.batches():
+            nearby_nodes = {}
+            for node, nearby in self.connection.execute(
+                    'SELECT node, nearby FROM nearby_nodes '
+                    'WHERE node >= ? AND node < ?', (start, end)):
+                nearby_nodes.setdefault(node, []).append(nearby)
+            for row in self.connection.execute(
+                    'SELECT id, x, y, %s FROM nodes '
+                    'WHERE id >= ? AND id < ? ORDER BY id' % ', '.join(
+                        NODE_ATTRIBUTES), (start, end)):
+                node = row[0]
+                if node in expired:
+                    expired.discard(node)
+                    continue
+                expired.update(
+                    nearby for nearby in nearby_nodes.get(node, [])
+                    if nearby > node)
+                for type_index, flag in enumerate(row[3:]):
+                    if flag == 1:
+                        yield row[1], row[2], type_index
+
+    def layer(self, name):
+        """Return the nodes table as a layer.
+
+        :param name: The name of the layer.
+        :type name: str
+
+        :returns: A point layer.
+        :rtype: QgsVectorLayer
+        """
+        self.connection.commit()
+        return QgsVectorLayer('%s|layername=nodes' % self.path, name, 'ogr')
+
+    def close(self):
+        """Close the file, removing it if it is temporary."""
+        self.connection.commit()
+        self.connection.close()
+        if self.temporary:
+            os.remove(self.path)
@@ -14,22 +14,58 @@ __license__ = "GPL"
 __copyright__ = ''
 
 
-from math import sqrt
+from array import array
+
+import numpy
 
 from PyQt4.QtCore import QVariant, QCoreApplication
 
 from qgis.core import (
-    QGis,
     QgsField,
-    QgsVectorLayer,
     QgsFeature,
     QgsGeometry,
     QgsPoint,
-    QgsMapLayer,
     QgsRectangle,
-    QgsFeatureRequest,
     QgsSpatialIndex)
 
+from stream_report import report_stage
+from stream_output import MemorySink
+from stream_store import NodeStore
+# The QGIS independent algorithms, imported here as they are part of the
+# interface of this module.
+# pylint: disable=W0611
+from stream_geometry import (
+    ExtractionCancelled,
+    CancellationToken,
+    list_to_str,
+    str_to_list,
+    to_list,
+    NodeArrays,
+    NodeGrid,
+    Adjacency,
+    associate_nodes,
+    NODE_ATTRIBUTES,
+    NODE_RULES,
+    classify_nodes,
+    AssociatedNodes,
+    between,
+    point_in_line,
+    deduplicate_points,
+    monotone_chains,
+    find_self_intersections,
+    segment_center,
+    flatten_lines,
+    line_positions,
+    cluster_points)
+from stream_network import (
+    feature_request,
+    GeometryCache,
+    line_end_points,
+    line_intersection_points,
+    StreamNetwork)
+from stream_output import is_line_layer
+# pylint: enable=W0611
+
 
 def tr(message):
     """Get the translation for a string using Qt translation API.
@@ -46,51 +82,6 @@ def tr(message):
     return QCoreApplication.translate('@default', message)
 
 
-def list_to_str(the_list, sep=','):
-    """Convert a list to str. If empty, return empty string.
-
-    :param the_list: A list.
-    :type the_list: list
-
-    :param sep: Separator for each element in the result.
-    :type sep: str
-
-    :returns: String represent the_list.
-    :rtype: str
-    """
-    if len(the_list) > 0:
-        return sep.join([str(x) for x in the_list])
-    else:
-        return ''
-
-
-def str_to_list(the_str, sep=',', the_type=None):
-    """Convert the_str to list.
-
-    :param the_str: String represents a list.
-    :type the_str: str
-
-    :param sep: Separator for each element in the_str.
-    :type sep: str
-
-    :param the_type: Type of the element.
-    :type the_type: type
-
-    :returns: List from the_str.
-    :rtype: list
-    """
-    if len(the_str) == 0:
-        return []
-    the_list = the_str.split(sep)
-    if the_type is None:
-        return the_list
-    else:
-        try:
-            return [the_type(x) for x in the_list]
-        except TypeError:
-            raise TypeError('%s is not valid type' % the_type)
-
-
 def add_layer_attribute(layer, attribute_name, qvariant):
     """Add new attribute called attribute_name to layer.
 
@@ -112,7 +103,30 @@ def add_layer_attribute(layer, attribute_name, qvariant):
         layer.commitChanges()
 
 
-def extract_nodes(layer):
+def add_layer_attributes(layer, attributes):
+    """Add new attributes to layer in a single edit session.
+
+    Attributes that already exist in the layer are left untouched.
+
+    :param layer: A Vector layer.
+    :type layer: QGISVectorLayer
+
+    :param attributes: List of (attribute_name, qvariant) tuples.
+    :type attributes: list
+    """
+    new_fields = [
+        QgsField(attribute_name, qvariant)
+        for attribute_name, qvariant in attributes
+        if layer.fieldNameIndex(attribute_name) == -1]
+    if new_fields:
+        data_provider = layer.dataProvider()
+        layer.startEditing()
+        data_provider.addAttributes(new_fields)
+        layer.updateFields()
+        layer.commitChanges()
+
+
+def extract_nodes(layer, columnar=False):
     """Return a list of tuple that represent line_id, first_point, last_point.
 
     This method will extract node from vector line layer. We only extract the
@@ -121,12 +135,23 @@ def extract_nodes(layer):
     :param layer: A vector line layer.
     :type layer: QGISVectorLayer
 
+    :param columnar: If True, return the nodes as NodeArrays instead of a
+        list of tuples. Defaults to False.
+    :type columnar: bool
+
     :returns: list of tuple. The tuple contains line_id, first_point of the
-        line, and last_point of the line.
-    :rtype: list
+        line, and last_point of the line. NodeArrays if columnar is True.
+    :rtype: list, NodeArrays
     """
-    nodes = []
-    lines = layer.getFeatures()
+    if columnar:
+        line_ids = array('l')
+        start_x = array('d')
+        start_y = array('d')
+        end_x = array('d')
+        end_y = array('d')
+    else:
+        nodes = []
+    lines = layer.getFeatures(feature_request(layer, []))
     for feature in lines:
         geom = feature.geometry()
         # for handling feature with None geometry
@@ -138,12 +163,31 @@ def extract_nodes(layer):
         line_id = feature.id()
         first_point = points[0]
         last_point = points[-1]
-        nodes.append((line_id, first_point, last_point))
-
+        if columnar:
+            line_ids.append(line_id)
+            start_x.append(first_point.x())
+            start_y.append(first_point.y())
+            end_x.append(last_point.x())
+            end_y.append(last_point.y())
+        else:
+            nodes.append((line_id, first_point, last_point))
+
+    if columnar:
+        return NodeArrays(
+            numpy.array(line_ids, dtype=numpy.int64),
+            numpy.array(start_x, dtype=numpy.float64),
+            numpy.array(start_y, dtype=numpy.float64),
+            numpy.array(end_x, dtype=numpy.float64),
+            numpy.array(end_y, dtype=numpy.float64))
     return nodes
 
 
-def create_nodes_layer(authority_id='EPSG:4326', nodes=None, name=None):
+def create_nodes_layer(
+        authority_id='EPSG:4326',
+        nodes=None,
+        name=None,
+        fields=None,
+        sink=None):
     """Return QgsVectorLayer (point) that contains nodes.
 
     This method also create attribute for the layer as follow:
@@ -158,39 +202,48 @@ def create_nodes_layer(authority_id='EPSG:4326', nodes=None, name=None):
     :type authority_id: str
 
     :param nodes: A list of nodes. Represent as line_id, first_point,
-        and last_point in a tuple.
-    :type nodes: list, None
+        and last_point in a tuple, or a NodeArrays.
+    :type nodes: list, NodeArrays, None
 
     :param name: The name of the layer. If None, set to Nodes.
     :type name: str
 
+    :param fields: Optional extra attributes for the nodes, as a list of
+        (name, QVariant type, values) tuples. values holds one value per
+        node, in node id order.
+    :type fields: list
+
+    :param sink: Optional sink receiving the nodes, see stream_output.
+        Defaults to a MemorySink.
+    :type sink: MemorySink, FileSink
+
     :returns: A vector point layer that contains nodes as attributes.
     :rtype: QgsVectorLayer
     """
     if name is None:
         name = tr('Stream features')
+    if fields is None:
+        fields = []
+    if sink is None:
+        sink = MemorySink()
 
-    layer = QgsVectorLayer(
-        'Point?crs=%s&index=yes' % authority_id, name, 'memory')
-
-    data_provider = layer.dataProvider()
-
-    # Start edit layer
-    layer.startEditing()
-
-    # Add fields
-    data_provider.addAttributes([
+    sink.open(name, authority_id, [
         QgsField('id', QVariant.Int),
         QgsField('line_id', QVariant.Int),
         QgsField('node_type', QVariant.String)
-    ])
+    ] + [QgsField(field[0], field[1]) for field in fields])
 
-    layer.commitChanges()
+    if isinstance(nodes, NodeArrays):
+        nodes = zip(
+            nodes.line_ids.tolist(),
+            [QgsPoint(x, y) for x, y in zip(
+                nodes.start_x.tolist(), nodes.start_y.tolist())],
+            [QgsPoint(x, y) for x, y in zip(
+                nodes.end_x.tolist(), nodes.end_y.tolist())])
 
     # For creating node_id
     node_id = 0
     # Add features
-    features = []
     for node in nodes:
         line_id = node[0]
         first_point = node[1]
@@ -200,22 +253,23 @@ def create_nodes_layer(authority_id='EPSG:4326', nodes=None, name=None):
         feature = QgsFeature()
         # noinspection PyArgumentList
         feature.setGeometry(QgsGeometry.fromPoint(first_point))
-        feature.setAttributes([node_id, line_id, 'upstream'])
-        features.append(feature)
+        feature.setAttributes(
+            [node_id, line_id, 'upstream'] +
+            [field[2][node_id] for field in fields])
+        sink.add_feature(feature)
         node_id += 1
 
         # Add upstream node
         feature = QgsFeature()
         # noinspection PyArgumentList
         feature.setGeometry(QgsGeometry.fromPoint(last_point))
-        feature.setAttributes([node_id, line_id, 'downstream'])
-        features.append(feature)
+        feature.setAttributes(
+            [node_id, line_id, 'downstream'] +
+            [field[2][node_id] for field in fields])
+        sink.add_feature(feature)
         node_id += 1
 
-    data_provider.addFeatures(features)
-    # Commit changes
-    layer.commitChanges()
-    return layer
+    return sink.close()
 
 
 def get_nearby_nodes(layer, node, threshold):
@@ -252,7 +306,7 @@ def get_nearby_nodes(layer, node, threshold):
     # iterate through all nodes
     upstream_nodes = []
     downstream_nodes = []
-    request = QgsFeatureRequest()
+    request = feature_request(layer, ['id', 'node_type'])
     request.setFilterRect(rectangle)
     for feature in layer.getFeatures(request):
         attributes = feature.attributes()
@@ -281,7 +335,8 @@ def add_associated_nodes(layer, threshold, callback=None):
     upstream_node_count, downstream_node_list, downstream_node_count) to the
     layer and populate those attributes with the right value.
 
-    it will use get_nearby_nodes function to populate them.
+    All nodes are read once and the nearby nodes are found with
+    associate_nodes, without querying the layer for every node.
 
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
@@ -295,9 +350,27 @@ def add_associated_nodes(layer, threshold, callback=None):
     :type callback: function
 
     """
-    nodes = layer.getFeatures()
+    id_index = layer.fieldNameIndex('id')
     node_type_index = layer.fieldNameIndex('node_type')
 
+    # Read all nodes once
+    node_fids = []
+    node_ids = []
+    upstream = []
+    xs = []
+    ys = []
+    request = feature_request(layer, ['id', 'node_type'])
+    for node in layer.getFeatures(request):
+        node_attributes = node.attributes()
+        point = node.geometry().asPoint()
+        node_fids.append(int(node.id()))
+        node_ids.append(node_attributes[id_index])
+        upstream.append(node_attributes[node_type_index] == 'upstream')
+        xs.append(point.x())
+        ys.append(point.y())
+    up_nodes, down_nodes, up_num, down_num = associate_nodes(
+        xs, ys, upstream, threshold, callback)
+
     # add attributes
     data_provider = layer.dataProvider()
 
@@ -313,40 +386,22 @@ def add_associated_nodes(layer, threshold, callback=None):
 
     layer.startEditing()
 
-    node_count = layer.featureCount()
-    counter = 1
-
+    up_num = up_num.tolist()
+    down_num = down_num.tolist()
     dictionary_changes = {}
-    for node in nodes:
-        if callback is not None:
-            if counter % 100 == 0:
-                callback(current=counter, maximum=node_count)
-        counter += 1
-        node_fid = int(node.id())
-        node_attributes = node.attributes()
-        #node_id = node_attributes[id_index]
-        node_type = node_attributes[node_type_index]
-        upstream_nodes, downstream_nodes = get_nearby_nodes(
-            layer, node, threshold)
-        upstream_count = len(upstream_nodes)
-        downstream_count = len(downstream_nodes)
-        if node_type == 'upstream':
-            upstream_count += 1
-        if node_type == 'downstream':
-            downstream_count += 1
+    for index in range(len(node_fids)):
+        upstream_nodes = [node_ids[i] for i in up_nodes[index]]
+        downstream_nodes = [node_ids[i] for i in down_nodes[index]]
         attributes = {
             up_nodes_index: list_to_str(upstream_nodes),
             down_nodes_index: list_to_str(downstream_nodes),
-            up_num_index: upstream_count,
-            down_num_index: downstream_count
+            up_num_index: up_num[index],
+            down_num_index: down_num[index]
         }
-        dictionary_changes[node_fid] = attributes
+        dictionary_changes[node_fids[index]] = attributes
 
     data_provider.changeAttributeValues(dictionary_changes)
 
-    if callback:
-        callback(current=node_count, maximum=node_count)
-
     layer.commitChanges()
 
 
@@ -372,38 +427,50 @@ def check_associated_attributes(layer):
         return True
 
 
-def identify_wells(layer):
-    """Mark nodes from the layer if it is a well.
+def identify_nodes(layer, attributes=None):
+    """Mark the type of every node in the layer.
 
-    A node is identified as a well if the number of upstream nodes == 1 and
-    the number downstream node 0.
-    And add attribute `well` for marking.
+    The up_num and down_num attributes are read once, every node type is
+    computed by classify_nodes and all the marks are written in one update.
 
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
+
+    :param attributes: The node type attributes to add, see NODE_ATTRIBUTES.
+        If None, all of them are added.
+    :type attributes: list
     """
     if not check_associated_attributes(layer):
         raise Exception('You should add associated node first')
 
-    add_layer_attribute(layer, 'well', QVariant.Int)
-    nodes = layer.getFeatures()
+    if attributes is None:
+        attributes = NODE_ATTRIBUTES
+    add_layer_attributes(
+        layer, [(attribute, QVariant.Int) for attribute in attributes])
 
     up_num_index = layer.fieldNameIndex('up_num')
     down_num_index = layer.fieldNameIndex('down_num')
-    well_index = layer.fieldNameIndex('well')
 
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
+    request = feature_request(layer, ['up_num', 'down_num'], geometry=False)
+    node_fids = []
+    up_num = []
+    down_num = []
+    for node in layer.getFeatures(request):
         node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if up_num == 1 and down_num == 0:
-            well_value = 1
-        else:
-            well_value = 0
-        attributes = {well_index: well_value}
-        dictionary_attributes[node_fid] = attributes
+        node_fids.append(node.id())
+        up_num.append(node_attributes[up_num_index])
+        down_num.append(node_attributes[down_num_index])
+
+    flags = classify_nodes(up_num, down_num)
+    columns = [
+        (layer.fieldNameIndex(attribute), flags[attribute].tolist())
+        for attribute in attributes]
+
+    dictionary_attributes = {}
+    for i, node_fid in enumerate(node_fids):
+        dictionary_attributes[node_fid] = dict(
+            (attribute_index, values[i])
+            for attribute_index, values in columns)
 
     data_provider = layer.dataProvider()
     layer.startEditing()
@@ -411,6 +478,19 @@ def identify_wells(layer):
     layer.commitChanges()
 
 
+def identify_wells(layer):
+    """Mark nodes from the layer if it is a well.
+
+    A node is identified as a well if the number of upstream nodes == 1 and
+    the number downstream node 0.
+    And add attribute `well` for marking.
+
+    :param layer: A vector point layer.
+    :type layer: QGISVectorLayer
+    """
+    identify_nodes(layer, ['well'])
+
+
 def identify_sinks(layer):
     """Mark nodes from the layer if it is a sink.
 
@@ -421,33 +501,7 @@ def identify_sinks(layer):
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
     """
-    if not check_associated_attributes(layer):
-        raise Exception('You should add associated node first')
-
-    add_layer_attribute(layer, 'sink', QVariant.Int)
-    nodes = layer.getFeatures()
-
-    up_num_index = layer.fieldNameIndex('up_num')
-    down_num_index = layer.fieldNameIndex('down_num')
-    sink_index = layer.fieldNameIndex('sink')
-
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
-        node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if up_num == 0 and down_num > 0:
-            sink_value = 1
-        else:
-            sink_value = 0
-        attributes = {sink_index: sink_value}
-        dictionary_attributes[node_fid] = attributes
-
-    data_provider = layer.dataProvider()
-    layer.startEditing()
-    data_provider.changeAttributeValues(dictionary_attributes)
-    layer.commitChanges()
+    identify_nodes(layer, ['sink'])
 
 
 def identify_watersheds(layer):
@@ -460,33 +514,7 @@ def identify_watersheds(layer):
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
     """
-    if not check_associated_attributes(layer):
-        raise Exception('You should add associated node first')
-
-    add_layer_attribute(layer, 'watershed', QVariant.Int)
-    nodes = layer.getFeatures()
-
-    up_num_index = layer.fieldNameIndex('up_num')
-    down_num_index = layer.fieldNameIndex('down_num')
-    watershed_index = layer.fieldNameIndex('watershed')
-
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
-        node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if up_num > 1 and down_num == 0:
-            watershed_value = 1
-        else:
-            watershed_value = 0
-        attributes = {watershed_index: watershed_value}
-        dictionary_attributes[node_fid] = attributes
-
-    data_provider = layer.dataProvider()
-    layer.startEditing()
-    data_provider.changeAttributeValues(dictionary_attributes)
-    layer.commitChanges()
+    identify_nodes(layer, ['watershed'])
 
 
 def identify_unclear_bifurcations(layer):
@@ -500,33 +528,7 @@ def identify_unclear_bifurcations(layer):
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
     """
-    if not check_associated_attributes(layer):
-        raise Exception('You should add associated node first')
-
-    add_layer_attribute(layer, 'unclear_bi', QVariant.Int)
-    nodes = layer.getFeatures()
-
-    up_num_index = layer.fieldNameIndex('up_num')
-    down_num_index = layer.fieldNameIndex('down_num')
-    unclear_bifurcation_index = layer.fieldNameIndex('unclear_bi')
-
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
-        node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if 1 < up_num == down_num > 1:
-            unclear_bifurcation_value = 1
-        else:
-            unclear_bifurcation_value = 0
-        attributes = {unclear_bifurcation_index: unclear_bifurcation_value}
-        dictionary_attributes[node_fid] = attributes
-
-    data_provider = layer.dataProvider()
-    layer.startEditing()
-    data_provider.changeAttributeValues(dictionary_attributes)
-    layer.commitChanges()
+    identify_nodes(layer, ['unclear_bi'])
 
 
 def identify_branches(layer):
@@ -539,33 +541,7 @@ def identify_branches(layer):
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
     """
-    if not check_associated_attributes(layer):
-        raise Exception('You should add associated node first')
-
-    add_layer_attribute(layer, 'branch', QVariant.Int)
-    nodes = layer.getFeatures()
-
-    up_num_index = layer.fieldNameIndex('up_num')
-    down_num_index = layer.fieldNameIndex('down_num')
-    branch_index = layer.fieldNameIndex('branch')
-
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
-        node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if 1 <= down_num < up_num:
-            branch_value = 1
-        else:
-            branch_value = 0
-        attributes = {branch_index: branch_value}
-        dictionary_attributes[node_fid] = attributes
-
-    data_provider = layer.dataProvider()
-    layer.startEditing()
-    data_provider.changeAttributeValues(dictionary_attributes)
-    layer.commitChanges()
+    identify_nodes(layer, ['branch'])
 
 
 def identify_confluences(layer):
@@ -578,33 +554,7 @@ def identify_confluences(layer):
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
     """
-    if not check_associated_attributes(layer):
-        raise Exception('You should add associated node first')
-
-    add_layer_attribute(layer, 'confluence', QVariant.Int)
-    nodes = layer.getFeatures()
-
-    up_num_index = layer.fieldNameIndex('up_num')
-    down_num_index = layer.fieldNameIndex('down_num')
-    confluence_index = layer.fieldNameIndex('confluence')
-
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
-        node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if 1 <= up_num < down_num:
-            confluence_value = 1
-        else:
-            confluence_value = 0
-        attributes = {confluence_index: confluence_value}
-        dictionary_attributes[node_fid] = attributes
-
-    data_provider = layer.dataProvider()
-    layer.startEditing()
-    data_provider.changeAttributeValues(dictionary_attributes)
-    layer.commitChanges()
+    identify_nodes(layer, ['confluence'])
 
 
 def identify_pseudo_nodes(layer):
@@ -617,114 +567,49 @@ def identify_pseudo_nodes(layer):
     :param layer: A vector point layer.
     :type layer: QGISVectorLayer
     """
-    if not check_associated_attributes(layer):
-        raise Exception('You should add associated node first')
-
-    add_layer_attribute(layer, 'pseudo', QVariant.Int)
-    nodes = layer.getFeatures()
-
-    up_num_index = layer.fieldNameIndex('up_num')
-    down_num_index = layer.fieldNameIndex('down_num')
-    pseudo_node_index = layer.fieldNameIndex('pseudo')
-
-    dictionary_attributes = {}
-    for node in nodes:
-        node_fid = node.id()
-        node_attributes = node.attributes()
-        up_num = node_attributes[up_num_index]
-        down_num = node_attributes[down_num_index]
-        if up_num == 1 and down_num == 1:
-            pseudo_node_value = 1
-        else:
-            pseudo_node_value = 0
-        attributes = {pseudo_node_index: pseudo_node_value}
-        dictionary_attributes[node_fid] = attributes
-
-    data_provider = layer.dataProvider()
-    layer.startEditing()
-    data_provider.changeAttributeValues(dictionary_attributes)
-    layer.commitChanges()
-
-
-def between(a, b, c):
-    """True if c is between a and b."""
-    if a < b < c:
-        return True
-    if c < b < a:
-        return True
-    return False
-
-
-def point_in_line(point, line):
-    """True if a point is in a line that has only two vertices."""
-    x_point = point[0]
-    y_point = point[1]
-    x1_line = line[0][0]
-    y1_line = line[0][1]
-    x2_line = line[1][0]
-    y2_line = line[1][1]
-    return (between(x1_line, x_point, x2_line)
-            and between(y1_line, y_point, y2_line))
+    identify_nodes(layer, ['pseudo'])
 
 
 def get_spatial_index(data_provider):
     """Create spatial index from a data provider."""
     qgs_feature = QgsFeature()
     index = QgsSpatialIndex()
-    qgs_features = data_provider.getFeatures()
+    qgs_features = data_provider.getFeatures(
+        feature_request(data_provider, []))
     while qgs_features.nextFeature(qgs_feature):
         index.insertFeature(qgs_feature)
     return index
 
 
-def identify_intersections(layer):
-    """Return all self intersection points of a line.
+def identify_intersections(
+        layer, statistics=None, precision=0, cancel_token=None):
+    """Return all intersection points between the lines of a layer.
+
+    See StreamNetwork.intersections, the network is only built for this.
 
     :param layer: A vector line to be identified.
     :type layer: QgsVectorLayer
 
+    :param statistics: Optional dictionary that will be populated with the
+        number of pairs pruned by their bounding box (pruned_pairs), the
+        number of pairs tested exactly (tested_pairs) and the geometry cache
+        hits and misses (cache_hits, cache_misses).
+    :type statistics: dict
+
+    :param precision: Points closer than precision are considered duplicates,
+        see deduplicate_points. Defaults to 0.
+    :type precision: float
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
     :returns: List of QgsPoint that represent the intersection point.
     :rtype: list
 
     """
-    intersections = []
-    data_provider = layer.dataProvider()
-    spatial_index = get_spatial_index(data_provider)
-
-    feature_2 = QgsFeature()
-    features = layer.getFeatures()
-    for feature in features:
-        geometry = feature.geometry()
-        vertices = geometry.asPolyline()
-        intersect_lines = spatial_index.intersects(geometry.boundingBox())
-        for intersect_line in intersect_lines:
-            line_id = int(intersect_line)
-            data_provider.getFeatures(
-                QgsFeatureRequest().setFilterFid(line_id)).nextFeature(
-                    feature_2)
-            geometry_2 = feature_2.geometry()
-            if geometry.intersects(geometry_2):
-                temp_geom = geometry.intersection(geometry_2)
-                if temp_geom.type() == QGis.Point:
-                    temp_list = []
-                    if temp_geom.isMultipart():
-                        temp_list = temp_geom.asMultiPoint()
-                    else:
-                        temp_list.append(temp_geom.asPoint())
-                    if len(vertices) > 1:
-                        if vertices[0] in temp_list:
-                            temp_list.remove(vertices[0])
-                        if vertices[-1] in temp_list:
-                                temp_list.remove(vertices[-1])
-                    intersections.extend(temp_list)
-    # Note(ismailsunni): if I converted directly from list to set, there is a
-    # problem. The elements in the set are not unique in qgis 2.0.
-    # Yes, this is strange.
-    result = []
-    for intersection in intersections:
-        if intersection not in result:
-            result.append(intersection)
-    return result
+    network = StreamNetwork(layer, cancel_token)
+    return network.intersections(statistics, precision, cancel_token)
 
 
 # noinspection PyArgumentList,PyCallByClass,PyTypeChecker
@@ -740,38 +625,11 @@ def identify_self_intersections(line):
     :returns: List of QgsPoint that represent the intersection point.
     :rtype: list
     """
-    self_intersections = []
-
     geometry = line.geometry()
-    vertices = geometry.asPolyline()
-    if len(vertices) <= 2:
-        return self_intersections
-
-    for i in range(len(vertices) - 2):
-        v = (vertices[i + 1].x() - vertices[i].x(),
-             vertices[i + 1].y() - vertices[i].y())
-        for j in range(i + 2, len(vertices) - 1):
-            w = (vertices[j + 1].x() - vertices[j].x(),
-                 vertices[j + 1].y() - vertices[j].y())
-            d = v[1] * w[0] - v[0] * w[1]
-            if d == 0:
-                # Continue to the next part of line
-                continue
-
-            dx = vertices[j].x() - vertices[i].x()
-            dy = vertices[j].y() - vertices[i].y()
-
-            k = (dy * w[0] - dx * w[1]) / float(d)
-
-            intersection = vertices[i][0] + v[0] * k, vertices[i][1] + v[1] * k
-            if not point_in_line(intersection, vertices[i:i + 2]):
-                continue
-            if not point_in_line(intersection, vertices[j:j + 2]):
-                continue
-            self_intersections.append(
-                QgsPoint(intersection[0], intersection[1]))
-
-    return self_intersections
+    vertices = [(vertex.x(), vertex.y()) for vertex in geometry.asPolyline()]
+    return [
+        QgsPoint(intersection[0], intersection[1])
+        for intersection in find_self_intersections(vertices)]
 
 
 def identify_segment_center(line):
@@ -784,93 +642,196 @@ def identify_segment_center(line):
     :rtype: QgsPoint
     """
     geometry = line.geometry()
-    vertices = geometry.asPolyline()
-    vertex_count = len(vertices)
-
-    if vertex_count < 1:
+    vertices = [(vertex.x(), vertex.y()) for vertex in geometry.asPolyline()]
+    center = segment_center(vertices)
+    if center is None:
         return None
+    return QgsPoint(center[0], center[1])
 
-    part_lengths = []
-    for i in range(vertex_count - 1):
-        length = vertices[i].sqrDist(vertices[i + 1])
-        part_lengths.append(sqrt(length))
 
-    segment_count = len(part_lengths)
-    line_length = sum(part_lengths)
-    half_length = 0.5 * line_length
+def identify_segment_points(layer, fractions, cancel_token=None):
+    """Return the points at fractions of the length of the lines of a layer.
 
-    current_length = 0
-    i = 0
-    add_length = 0
-    while current_length <= half_length and i < segment_count:
-        add_length = part_lengths[i]
-        current_length += add_length
-        i += 1
+    All the fractions are computed in one pass, see line_positions.
 
-    current_length -= add_length
-    delta_length = half_length - current_length
-    i -= 1
+    :param layer: A vector line layer to be identified.
+    :type layer: QgsVectorLayer
 
-    if add_length > 0:
-        ratio = float(delta_length) / float(add_length)
+    :param fractions: The fractions of the line length, between 0 and 1,
+        e.g. [0.25, 0.5, 0.75] for quarter point stations.
+    :type fractions: list
 
-        center_x = vertices[i].x()
-        center_x += ratio * (vertices[i + 1].x() - vertices[i].x())
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
 
-        center_y = vertices[i].y()
-        center_y += ratio * (vertices[i + 1].y() - vertices[i].y())
-    else:
-        try:
-            center_x = vertices[i].x()
-            center_y = vertices[i].y()
-        except IndexError:
-            return None
+    :returns: One list of QgsPoint per fraction.
+    :rtype: list
+    """
+    lines = []
+    data_provider = layer.dataProvider()
+    features = data_provider.getFeatures(feature_request(data_provider, []))
+    for feature in features:
+        if cancel_token is not None:
+            cancel_token.check()
+        if feature.geometry() is None:
+            continue
+        vertices = feature.geometry().asPolyline()
+        if vertices:
+            lines.append([(vertex.x(), vertex.y()) for vertex in vertices])
 
-    return QgsPoint(center_x, center_y)
+    xs, ys, offsets = flatten_lines(lines)
+    position_xs, position_ys = line_positions(
+        xs, ys, offsets, fractions, cancel_token)
+    return [
+        [QgsPoint(x, y) for x, y in zip(
+            position_xs[:, column].tolist(),
+            position_ys[:, column].tolist())]
+        for column in range(len(fractions))]
 
 
-def identify_segment_centers(layer):
+def identify_segment_centers(layer, cancel_token=None):
     """Return a list of QgsPoint of linear segment centers in layer.
 
     :param layer: A vector line layer to be identified.
     :type layer: QgsVectorLayer
 
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
     :returns: A list of linear segment center.
     :rtype: list
     """
-    segment_centers = []
-    data_provider = layer.dataProvider()
-    features = data_provider.getFeatures()
-    for feature in features:
-        center = identify_segment_center(feature)
-        if center is not None:
-            segment_centers.append(center)
-
-    return segment_centers
+    return identify_segment_points(layer, [0.5], cancel_token)[0]
 
 
-def identify_self_intersections_layer(layer):
+def identify_self_intersections_layer(
+        layer, precision=0, cancel_token=None):
     """Return all self intersection points of a vector line layer.
 
     :param layer: A vector line layer to be identified.
     :type layer: QgsVectorLayer
 
+    :param precision: Points closer than precision are considered duplicates,
+        see deduplicate_points. Defaults to 0.
+    :type precision: float
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
     :returns: List of QgsPoint that represent the intersection point.
     :rtype: list
     """
 
     self_intersections_layer = []
     data_provider = layer.dataProvider()
-    features = data_provider.getFeatures()
+    features = data_provider.getFeatures(feature_request(data_provider, []))
     for feature in features:
+        if cancel_token is not None:
+            cancel_token.check()
         self_intersections = identify_self_intersections(feature)
         if self_intersections:
             self_intersections_layer.extend(self_intersections)
 
-    return self_intersections_layer
+    return deduplicate_points(self_intersections_layer, precision)
+
+
+def associate_layer_nodes(
+        input_layer,
+        threshold=0,
+        callback=None,
+        cancel_token=None,
+        report=None,
+        associate=None):
+    """Find the nearby nodes and the type of the nodes of a line layer.
+
+    The layer is read into a StreamNetwork, see StreamNetwork.associate.
+
+    :param input_layer: A vector line layer.
+    :type input_layer: QGISVectorLayer
+
+    :param threshold: Distance threshold for node snapping. Defaults to 0.
+    :type threshold: float
+
+    :param callback: A function to all to indicate progress. The function
+        should accept params 'current' (int) and 'maximum' (int). Defaults to
+        None.
+    :type callback: function
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :param report: Optional run report, the read_lines, associate_nodes
+        and rule_<attribute> stages are recorded in it.
+    :type report: RunReport
+
+    :param associate: Function used instead of associate_nodes, with the
+        same arguments and result, e.g. to run it in several processes.
+    :type associate: function
+
+    :returns: The nodes with their nearby nodes and node types.
+    :rtype: AssociatedNodes
+    """
+    network = StreamNetwork(input_layer, cancel_token, report)
+    return network.associate(
+        threshold, callback, cancel_token, report, associate)
+
 
+def create_associated_nodes_layer(
+        authority_id, nodes, sink=None, report=None):
+    """Create the intermediate layer of associated nodes.
 
-def create_intermediate_layer(input_layer, threshold=0, callback=None):
+    The nearby nodes are only turned into the up_nodes and down_nodes
+    strings here, the extraction itself uses the arrays.
+
+    :param authority_id: The authority id of the layer crs.
+    :type authority_id: str
+
+    :param nodes: The nodes, see associate_layer_nodes.
+    :type nodes: AssociatedNodes
+
+    :param sink: Optional sink receiving the nodes, see stream_output.
+        Defaults to a MemorySink.
+    :type sink: MemorySink, FileSink
+
+    :param report: Optional run report, the intermediate_layer stage is
+        recorded in it.
+    :type report: RunReport
+
+    :returns: Intermediate layer.
+    :rtype: QgsVectorLayer
+    """
+    with report_stage(report, 'intermediate_layer'):
+        fields = [
+            ('up_nodes', QVariant.String, nodes.up_nodes.strings()),
+            ('down_nodes', QVariant.String, nodes.down_nodes.strings()),
+            ('up_num', QVariant.Int, nodes.up_num.tolist()),
+            ('down_num', QVariant.Int, nodes.down_num.tolist())]
+        fields.extend([
+            (attribute, QVariant.Int, nodes.flags[attribute].tolist())
+            for attribute in NODE_ATTRIBUTES])
+
+        nodes_layer_name = tr('Intermediate layer')
+        # noinspection PyTypeChecker
+        return create_nodes_layer(
+            authority_id=authority_id,
+            nodes=nodes.nodes,
+            name=nodes_layer_name,
+            fields=fields,
+            sink=sink)
+
+
+def create_intermediate_layer(
+        input_layer,
+        threshold=0,
+        callback=None,
+        cancel_token=None,
+        report=None,
+        associate=None,
+        sink=None):
     """Helper function to create intermediate layer.
 
     Intermediate layer is a temporary layer that is used for helping the tool
@@ -887,53 +848,113 @@ def create_intermediate_layer(input_layer, threshold=0, callback=None):
         None.
     :type callback: function
 
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :param report: Optional run report, the read_lines, associate_nodes,
+        rule_<attribute> and intermediate_layer stages are recorded in it.
+    :type report: RunReport
+
+    :param associate: Function used instead of associate_nodes, with the
+        same arguments and result, e.g. to run it in several processes.
+    :type associate: function
+
+    :param sink: Optional sink receiving the nodes, see stream_output.
+        Defaults to a MemorySink.
+    :type sink: MemorySink, FileSink
+
     :returns: Intermediate layer.
     :rtype: QgsVectorLayer
     """
-    # Creating intermediate layer
-    authority_id = input_layer.crs().authid()
-    nodes = extract_nodes(layer=input_layer)
-    nodes_layer_name = tr('Intermediate layer')
-    # noinspection PyTypeChecker
-    intermediate_layer = create_nodes_layer(
-        authority_id=authority_id, nodes=nodes, name=nodes_layer_name)
-    add_associated_nodes(intermediate_layer, threshold, callback)
-
-    # Create a collection of function references that we will call in turn
-    # Note the actually run order is non deterministic so each function
-    # should be independent.
-    rules = {
-        tr('Finding wells...'): identify_wells,
-        tr('Finding sinks...'): identify_sinks,
-        tr('Finding branches...'): identify_branches,
-        tr('Finding confluences...'): identify_confluences,
-        tr('Finding pseudo nodes...'): identify_pseudo_nodes,
-        tr('Finding watersheds...'): identify_watersheds,
-        tr('Finding unclear bifurcations...'): identify_unclear_bifurcations}
-    rule_count = len(rules)
-    index = 1
+    nodes = associate_layer_nodes(
+        input_layer, threshold, callback, cancel_token, report, associate)
+    return create_associated_nodes_layer(
+        input_layer.crs().authid(), nodes, sink, report)
 
-    for message, rule in rules.iteritems():
-        callback(current=index, maximum=rule_count, message=message)
-        rule(intermediate_layer)
-        index += 1
 
-    return intermediate_layer
+def store_network_nodes(
+        store,
+        network,
+        threshold=0,
+        callback=None,
+        cancel_token=None,
+        report=None):
+    """Find the nearby nodes and the type of the nodes in a NodeStore.
 
+    This is associate_layer_nodes running against the store, in batches.
 
-def create_new_features(
+    :param store: An empty store.
+    :type store: NodeStore
+
+    :param network: The network of a vector line layer.
+    :type network: StreamNetwork
+
+    :param threshold: Distance threshold for node snapping. Defaults to 0.
+    :type threshold: float
+
+    :param callback: A function to all to indicate progress. The function
+        should accept params 'current' (int) and 'maximum' (int). Defaults to
+        None.
+    :type callback: function
+
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :param report: Optional run report, the store_nodes, associate_nodes
+        and classify_nodes stages are recorded in it.
+    :type report: RunReport
+
+    :returns: The store.
+    :rtype: NodeStore
+    """
+    with report_stage(report, 'store_nodes') as stage:
+        store.add_nodes(network.authority_id, network.nodes, cancel_token)
+        stage.count('nodes', store.node_count)
+    with report_stage(report, 'associate_nodes') as stage:
+        nearby_count = store.associate(threshold, callback, cancel_token)
+        stage.count('nodes', store.node_count)
+        stage.count('nearby_nodes', nearby_count)
+    if callback is not None:
+        callback(current=1, maximum=1, message=tr('Classifying nodes...'))
+    with report_stage(report, 'classify_nodes') as stage:
+        for attribute, count in store.classify(cancel_token).items():
+            stage.count(attribute, count)
+    return store
+
+
+def node_type_names():
+    """Return the output type name of every node type.
+
+    :returns: List of the translated names, in the order of NODE_ATTRIBUTES.
+    :rtype: list
+    """
+    return [
+        tr('Well'),
+        tr('Sink'),
+        tr('Branch'),
+        tr('Confluence'),
+        tr('Pseudo node'),
+        tr('Watershed'),
+        tr('Unclear Bifurcation')]
+
+
+def create_output_points(
         intermediate_layer,
         self_intersections,
         intersections,
         segment_centers):
-    """Create list of features ready to add to final layer.
+    """Create list of points ready to add to final layer.
 
     This function will extract node from intermediate_layer, then add points
     from self_intersections, intersections, and segment_centers to complete
-    the list of features.
+    the list of points.
 
-    :param intermediate_layer: An intermediate layer.
-    :type intermediate_layer: QgsVectorLayer
+    :param intermediate_layer: An intermediate layer, or the nodes it is
+        made of (see associate_layer_nodes or store_network_nodes) to avoid
+        reading it.
+    :type intermediate_layer: QgsVectorLayer, AssociatedNodes, NodeStore
 
     :param self_intersections: List of self_intersection points.
     :type self_intersections: list
@@ -944,10 +965,88 @@ def create_new_features(
     :param segment_centers: List of segment_center points.
     :type segment_centers: list
 
-    :returns: List of QgsFeature
+    :returns: List of (QgsPoint, type name) tuples.
     :rtype: list
     """
-    new_features = []
+    return list(iter_output_points(
+        intermediate_layer, self_intersections, intersections,
+        segment_centers))
+
+
+def iter_output_points(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers):
+    """Generate the points of create_output_points, in the same order.
+
+    :returns: Generator of (QgsPoint, type name) tuples.
+    :rtype: generator
+    """
+    feature_names = node_type_names()
+    if isinstance(intermediate_layer, AssociatedNodes):
+        output_points = node_output_points(intermediate_layer, feature_names)
+    elif isinstance(intermediate_layer, NodeStore):
+        output_points = (
+            (QgsPoint(x, y), feature_names[type_index])
+            for x, y, type_index in intermediate_layer.typed_nodes())
+    else:
+        output_points = layer_output_points(intermediate_layer, feature_names)
+    for output_point in output_points:
+        yield output_point
+
+    self_intersection_name = tr('Self Intersection')
+    segment_center_name = tr('Segment Center')
+    intersection_name = tr('Intersection')
+
+    for self_intersection in self_intersections:
+        yield self_intersection, self_intersection_name
+
+    for segment_center in segment_centers:
+        yield segment_center, segment_center_name
+
+    for intersection in intersections:
+        yield intersection, intersection_name
+
+
+def node_output_points(nodes, feature_names):
+    """Generate the typed nodes, one for every group of nearby nodes.
+
+    :param nodes: The nodes, see associate_layer_nodes.
+    :type nodes: AssociatedNodes
+
+    :param feature_names: The name of every node type, see node_type_names.
+    :type feature_names: list
+
+    :returns: Generator of (QgsPoint, type name) tuples.
+    :rtype: generator
+    """
+    xs = nodes.xs.tolist()
+    ys = nodes.ys.tolist()
+    columns = [
+        nodes.flags[attribute].tolist() for attribute in NODE_ATTRIBUTES]
+    for index in nodes.representatives():
+        node_point = QgsPoint(xs[index], ys[index])
+        for i, column in enumerate(columns):
+            if column[index] == 1:
+                yield node_point, feature_names[i]
+
+
+def layer_output_points(intermediate_layer, feature_names):
+    """Generate the typed nodes of an intermediate layer.
+
+    The nodes are read from the layer and its up_nodes and down_nodes
+    strings, see node_output_points.
+
+    :param intermediate_layer: An intermediate layer.
+    :type intermediate_layer: QgsVectorLayer
+
+    :param feature_names: The name of every node type, see node_type_names.
+    :type feature_names: list
+
+    :returns: Generator of (QgsPoint, type name) tuples.
+    :rtype: generator
+    """
     id_index = intermediate_layer.fieldNameIndex('id')
     upstream_index = intermediate_layer.fieldNameIndex('up_nodes')
     downstream_index = intermediate_layer.fieldNameIndex('down_nodes')
@@ -968,23 +1067,11 @@ def create_new_features(
         watershed_index,
         unclear_bifurcation_index]
 
-    feature_names = [
-        tr('Well'),
-        tr('Sink'),
-        tr('Branch'),
-        tr('Confluence'),
-        tr('Pseudo node'),
-        tr('Watershed'),
-        tr('Unclear Bifurcation')]
-
-    self_intersection_name = tr('Self Intersection')
-    segment_center_name = tr('Segment Center')
-    intersection_name = tr('Intersection')
-
     intermediate_data_provider = intermediate_layer.dataProvider()
-    nodes = intermediate_data_provider.getFeatures()
+    nodes = intermediate_data_provider.getFeatures(feature_request(
+        intermediate_data_provider,
+        ['id', 'up_nodes', 'down_nodes'] + NODE_ATTRIBUTES))
 
-    new_node_id = 1
     expired_node_id = set()
     for node in nodes:
         # get data from intermediate layers
@@ -1005,44 +1092,231 @@ def create_new_features(
         expired_node_id = expired_node_id.union(node_downstream)
 
         node_point = node.geometry().asPoint()
-        x = node_point.x()
-        y = node_point.y()
         for i in range(len(feature_indexes)):
             if node_attribute[feature_indexes[i]] == 1:
-                new_feature = QgsFeature()
-                new_feature.setGeometry(QgsGeometry.fromPoint(node_point))
-                new_feature.setAttributes(
-                    [new_node_id, x, y, feature_names[i]])
-                new_features.append(new_feature)
+                yield node_point, feature_names[i]
 
-    for self_intersection in self_intersections:
-        new_feature = QgsFeature()
-        new_feature.setGeometry(QgsGeometry.fromPoint(self_intersection))
-        x = self_intersection.x()
-        y = self_intersection.y()
-        new_feature.setAttributes(
-            [new_node_id, x, y, tr(self_intersection_name)])
-        new_features.append(new_feature)
 
-    for segment_center in segment_centers:
-        new_feature = QgsFeature()
-        new_feature.setGeometry(QgsGeometry.fromPoint(segment_center))
-        x = segment_center.x()
-        y = segment_center.y()
-        new_feature.setAttributes([new_node_id, x, y, segment_center_name])
-        new_features.append(new_feature)
-
-    intersection_points = []
-    for intersection in intersections:
-        new_feature = QgsFeature()
-        new_feature.setGeometry(QgsGeometry.fromPoint(intersection))
-        x = intersection.x()
-        y = intersection.y()
-        new_feature.setAttributes([new_node_id, x, y, intersection_name])
-        intersection_points.append(new_feature)
-    new_features.extend(intersection_points)
+def merge_duplicate_points(points, threshold):
+    """Replace the points closer than threshold by one Unseparated point.
+
+    How to find unseparated: basically, unseparated is an intersection point
+    in well or sink. So, we find the clusters of duplicate points (see
+    cluster_points) and keep only the first point of every cluster, as an
+    Unseparated point.
+
+    :param points: List of (QgsPoint, type name) tuples.
+    :type points: list
+
+    :param threshold: Distance threshold for deciding whether nodes are
+        converged or not.
+    :type threshold: float
+
+    :returns: List of (QgsPoint, type name) tuples, in the original order.
+    :rtype: list
+    """
+    clusters = cluster_points(
+        [point[0].x() for point in points],
+        [point[0].y() for point in points],
+        threshold)
+    return list(merge_clusters(points, clusters))
+
+
+def merge_clusters(points, clusters):
+    """Generate the first point of every cluster of points.
+
+    The points of the clusters with more than one point become Unseparated
+    points, see merge_duplicate_points.
+
+    :param points: The points, can be a generator.
+    :type points: iterable of (QgsPoint, type name) tuples
+
+    :param clusters: The cluster of every point, see cluster_points.
+    :type clusters: list
+
+    :returns: Generator of (QgsPoint, type name) tuples, in the original
+        order.
+    :rtype: generator
+    """
+    # Clusters with more than one point
+    shared_clusters = set(
+        cluster for index, cluster in enumerate(clusters) if cluster != index)
+
+    unseparated_name = tr('Unseparated')
+    for index, point in enumerate(points):
+        if clusters[index] != index:
+            continue
+        if index in shared_clusters:
+            yield point[0], unseparated_name
+        else:
+            yield point
+
+
+def create_new_points(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold=None,
+        report=None):
+    """Create list of points ready to add to final layer.
+
+    The points are collected by create_output_points and merged by
+    merge_duplicate_points if a threshold is given.
+
+    :param intermediate_layer: An intermediate layer or its nodes, see
+        create_output_points.
+    :type intermediate_layer: QgsVectorLayer, AssociatedNodes, NodeStore
 
-    return new_features
+    :param self_intersections: List of self_intersection points.
+    :type self_intersections: list
+
+    :param intersections: List of intersection points.
+    :type intersections: list
+
+    :param segment_centers: List of segment_center points.
+    :type segment_centers: list
+
+    :param threshold: Distance threshold for merging duplicate points into
+        Unseparated points. If None, points are not merged.
+    :type threshold: float, None
+
+    :param report: Optional run report, the output_points and
+        merge_duplicates stages are recorded in it.
+    :type report: RunReport
+
+    :returns: List of (QgsPoint, type name) tuples.
+    :rtype: list
+    """
+    return list(iter_new_points(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold,
+        report))
+
+
+def iter_new_points(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold=None,
+        report=None):
+    """Return the points of create_new_points without holding them.
+
+    The points are generated twice by iter_output_points. The first pass,
+    run here, only keeps their coordinates to find the clusters of
+    duplicate points (see cluster_points). The returned generator is the
+    second pass, generating the merged points. Only the coordinates, the
+    clusters and their grid are held in memory, not the points.
+
+    :returns: Generator of (QgsPoint, type name) tuples.
+    :rtype: generator
+    """
+    def output_points():
+        """Generate the points before they are merged."""
+        return iter_output_points(
+            intermediate_layer,
+            self_intersections,
+            intersections,
+            segment_centers)
+
+    if threshold is None:
+        return output_points()
+
+    with report_stage(report, 'output_points') as stage:
+        xs = array('d')
+        ys = array('d')
+        for point, _ in output_points():
+            xs.append(point.x())
+            ys.append(point.y())
+        stage.count('points', len(xs))
+    with report_stage(report, 'merge_duplicates') as stage:
+        clusters = cluster_points(xs, ys, threshold)
+        del xs, ys
+        stage.count('points', sum(
+            1 for index, cluster in enumerate(clusters) if cluster == index))
+    return merge_clusters(output_points(), clusters)
+
+
+def create_new_features(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold=None,
+        report=None):
+    """Create list of features ready to add to final layer.
+
+    The points of create_new_points are numbered from 1.
+
+    :param intermediate_layer: An intermediate layer or its nodes, see
+        create_output_points.
+    :type intermediate_layer: QgsVectorLayer, AssociatedNodes, NodeStore
+
+    :param self_intersections: List of self_intersection points.
+    :type self_intersections: list
+
+    :param intersections: List of intersection points.
+    :type intersections: list
+
+    :param segment_centers: List of segment_center points.
+    :type segment_centers: list
+
+    :param threshold: Distance threshold for merging duplicate points into
+        Unseparated points. If None, points are not merged.
+    :type threshold: float, None
+
+    :param report: Optional run report, see create_new_points.
+    :type report: RunReport
+
+    :returns: List of QgsFeature
+    :rtype: list
+    """
+    points = create_new_points(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold,
+        report)
+    return list(create_output_features(points))
+
+
+def create_output_features(points):
+    """Generate the features of the output layer, numbered from 1.
+
+    :param points: List of (QgsPoint, type name) tuples.
+    :type points: list
+
+    :returns: Generator of QgsFeature.
+    :rtype: generator
+    """
+    for new_node_id, (point, type_name) in enumerate(points, 1):
+        yield create_output_feature(new_node_id, point, type_name)
+
+
+def create_output_feature(feature_id, point, type_name):
+    """Create a feature of the output layer.
+
+    :param feature_id: Value of the id attribute.
+    :type feature_id: int
+
+    :param point: The location of the feature.
+    :type point: QgsPoint
+
+    :param type_name: Value of the type attribute.
+    :type type_name: str
+
+    :returns: A feature with the id, x, y and type attributes.
+    :rtype: QgsFeature
+    """
+    feature = QgsFeature()
+    feature.setGeometry(QgsGeometry.fromPoint(point))
+    feature.setAttributes([feature_id, point.x(), point.y(), type_name])
+    return feature
 
 
 def get_duplicate_points(layer, threshold):
@@ -1064,37 +1338,52 @@ def get_duplicate_points(layer, threshold):
     :rtype: list
     """
     data_provider = layer.dataProvider()
-    output_spatial_index = get_spatial_index(data_provider)
-    duplicate_features = list()
+    points = []
+    for feature in data_provider.getFeatures(
+            feature_request(data_provider, [])):
+        point = feature.geometry().asPoint()
+        points.append((feature.id(), point.x(), point.y()))
+    points.sort()
+
+    fids = [point[0] for point in points]
+    clusters = cluster_points(
+        [point[1] for point in points], [point[2] for point in points],
+        threshold)
+
+    # Clusters with more than one point
+    shared_clusters = set(
+        cluster for index, cluster in enumerate(clusters) if cluster != index)
     unique_features = []
     duplicated_features = []
-    for feature in data_provider.getFeatures():
-        geometry = feature.geometry()
-        rectangle = QgsRectangle(
-            geometry.asPoint().x() - threshold,
-            geometry.asPoint().y() - threshold,
-            geometry.asPoint().x() + threshold,
-            geometry.asPoint().y() + threshold
-        )
-        duplicate_feature = output_spatial_index.intersects(rectangle)
-        if len(duplicate_feature) > 1:
-            duplicate_feature.sort()
-            if duplicate_feature not in duplicate_features:
-                duplicate_features.append(duplicate_feature)
-                unique_features.append(int(duplicate_feature[0]))
-                duplicated_features.extend(duplicate_feature[1:])
-
-    return  unique_features, duplicated_features
+    for index, cluster in enumerate(clusters):
+        if cluster != index:
+            duplicated_features.append(fids[index])
+        elif index in shared_clusters:
+            unique_features.append(fids[index])
+
+    return unique_features, duplicated_features
 
 
 # noinspection PyPep8Naming,PyArgumentList,PyArgumentList
-def identify_features(input_layer, threshold=0, callback=None):
+def identify_features(
+        input_layer,
+        threshold=0,
+        callback=None,
+        cancel_token=None,
+        report=None,
+        intermediate_sink=None,
+        output_sink=None,
+        create_intermediate=True,
+        intermediate_store=None):
     """Identify all features in one functions and put it in a layer.
 
     This function will find node that is an unseparated or ungetrennter (
     germany). The definition of this type is a node that located in a line (
     not in the start or end of a line).
 
+    The layer is read once into a StreamNetwork and all the rules are run
+    on it.
+
     :param input_layer: A vector line layer.
     :type input_layer: QGISVectorLayer
 
@@ -1106,112 +1395,196 @@ def identify_features(input_layer, threshold=0, callback=None):
         None.
     :type callback: function
 
+    :param cancel_token: Optional token checked while running, to stop the
+        computation when it is cancelled.
+    :type cancel_token: CancellationToken
+
+    :param report: Optional run report. The wall time, CPU time, peak
+        memory, memory change and item counts of every stage are recorded
+        in it, see stream_report.RunReport.
+    :type report: RunReport
+
+    :param intermediate_sink: Optional sink receiving the nodes of the
+        intermediate layer, see stream_output. Defaults to a MemorySink.
+    :type intermediate_sink: MemorySink, FileSink
+
+    :param output_sink: Optional sink receiving the identified features.
+        Defaults to a MemorySink.
+    :type output_sink: MemorySink, FileSink
+
+    :param create_intermediate: If False, the intermediate layer is not
+        created and None is returned instead. Defaults to True.
+    :type create_intermediate: bool
+
+    :param intermediate_store: Optional empty store, the nodes are kept and
+        classified in it instead of memory, see store_network_nodes. The
+        intermediate layer is then its nodes table and intermediate_sink is
+        not used.
+    :type intermediate_store: NodeStore
+
+    :raises: ExtractionCancelled if cancel_token is cancelled.
+
     :returns: A tuple of an intermediate layer that contains nodes and Map
     layer (memory layer) containing identified features.
     :rtype: tuple
 
     """
-    intermediate_layer = create_intermediate_layer(
-        input_layer, threshold, callback)
-    authority_id = input_layer.crs().authid()
+    network = StreamNetwork(input_layer, cancel_token, report)
+    authority_id = network.authority_id
+    intermediate_layer = None
+    if intermediate_store is None:
+        nodes = network.associate(threshold, callback, cancel_token, report)
+        if create_intermediate:
+            intermediate_layer = create_associated_nodes_layer(
+                authority_id, nodes, intermediate_sink, report)
+    else:
+        nodes = store_network_nodes(
+            intermediate_store,
+            network,
+            threshold,
+            callback,
+            cancel_token,
+            report)
+        if create_intermediate:
+            intermediate_layer = intermediate_store.layer(
+                tr('Intermediate layer'))
 
     index = 1
     rule_count = 4
     # Find self intersections
     message = tr('Finding self intersections...')
     callback(current=index, maximum=rule_count, message=message)
-    self_intersections = identify_self_intersections_layer(input_layer)
+    with report_stage(report, 'self_intersections') as stage:
+        self_intersections = network.self_intersections(
+            cancel_token=cancel_token)
+        stage.count('points', len(self_intersections))
     index += 1
 
     # Find segment centers
     message = tr('Finding segment centers...')
     callback(current=index, maximum=rule_count, message=message)
-    segment_centers = identify_segment_centers(input_layer)
+    with report_stage(report, 'segment_centers') as stage:
+        segment_centers = network.segment_centers(cancel_token)
+        stage.count('points', len(segment_centers))
     index += 1
 
     # Find intersections
     message = tr('Finding intersections...')
     callback(current=index, maximum=rule_count, message=message)
-    intersections = identify_intersections(input_layer)
+    with report_stage(report, 'intersections') as stage:
+        statistics = {}
+        intersections = network.intersections(
+            statistics, cancel_token=cancel_token)
+        stage.count('points', len(intersections))
+        for name in ['tested_pairs', 'pruned_pairs']:
+            stage.count(name, statistics[name])
     index += 1
 
-    # create output layer
-    layer_name = tr('Stream Features')
-    field_id = 'field=id:integer'
-    field_x = 'field=x:double'
-    field_y = 'field=y:double'
-    field_type = 'field=type:string(30)'
+    if cancel_token is not None:
+        cancel_token.check()
+    message = tr('Finding Unseparated...')
+    callback(current=index, maximum=rule_count, message=message)
+    output_layer = create_output_layer(
+        authority_id,
+        nodes,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold,
+        report,
+        output_sink)
 
-    uri = ('Point?crs=%s&index=yes&%s&%s&%s&%s' % (
-        authority_id, field_id, field_x, field_y, field_type))
+    return intermediate_layer, output_layer
 
-    output_layer = QgsVectorLayer(uri, layer_name, 'memory')
 
-    # Start edit layer
-    output_data_provider = output_layer.dataProvider()
-    output_layer.startEditing()
+def output_fields():
+    """Return the attributes of the identified features.
 
-    type_index = output_layer.fieldNameIndex('type')
+    :returns: The id, x, y and type fields.
+    :rtype: list of QgsField
+    """
+    return [
+        QgsField('id', QVariant.Int),
+        QgsField('x', QVariant.Double),
+        QgsField('y', QVariant.Double),
+        QgsField('type', QVariant.String, 'string', 30)]
 
-    new_features = create_new_features(
-        intermediate_layer, self_intersections, intersections, segment_centers)
 
-    output_data_provider.addFeatures(new_features)
-    output_layer.updateFields()
-    output_layer.commitChanges()
+def create_features_layer(authority_id):
+    """Create the empty memory layer holding the identified features.
 
-    message = tr('Finding Unseparated...')
-    callback(current=index, maximum=rule_count, message=message)
-    # How to find unseparated
-    # Basically, unseparated is an intersection point in well or sink. So,
-    # we find duplicate points, and replace it with Unseparated.
-    unique_features, duplicated_features = get_duplicate_points(
-        output_layer, threshold)
+    :param authority_id: The authority id of the layer crs.
+    :type authority_id: str
 
-    # Deleting duplicated features
-    duplicated_features = [int(x) for x in duplicated_features]
-    output_data_provider.deleteFeatures(duplicated_features)
+    :returns: Point memory layer with the id, x, y and type attributes.
+    :rtype: QgsVectorLayer
+    """
+    sink = MemorySink()
+    sink.open(tr('Stream Features'), authority_id, output_fields())
+    return sink.close()
 
-    # Replacing them with unseparated
-    dictionary_attributes = {}
-    attributes = {type_index: tr('Unseparated')}
 
-    for true_feature in unique_features:
-        dictionary_attributes[true_feature] = attributes
-    output_data_provider.changeAttributeValues(dictionary_attributes)
-    output_layer.updateFields()
+def create_output_layer(
+        authority_id,
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold,
+        report=None,
+        sink=None):
+    """Create the output layer of identify_features.
 
-    # Re write the id
-    features = output_layer.getFeatures()
-    dictionary_attributes = {}
-    i = 1
-    for feature in features:
-        attributes = {0: i}
-        dictionary_attributes[feature.id()] = attributes
-        feature.setFeatureId(i - 1)
-        i += 1
-    output_data_provider.changeAttributeValues(dictionary_attributes)
+    :param authority_id: The authority id of the layer crs.
+    :type authority_id: str
 
-    output_layer.updateFields()
-    output_layer.commitChanges()
+    :param intermediate_layer: An intermediate layer or its nodes, see
+        create_output_points.
+    :type intermediate_layer: QgsVectorLayer, AssociatedNodes, NodeStore
 
-    return intermediate_layer, output_layer
+    :param self_intersections: List of self_intersection points.
+    :type self_intersections: list
+
+    :param intersections: List of intersection points.
+    :type intersections: list
 
+    :param segment_centers: List of segment_center points.
+    :type segment_centers: list
 
-def is_line_layer(layer):
-    """Check if a QGIS layer is vector and its geometries are lines.
+    :param threshold: Distance threshold for merging duplicate points.
+    :type threshold: float
 
-    :param layer: A vector layer.
-    :type layer: QgsVectorLayer, QgsMapLayer
+    :param report: Optional run report, see create_new_points. The
+        output_layer stage is recorded in it too.
+    :type report: RunReport
 
-    :returns: True if the layer contains lines, otherwise False.
-    :rtype: bool
+    :param sink: Optional sink receiving the features, see stream_output.
+        Defaults to a MemorySink.
+    :type sink: MemorySink, FileSink
+
+    :returns: Layer containing the identified features.
+    :rtype: QgsVectorLayer
     """
-    try:
-        return (layer.type() == QgsMapLayer.VectorLayer) and (
-            layer.geometryType() == QGis.Line)
-    except AttributeError:
-        return False
+    if sink is None:
+        sink = MemorySink()
+
+    # The points and their features are generated while they are written
+    # to the sink, see iter_new_points.
+    points = iter_new_points(
+        intermediate_layer,
+        self_intersections,
+        intersections,
+        segment_centers,
+        threshold,
+        report)
+
+    with report_stage(report, 'output_layer') as stage:
+        sink.open(tr('Stream Features'), authority_id, output_fields())
+        sink.add_features(create_output_features(points))
+        output_layer = sink.close()
+        stage.count('features', sink.count)
+
+    return output_layer
 
 
 def console_progress_callback(current, maximum, message=None):
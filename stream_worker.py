@@ -0,0 +1,130 @@
+# coding=utf-8
+"""
+Background worker running the feature extraction outside of the GUI thread.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import logging
+
+from PyQt4.QtCore import QObject, QCoreApplication, pyqtSignal
+
+from stream_utilities import (
+    identify_features,
+    CancellationToken,
+    ExtractionCancelled)
+from stream_report import RunReport
+from stream_cache import identify_features_cached
+
+LOGGER = logging.getLogger('QGIS')
+
+
+class ExtractorWorker(QObject):
+    """Worker calling identify_features, to be moved to a QThread.
+
+    Progress is reported with the progress signal. When the extraction is
+    done the resulting layers are moved to the main thread and handed over
+    with the finished signal.
+    """
+
+    # current, maximum, message (str or None)
+    progress = pyqtSignal(int, int, object)
+    # intermediate layer, output layer
+    finished = pyqtSignal(object, object)
+    # error message
+    error = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, layer, threshold, cache=None, create_intermediate=True):
+        """Constructor.
+
+        :param layer: A vector line layer.
+        :type layer: QgsVectorLayer
+
+        :param threshold: Distance threshold for node snapping.
+        :type threshold: float
+
+        :param cache: Optional result cache. The result of an unchanged layer
+            is then read from the cache instead of computed again.
+        :type cache: ResultCache
+
+        :param create_intermediate: If False, the intermediate layer is not
+            created and None is handed over instead. Defaults to True.
+        :type create_intermediate: bool
+        """
+        QObject.__init__(self)
+        self.layer = layer
+        self.threshold = threshold
+        self.cache = cache
+        self.create_intermediate = create_intermediate
+        self.cancel_token = CancellationToken()
+        self.report = RunReport()
+
+    def run(self):
+        """Run the extraction. Called when the thread is started."""
+        # noinspection PyBroadException
+        try:
+            if self.cache is None:
+                intermediate_layer, output_layer = identify_features(
+                    self.layer,
+                    threshold=self.threshold,
+                    callback=self.report_progress,
+                    cancel_token=self.cancel_token,
+                    report=self.report,
+                    create_intermediate=self.create_intermediate)
+            else:
+                intermediate_layer, output_layer = identify_features_cached(
+                    self.cache,
+                    self.layer,
+                    threshold=self.threshold,
+                    callback=self.report_progress,
+                    cancel_token=self.cancel_token,
+                    report=self.report,
+                    create_intermediate=self.create_intermediate)
+        except ExtractionCancelled:
+            LOGGER.debug('Feature extraction cancelled.')
+            self.cancelled.emit()
+            return
+        except Exception as e:
+            LOGGER.exception('A failure occurred calling identify_features.')
+            self.error.emit(str(e))
+            return
+
+        self.report.log(LOGGER)
+        # The layers were created in this thread, they must belong to the
+        # main thread before they are added to the map.
+        main_thread = QCoreApplication.instance().thread()
+        if intermediate_layer is not None:
+            intermediate_layer.moveToThread(main_thread)
+        output_layer.moveToThread(main_thread)
+        self.finished.emit(intermediate_layer, output_layer)
+
+    def report_progress(self, current, maximum, message=None):
+        """Callback for identify_features, forwarding to the progress signal.
+
+        :param current: Current progress.
+        :type current: int
+
+        :param maximum: Maximum range (point at which task is complete.
+        :type maximum: int
+
+        :param message: Optional message to display in the progress bar
+        :type message: str, QString
+        """
+        self.progress.emit(current, maximum, message)
+
+    def kill(self):
+        """Ask the extraction to stop as soon as possible.
+
+        As a slot it is only called once run returns, when the worker lives
+        in the extraction thread. Cancel cancel_token directly from the
+        other thread instead, it is thread safe.
+        """
+        self.cancel_token.cancel()
@@ -0,0 +1,240 @@
+# coding=utf-8
+"""Deterministic synthetic stream networks for tests and benchmarks.
+
+The networks are built on a staggered lattice (Scheidegger model): every
+lattice node drains to one of its two diagonal neighbours in the row below,
+so the lines form a dendritic network with confluences, pseudo nodes, wells
+and a sink per outlet, and no two lines cross. On top of that:
+
+* braiding makes some nodes drain to both diagonal neighbours (branches),
+* near misses move the downstream end of some lines a little, so whether
+  they are connected depends on the snapping threshold,
+* crossings make some lines swing across the line of their neighbour
+  before reaching their downstream node,
+* self crossings make some lines loop over themselves.
+
+Only the standard library is needed to generate the coordinates, QGIS is
+only imported to create a layer from them.
+"""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import random
+from math import ceil, sqrt
+
+
+def generate_network(
+        line_count,
+        vertices_per_line=2,
+        braiding=0.0,
+        near_miss=0.0,
+        near_miss_distance=0.5,
+        crossing=0.0,
+        self_crossing=0.0,
+        spacing=10.0,
+        seed=0):
+    """Generate the vertices of a synthetic dendritic stream network.
+
+    The same arguments always give the same network.
+
+    :param line_count: Number of lines to generate.
+    :type line_count: int
+
+    :param vertices_per_line: Number of vertices of every line, at least 2.
+    :type vertices_per_line: int
+
+    :param braiding: Probability (0 to 1) that a node also drains to its
+        other diagonal neighbour.
+    :type braiding: float
+
+    :param near_miss: Probability (0 to 1) that the downstream end of a line
+        is moved away from the node it drains to.
+    :type near_miss: float
+
+    :param near_miss_distance: How far a near miss end is moved.
+    :type near_miss_distance: float
+
+    :param crossing: Probability (0 to 1) that a line crosses the line of
+        its neighbour. A crossing line has at least 3 vertices.
+    :type crossing: float
+
+    :param self_crossing: Probability (0 to 1) that a line loops over
+        itself. A self crossing line has 5 vertices and crosses itself
+        once.
+    :type self_crossing: float
+
+    :param spacing: Distance between two lattice rows.
+    :type spacing: float
+
+    :param seed: Seed of the random generator.
+    :type seed: int
+
+    :returns: List of lines, every line is a list of (x, y) tuples going
+        from upstream to downstream.
+    :rtype: list
+    """
+    if vertices_per_line < 2:
+        raise ValueError('A line needs at least 2 vertices.')
+    generator = random.Random(seed)
+    # Roughly as many rows as nodes per row
+    width = 2 * max(1, int(ceil(sqrt(line_count))))
+    lines = []
+    row = 1
+    while len(lines) < line_count:
+        for column in range(row % 2, width, 2):
+            if column == 0:
+                targets = [1]
+            elif column == width - 1:
+                targets = [column - 1]
+            else:
+                targets = [column + generator.choice((-1, 1))]
+                if generator.random() < braiding:
+                    targets = [column - 1, column + 1]
+            for target in targets:
+                start = (column * spacing, row * spacing)
+                end = (target * spacing, (row - 1) * spacing)
+                if generator.random() < near_miss:
+                    end = (end[0], end[1] + near_miss_distance)
+                # The random numbers are only drawn when asked for, so the
+                # networks without crossings do not change.
+                if crossing and generator.random() < crossing:
+                    line = _crossing_vertices(
+                        start, end, spacing, vertices_per_line, generator)
+                elif self_crossing and generator.random() < self_crossing:
+                    line = _self_crossing_vertices(start, end)
+                else:
+                    line = _line_vertices(
+                        start, end, vertices_per_line, generator)
+                lines.append(line)
+                if len(lines) == line_count:
+                    return lines
+        row += 1
+    return lines
+
+
+def _line_vertices(start, end, vertices_per_line, generator):
+    """Return the vertices of a line between start and end.
+
+    The inner vertices are moved a little across the line so that lines
+    with more vertices are not straight.
+
+    :param start: The upstream end of the line.
+    :type start: tuple
+
+    :param end: The downstream end of the line.
+    :type end: tuple
+
+    :param vertices_per_line: Number of vertices, at least 2.
+    :type vertices_per_line: int
+
+    :param generator: The random generator of the network.
+    :type generator: random.Random
+
+    :returns: List of (x, y) tuples.
+    :rtype: list
+    """
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    vertices = [start]
+    for i in range(1, vertices_per_line - 1):
+        fraction = float(i) / (vertices_per_line - 1)
+        jitter = generator.uniform(-0.1, 0.1)
+        vertices.append((
+            start[0] + fraction * dx - jitter * dy,
+            start[1] + fraction * dy + jitter * dx))
+    vertices.append(end)
+    return vertices
+
+
+def _crossing_vertices(start, end, spacing, vertices_per_line, generator):
+    """Return the vertices of a line crossing the line of its neighbour.
+
+    The line first swings half a row down and one and a half columns past
+    its downstream node, across the line starting two columns away in the
+    same direction, then comes back to its downstream node.
+
+    :param start: The upstream end of the line.
+    :type start: tuple
+
+    :param end: The downstream end of the line.
+    :type end: tuple
+
+    :param spacing: Distance between two lattice rows.
+    :type spacing: float
+
+    :param vertices_per_line: Number of vertices, at least 3 are used.
+    :type vertices_per_line: int
+
+    :param generator: The random generator of the network.
+    :type generator: random.Random
+
+    :returns: List of (x, y) tuples.
+    :rtype: list
+    """
+    direction = 1 if end[0] > start[0] else -1
+    swing = (
+        start[0] + 3 * direction * spacing,
+        start[1] - 0.5 * spacing)
+    first_count = max(2, (vertices_per_line + 1) // 2)
+    second_count = max(2, vertices_per_line - first_count + 1)
+    return (
+        _line_vertices(start, swing, first_count, generator) +
+        _line_vertices(swing, end, second_count, generator)[1:])
+
+
+def _self_crossing_vertices(start, end):
+    """Return the vertices of a line looping over itself once.
+
+    :param start: The upstream end of the line.
+    :type start: tuple
+
+    :param end: The downstream end of the line.
+    :type end: tuple
+
+    :returns: List of 5 (x, y) tuples.
+    :rtype: list
+    """
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    # Positions along and across the line, the last segment crosses the
+    # second one at (0.6, 0).
+    loop = [(0, 0), (0.6, 0.2), (0.6, -0.2), (0.4, 0), (1, 0)]
+    return [
+        (start[0] + along * dx - across * dy,
+         start[1] + along * dy + across * dx)
+        for along, across in loop]
+
+
+def create_network_layer(lines, name='Synthetic network', crs='EPSG:32750'):
+    """Create a memory line layer from generated lines.
+
+    :param lines: List of lines as returned by generate_network.
+    :type lines: list
+
+    :param name: Name of the layer.
+    :type name: str
+
+    :param crs: Authority id of the layer crs.
+    :type crs: str
+
+    :returns: A line memory layer with an id attribute.
+    :rtype: QgsVectorLayer
+    """
+    from qgis.core import QgsVectorLayer, QgsFeature, QgsGeometry, QgsPoint
+
+    uri = 'LineString?crs=%s&field=id:integer' % crs
+    layer = QgsVectorLayer(uri, name, 'memory')
+    features = []
+    for line_id, vertices in enumerate(lines):
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry.fromPolyline(
+            [QgsPoint(x, y) for x, y in vertices]))
+        feature.setAttributes([line_id])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
@@ -9,8 +9,10 @@ __copyright__ = 'Copyright 2012, Australia Indonesia Facility for '
 __copyright__ += 'Disaster Reduction'
 
 import os
+import sys
 import unittest
 import logging
+import subprocess
 import ConfigParser
 
 LOGGER = logging.getLogger('QGIS')
@@ -60,5 +62,24 @@ class TestInit(unittest.TestCase):
 
             self.assertIn(expectation, dict(metadata), message)
 
+    def test_lazy_imports(self):
+        """Test that loading the plugin does not import the heavy modules."""
+        modules = subprocess.check_output([
+            sys.executable,
+            '-c',
+            'import sys, custom_logging, stream_feature_extractor; '
+            'print(",".join(sorted(sys.modules)))'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        modules = modules.strip().split(',')
+        for module in [
+                'raven',
+                'numpy',
+                'resources_rc',
+                'stream_utilities',
+                'stream_worker',
+                'stream_options_dialog',
+                'stream_help_dialog']:
+            self.assertNotIn(module, modules)
+
 if __name__ == '__main__':
     unittest.main()
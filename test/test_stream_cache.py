@@ -0,0 +1,143 @@
+# coding=utf-8
+"""Tests for the persistent result cache."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import time
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from qgis.core import QgsGeometry, QgsPoint
+
+from stream_utilities import identify_features
+from stream_cache import ResultCache, content_key, identify_features_cached
+from stream_report import RunReport
+
+from test.synthetic_network import generate_network, create_network_layer
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def silent_callback(current, maximum, message=None):
+    """Progress callback that does nothing.
+
+    :param current: Current progress.
+    :type current: int
+
+    :param maximum: Maximum range (point at which task is complete.
+    :type maximum: int
+
+    :param message: Optional message to display in the progress bar
+    :type message: str, QString
+    """
+    pass
+
+
+def layer_features(layer):
+    """Return the attributes of all the features of a layer.
+
+    :param layer: A vector layer.
+    :type layer: QgsVectorLayer
+
+    :returns: List of the attributes of every feature.
+    :rtype: list
+    """
+    return [feature.attributes() for feature in layer.getFeatures()]
+
+
+class TestStreamCache(unittest.TestCase):
+    """Test the persistent result cache."""
+
+    def setUp(self):
+        """Create an empty cache directory."""
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        """Remove the cache directory."""
+        shutil.rmtree(self.directory)
+
+    def test_content_key(self):
+        """Test that the key changes with the geometries and threshold."""
+        layer = create_network_layer(generate_network(20))
+        key = content_key(layer, 1)
+        self.assertEqual(content_key(layer, 1.0), key)
+        self.assertNotEqual(content_key(layer, 2), key)
+
+        fid = next(layer.getFeatures()).id()
+        layer.dataProvider().changeGeometryValues({
+            fid: QgsGeometry.fromPolyline([QgsPoint(0, 0), QgsPoint(1, 1)])})
+        self.assertNotEqual(content_key(layer, 1), key)
+
+    def test_identify_features_cached(self):
+        """Test that a cached result equals the computed one."""
+        cache = ResultCache(self.directory)
+        layer = create_network_layer(generate_network(100, braiding=0.2))
+        expected_intermediate, expected_output = identify_features(
+            layer, 1, silent_callback)
+
+        identify_features_cached(cache, layer, 1, silent_callback)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        report = RunReport()
+        intermediate_layer, output_layer = identify_features_cached(
+            cache, layer, 1, silent_callback, report=report)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(report.get('cache').counts['hit'], 1)
+        self.assertEqual(
+            layer_features(output_layer), layer_features(expected_output))
+        self.assertEqual(
+            layer_features(intermediate_layer),
+            layer_features(expected_intermediate))
+
+        intermediate_layer, output_layer = identify_features_cached(
+            cache, layer, 1, silent_callback, create_intermediate=False)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertIsNone(intermediate_layer)
+        self.assertEqual(
+            layer_features(output_layer), layer_features(expected_output))
+
+    def test_missing_intermediate_layer(self):
+        """Test that a result without intermediate layer can be a miss."""
+        cache = ResultCache(self.directory)
+        layer = create_network_layer(generate_network(20))
+        identify_features_cached(
+            cache, layer, 1, silent_callback, create_intermediate=False)
+        intermediate_layer, _ = identify_features_cached(
+            cache, layer, 1, silent_callback)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertIsNotNone(intermediate_layer)
+        identify_features_cached(cache, layer, 1, silent_callback)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_corrupt_file(self):
+        """Test that an unreadable file is a miss and is removed."""
+        cache = ResultCache(self.directory)
+        path = cache.path('abc')
+        with open(path, 'wb') as cache_file:
+            cache_file.write('not a gzip file')
+        self.assertIsNone(cache.get('abc'))
+        self.assertEqual(cache.misses, 1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_evict(self):
+        """Test that the least recently used files are removed first."""
+        cache = ResultCache(self.directory, max_bytes=25)
+        for index, key in enumerate(['a', 'b', 'c']):
+            with open(cache.path(key), 'wb') as cache_file:
+                cache_file.write('x' * 10)
+            modified = time.time() - 100 + index
+            os.utime(cache.path(key), (modified, modified))
+        cache.evict()
+        self.assertFalse(os.path.exists(cache.path('a')))
+        self.assertTrue(os.path.exists(cache.path('b')))
+        self.assertTrue(os.path.exists(cache.path('c')))
+
+
+if __name__ == '__main__':
+    unittest.main()
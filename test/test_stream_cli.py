@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Tests for the command line batch extractor."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import stream_utilities
+from stream_cli import parse_arguments, output_paths, main
+from test.utilities_for_testing import get_qgis_app
+
+DATA_TEST_DIR = os.path.join(os.path.dirname(__file__), 'test_data')
+SUNGAI_BARU_SHP = os.path.join(
+    DATA_TEST_DIR, 'small_test', 'sungai_baru.shp')
+RIVER_TEST_SHP = os.path.join(DATA_TEST_DIR, 'River_Test', 'River_Test.shp')
+
+QGIS_APP = get_qgis_app()
+
+
+class TestStreamCli(unittest.TestCase):
+    """Test the command line batch extractor."""
+
+    def test_parse_arguments(self):
+        """Test for parse_arguments."""
+        arguments = parse_arguments(
+            ['-t', '0.5', '-o', 'out', 'a.shp', 'b.shp'])
+        self.assertEqual(arguments.inputs, ['a.shp', 'b.shp'])
+        self.assertEqual(arguments.output, 'out')
+        self.assertEqual(arguments.threshold, 0.5)
+        self.assertEqual(arguments.format, '.shp')
+        self.assertEqual(arguments.processes, 1)
+        self.assertFalse(arguments.intermediate)
+        self.assertFalse(arguments.store)
+        self.assertFalse(arguments.quiet)
+
+    def test_parse_arguments_store(self):
+        """Test that --store needs a single process and no cache."""
+        arguments = parse_arguments(['--store', '-o', 'out', 'a.shp'])
+        self.assertTrue(arguments.store)
+        self.assertRaises(
+            SystemExit,
+            parse_arguments, ['--store', '-p', '2', '-o', 'out', 'a.shp'])
+        self.assertRaises(
+            SystemExit,
+            parse_arguments, ['--store', '--cache', '-o', 'out', 'a.shp'])
+
+    def test_output_paths(self):
+        """Test for output_paths."""
+        features_path, intermediate_path = output_paths(
+            os.path.join('data', 'rivers.shp'), 'out', '.gpkg', True)
+        expected_path = os.path.join('out', 'rivers_features.gpkg')
+        message = 'Expected %s but I got %s' % (expected_path, features_path)
+        self.assertEqual(features_path, expected_path, message)
+        expected_path = os.path.join(
+            'out', 'rivers_features_intermediate.gpkg')
+        message = 'Expected %s but I got %s' % (
+            expected_path, intermediate_path)
+        self.assertEqual(intermediate_path, expected_path, message)
+
+        features_path, intermediate_path = output_paths(
+            'rivers.shp', 'result.shp', '.gpkg', False)
+        self.assertEqual(features_path, 'result.shp')
+        self.assertEqual(intermediate_path, 'result_intermediate.shp')
+
+    def test_main_failing_input(self):
+        """Test that main reports a failing input and processes the next."""
+        processed = []
+
+        def identify_features(layer, *args, **kwargs):
+            """Fail on sungai_baru, record the other layers."""
+            if layer.name() == 'sungai_baru':
+                raise ValueError('Broken geometry')
+            processed.append(layer.name())
+
+        output_directory = tempfile.mkdtemp()
+        original_identify_features = stream_utilities.identify_features
+        stream_cli_stderr = StringIO()
+        stream_utilities.identify_features = identify_features
+        original_stderr, sys.stderr = sys.stderr, stream_cli_stderr
+        try:
+            status = main([
+                '-q', '-o', output_directory,
+                SUNGAI_BARU_SHP, RIVER_TEST_SHP])
+        finally:
+            sys.stderr = original_stderr
+            stream_utilities.identify_features = original_identify_features
+            shutil.rmtree(output_directory)
+
+        self.assertEqual(status, 1)
+        self.assertEqual(processed, ['River_Test'])
+        message = stream_cli_stderr.getvalue()
+        self.assertIn('Failed to process %s' % SUNGAI_BARU_SHP, message)
+        self.assertIn('ValueError: Broken geometry', message)
+
+
+if __name__ == '__main__':
+    unittest.main()
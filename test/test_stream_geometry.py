@@ -0,0 +1,190 @@
+# coding=utf-8
+"""Tests for the geometry core, they do not need QGIS."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import sys
+import unittest
+import subprocess
+
+import numpy
+
+from stream_geometry import (
+    CancellationToken,
+    ExtractionCancelled,
+    Adjacency,
+    NodeArrays,
+    AssociatedNodes,
+    associate_nodes,
+    classify_nodes,
+    find_self_intersections,
+    self_intersection_candidates,
+    segment_center,
+    flatten_lines,
+    line_positions,
+    wkb_line_coordinates,
+    LineVertices)
+
+
+class TestStreamGeometry(unittest.TestCase):
+    """Test the geometry core."""
+
+    def test_no_qgis_import(self):
+        """Test that the core does not import QGIS or Qt."""
+        modules = subprocess.check_output([
+            sys.executable,
+            '-c',
+            'import sys, stream_geometry; '
+            'print(",".join(sorted(sys.modules)))'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        modules = modules.strip().split(',')
+        for module in modules:
+            message = '%s should not be imported' % module
+            self.assertFalse(module.startswith('qgis'), message)
+            self.assertFalse(module.startswith('PyQt4'), message)
+
+    def test_segment_center(self):
+        """Test for segment_center."""
+        center = segment_center([(0, 0), (1, 0), (2, 0)])
+        expected_center = (1, 0)
+        message = 'Expected %s but I got %s' % (expected_center, center)
+        self.assertEqual(center, expected_center, message)
+
+        center = segment_center([(0, 0), (1, 0), (2, 0), (5, 0)])
+        expected_center = (2.5, 0)
+        message = 'Expected %s but I got %s' % (expected_center, center)
+        self.assertEqual(center, expected_center, message)
+
+        self.assertEqual(segment_center([(3, 4)]), (3, 4))
+        self.assertIsNone(segment_center([]))
+
+    def test_line_positions(self):
+        """Test for line_positions."""
+        lines = [
+            [(0, 0), (1, 0), (2, 0), (5, 0)],
+            [],
+            [(3, 4)],
+            [(0, 0), (0, 0), (0, 4)],
+            [(1, 1), (1, 1)],
+            [(0, 0), (4, 0), (4, 4)]]
+        xs, ys, offsets = flatten_lines(lines)
+        self.assertEqual(offsets.tolist(), [0, 4, 4, 5, 8, 10, 13])
+        position_xs, position_ys = line_positions(
+            xs, ys, offsets, [0, 0.25, 0.5, 1])
+        self.assertEqual(position_xs[0].tolist(), [0, 1.25, 2.5, 5])
+        self.assertTrue(numpy.isnan(position_xs[1]).all())
+        self.assertEqual(position_ys[3].tolist(), [0, 1, 2, 4])
+        self.assertEqual(position_xs[4].tolist(), [1, 1, 1, 1])
+        self.assertEqual(position_xs[5].tolist(), [0, 2, 4, 4])
+        self.assertEqual(position_ys[5].tolist(), [0, 0, 0, 4])
+        # The centers are the ones of segment_center
+        for index, vertices in enumerate(lines):
+            if vertices:
+                self.assertEqual(
+                    (position_xs[index][2], position_ys[index][2]),
+                    segment_center(vertices))
+
+    def test_line_vertices(self):
+        """Test for wkb_line_coordinates and LineVertices."""
+        lines = [[(0, 0), (1, 2), (3, 1)], [], [(5, 5)]]
+        vertices = LineVertices(*flatten_lines(lines))
+        wkbs = [vertices.wkb(index) for index in range(len(vertices))]
+        self.assertIsNone(wkb_line_coordinates(''))
+        self.assertIsNone(wkb_line_coordinates(wkbs[0].replace(
+            '\x02', '\x05', 1)))
+        self.assertEqual(
+            wkb_line_coordinates(wkbs[0]).tolist(), [0, 0, 1, 2, 3, 1])
+
+        decoded = LineVertices.from_coordinates(
+            [wkb_line_coordinates(wkb) for wkb in wkbs])
+        self.assertEqual(decoded.offsets.tolist(), [0, 3, 3, 4])
+        self.assertEqual(list(decoded.lines()), lines)
+        self.assertEqual(decoded.bounding_box(0), (0, 0, 3, 2))
+        has_vertices, start_x, start_y, end_x, end_y = decoded.end_points()
+        self.assertEqual(has_vertices.tolist(), [True, False, True])
+        self.assertEqual(start_x.tolist(), [0, 5])
+        self.assertEqual(end_y.tolist(), [1, 5])
+
+    def test_cancellation_token(self):
+        """Test that a cancelled token stops associate_nodes."""
+        token = CancellationToken()
+        token.check()
+        token.cancel()
+        self.assertRaises(
+            ExtractionCancelled,
+            associate_nodes, [0, 1], [0, 0], [True, False], 1, None, token)
+
+    def test_adjacency(self):
+        """Test for Adjacency."""
+        adjacency = Adjacency.from_lists([[1, 2], [], [0]])
+        self.assertEqual(len(adjacency), 3)
+        self.assertEqual(adjacency.offsets.tolist(), [0, 2, 2, 3])
+        self.assertEqual(adjacency.neighbours.tolist(), [1, 2, 0])
+        self.assertEqual(adjacency[0].tolist(), [1, 2])
+        self.assertEqual(adjacency.counts().tolist(), [2, 0, 1])
+        self.assertEqual(adjacency.rows().tolist(), [0, 0, 2])
+        self.assertEqual(adjacency.lists(), [[1, 2], [], [0]])
+        self.assertEqual(adjacency.strings(), ['1,2', '', '0'])
+        self.assertEqual(adjacency, Adjacency.from_lists([[1, 2], [], [0]]))
+        self.assertNotEqual(adjacency, Adjacency.from_lists([[1], [2], [0]]))
+
+    def test_representatives(self):
+        """Test that every group of nearby nodes is reported once."""
+        # Two lines joined at (1, 0) and a line ending near it
+        nodes = NodeArrays(
+            numpy.array([1, 2, 3]),
+            numpy.array([0.0, 1.0, 5.0]),
+            numpy.array([0.0, 0.0, 5.0]),
+            numpy.array([1.0, 2.0, 1.1]),
+            numpy.array([0.0, 0.0, 0.0]))
+        _, xs, ys, upstream = nodes.endpoints()
+        up_nodes, down_nodes, up_num, down_num = associate_nodes(
+            xs, ys, upstream, 0.2)
+        associated_nodes = AssociatedNodes(
+            nodes,
+            up_nodes,
+            down_nodes,
+            up_num,
+            down_num,
+            classify_nodes(up_num, down_num))
+        self.assertEqual(len(associated_nodes), 6)
+        self.assertEqual(associated_nodes.representatives(), [0, 1, 3, 4])
+
+    def test_pipeline(self):
+        """Test the node classification and self intersections."""
+        xs = numpy.array([0.0, 1.0, 1.0, 2.0])
+        ys = numpy.array([0.0, 0.0, 0.0, 0.0])
+        upstream = numpy.array([True, False, True, False])
+        _, _, up_num, down_num = associate_nodes(xs, ys, upstream, 0)
+        flags = classify_nodes(up_num, down_num)
+        self.assertEqual(flags['well'].tolist(), [1, 0, 0, 0])
+        self.assertEqual(flags['pseudo'].tolist(), [0, 1, 1, 0])
+        self.assertEqual(flags['sink'].tolist(), [0, 0, 0, 1])
+
+        vertices = [(0, 0), (4, 4), (4, 0), (0, 4)]
+        self.assertEqual(find_self_intersections(vertices), [(2.0, 2.0)])
+
+    def test_self_intersection_candidates(self):
+        """Test that only overlapping chains are compared on a zig-zag."""
+        # 2000 segments zig-zagging up, each of them is a monotone chain and
+        # all the chains overlap in x.
+        vertices = [(i % 2, i) for i in range(2001)]
+        self.assertEqual(self_intersection_candidates(vertices), [])
+        self.assertEqual(find_self_intersections(vertices), [])
+
+        # Going back down across the zig-zag crosses every segment but the
+        # adjacent one.
+        vertices.append((0.5, -1))
+        candidates = self_intersection_candidates(vertices)
+        self.assertEqual(len(candidates), 1999)
+        self.assertEqual(candidates[0], (0, 2000))
+        self.assertEqual(len(find_self_intersections(vertices)), 1999)
+
+
+if __name__ == '__main__':
+    unittest.main()
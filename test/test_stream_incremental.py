@@ -0,0 +1,85 @@
+# coding=utf-8
+"""Tests for the incremental extraction."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import unittest
+
+from qgis.core import QgsFeature, QgsGeometry, QgsPoint
+
+from stream_utilities import identify_features
+from stream_incremental import IncrementalExtractor
+
+from test.synthetic_network import generate_network, create_network_layer
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def output_points(layer):
+    """Return the sorted x, y and type of the features of an output layer.
+
+    :param layer: An output layer.
+    :type layer: QgsVectorLayer
+
+    :returns: List of (x, y, type) tuples.
+    :rtype: list
+    """
+    return sorted(
+        tuple(feature.attributes()[1:4]) for feature in layer.getFeatures())
+
+
+def line_geometry(vertices):
+    """Return a line geometry.
+
+    :param vertices: List of (x, y) tuples.
+    :type vertices: list
+
+    :returns: The line.
+    :rtype: QgsGeometry
+    """
+    return QgsGeometry.fromPolyline([QgsPoint(x, y) for x, y in vertices])
+
+
+class TestStreamIncremental(unittest.TestCase):
+    """Test the incremental extraction."""
+
+    def test_incremental_extractor(self):
+        """Test that the patched output matches a full extraction."""
+        threshold = 1
+        lines = generate_network(
+            200, vertices_per_line=3, braiding=0.2, near_miss=0.3)
+        layer = create_network_layer(lines)
+        extractor = IncrementalExtractor(layer, threshold)
+        _, expected_layer = identify_features(
+            layer, threshold, lambda **kwargs: None)
+        self.assertEqual(
+            output_points(extractor.output_layer),
+            output_points(expected_layer))
+
+        fids = sorted(feature.id() for feature in layer.getFeatures())
+        layer.startEditing()
+        layer.deleteFeature(fids[3])
+        layer.changeGeometry(
+            fids[10], line_geometry([(0, 0), (35, 42), (80, 20)]))
+        feature = QgsFeature()
+        feature.setGeometry(line_geometry([(5, 5), (60, 70), (60, 0)]))
+        feature.setAttributes([1000])
+        layer.addFeature(feature)
+        # The output is updated when the edits are committed
+        layer.commitChanges()
+
+        _, expected_layer = identify_features(
+            layer, threshold, lambda **kwargs: None)
+        self.assertEqual(
+            output_points(extractor.output_layer),
+            output_points(expected_layer))
+        extractor.disconnect_layer()
+
+
+if __name__ == '__main__':
+    unittest.main()
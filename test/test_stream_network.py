@@ -0,0 +1,91 @@
+# coding=utf-8
+"""Tests for the stream network."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import unittest
+
+from qgis.core import QgsGeometry, QgsPoint, QgsFeatureRequest
+
+from stream_network import StreamNetwork, feature_request
+from stream_utilities import (
+    extract_nodes,
+    identify_self_intersections_layer,
+    identify_segment_centers)
+
+from test.synthetic_network import generate_network, create_network_layer
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class TestStreamNetwork(unittest.TestCase):
+    """Test the stream network."""
+
+    def test_incidence(self):
+        """Test the line to node incidence."""
+        layer = create_network_layer([
+            [(0, 0), (1, 0)],
+            [(1, 0), (2, 0)],
+            [(1.1, 0), (1.1, 1)]])
+        network = StreamNetwork(layer)
+        self.assertEqual(len(network), 3)
+        fids = network.fids
+        self.assertEqual(network.line_nodes(fids[1]), (2, 3))
+        self.assertEqual(network.node_line(3), fids[1])
+        self.assertEqual(
+            network.lines_in(QgsGeometry.fromPoint(
+                QgsPoint(1, 0)).boundingBox()),
+            sorted(fids[:2]))
+
+        network.associate(0.2)
+        # The end of the first line is near the start of the others
+        self.assertEqual(network.nearby_nodes(1), [2, 4])
+        self.assertEqual(
+            network.associated_nodes.flags['well'].tolist(),
+            [1, 0, 0, 0, 0, 0])
+
+    def test_feature_request(self):
+        """Test for feature_request."""
+        layer = create_network_layer(generate_network(10))
+        request = feature_request(layer)
+        self.assertFalse(request.flags() & QgsFeatureRequest.NoGeometry)
+        self.assertFalse(
+            request.flags() & QgsFeatureRequest.SubsetOfAttributes)
+
+        request = feature_request(layer, ['id'], geometry=False)
+        self.assertTrue(request.flags() & QgsFeatureRequest.NoGeometry)
+        self.assertTrue(
+            request.flags() & QgsFeatureRequest.SubsetOfAttributes)
+        self.assertEqual(list(request.subsetOfAttributes()), [0])
+        for feature in layer.getFeatures(request):
+            self.assertIsNone(feature.geometry())
+
+    def test_rules(self):
+        """Test that the network gives the results of the layer functions."""
+        layer = create_network_layer(generate_network(100, braiding=0.2))
+        network = StreamNetwork(layer)
+
+        node_arrays = extract_nodes(layer, columnar=True)
+        self.assertEqual(
+            network.nodes.line_ids.tolist(), node_arrays.line_ids.tolist())
+        self.assertEqual(
+            network.nodes.end_x.tolist(), node_arrays.end_x.tolist())
+        self.assertEqual(
+            network.self_intersections(),
+            identify_self_intersections_layer(layer))
+        self.assertEqual(
+            network.segment_centers(), identify_segment_centers(layer))
+
+        statistics = {}
+        network.intersections(statistics)
+        # Every geometry is rebuilt once from the vertices
+        self.assertEqual(statistics['cache_misses'], len(network))
+
+
+if __name__ == '__main__':
+    unittest.main()
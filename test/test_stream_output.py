@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Tests for the output sinks."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from qgis.core import QgsFeature, QgsGeometry, QgsPoint
+
+from stream_utilities import identify_features, output_fields
+from stream_output import MemorySink, FileSink
+
+from test.synthetic_network import generate_network, create_network_layer
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def layer_features(layer):
+    """Return the attributes of all the features of a layer.
+
+    :param layer: A vector layer.
+    :type layer: QgsVectorLayer
+
+    :returns: List of the attributes of every feature.
+    :rtype: list
+    """
+    return [feature.attributes() for feature in layer.getFeatures()]
+
+
+class RecordingSink(MemorySink):
+    """Memory sink recording the size of the written chunks."""
+
+    def __init__(self, chunk_size):
+        """Constructor.
+
+        :param chunk_size: Number of features buffered before they are
+            written.
+        :type chunk_size: int
+        """
+        super(RecordingSink, self).__init__(chunk_size)
+        self.chunks = []
+
+    def write(self, features):
+        """Record the chunk, then add it to the memory layer."""
+        self.chunks.append(len(features))
+        super(RecordingSink, self).write(features)
+
+
+class TestStreamOutput(unittest.TestCase):
+    """Test the output sinks."""
+
+    def setUp(self):
+        """Create an empty output directory."""
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        """Remove the output directory."""
+        shutil.rmtree(self.directory)
+
+    def test_memory_sink(self):
+        """Test that the features are written in chunks."""
+        sink = RecordingSink(4)
+        sink.open('points', 'EPSG:4326', output_fields())
+        for index in range(10):
+            feature = QgsFeature()
+            feature.setGeometry(QgsGeometry.fromPoint(QgsPoint(index, 0)))
+            feature.setAttributes([index, index, 0, 'Well'])
+            sink.add_feature(feature)
+        self.assertEqual(sink.chunks, [4, 4])
+        layer = sink.close()
+        self.assertEqual(sink.chunks, [4, 4, 2])
+        self.assertEqual(sink.count, 10)
+        self.assertEqual(layer.featureCount(), 10)
+
+    def test_file_sink(self):
+        """Test that identify_features can write to files."""
+        layer = create_network_layer(generate_network(100, braiding=0.2))
+        expected_intermediate, expected_output = identify_features(
+            layer, 1, lambda **kwargs: None)
+
+        output_path = os.path.join(self.directory, 'features.shp')
+        intermediate_path = os.path.join(self.directory, 'nodes.shp')
+        intermediate_layer, output_layer = identify_features(
+            layer,
+            1,
+            lambda **kwargs: None,
+            intermediate_sink=FileSink(intermediate_path, chunk_size=50),
+            output_sink=FileSink(output_path, chunk_size=50))
+        self.assertTrue(os.path.exists(output_path))
+        self.assertEqual(
+            layer_features(output_layer), layer_features(expected_output))
+        self.assertEqual(
+            layer_features(intermediate_layer),
+            layer_features(expected_intermediate))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# coding=utf-8
+"""Tests for the tiled multi process extraction."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import unittest
+from multiprocessing import Pool
+
+import numpy
+from qgis.core import QgsVectorLayer
+
+from stream_utilities import associate_nodes, identify_features
+from stream_parallel import (
+    TileGrid,
+    associate_nodes_parallel,
+    identify_features_parallel)
+
+from test.synthetic_network import generate_network
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+DATA_TEST_DIR = os.path.join(os.path.dirname(__file__), 'test_data')
+SUNGAI_BARU_SHP = os.path.join(
+    DATA_TEST_DIR, 'small_test', 'sungai_baru.shp')
+RIVER_TEST_SHP = os.path.join(DATA_TEST_DIR, 'River_Test', 'River_Test.shp')
+
+
+def output_features(layer):
+    """Return the attributes of all the features of an output layer.
+
+    :param layer: An output layer of identify_features.
+    :type layer: QgsVectorLayer
+
+    :returns: List of the attributes of every feature.
+    :rtype: list
+    """
+    return [feature.attributes() for feature in layer.getFeatures()]
+
+
+class TestStreamParallel(unittest.TestCase):
+    """Test the tiled multi process extraction."""
+
+    def test_tile_grid(self):
+        """Test for TileGrid."""
+        grid = TileGrid(0, 0, 100, 50, 4)
+        self.assertEqual(len(grid), 4)
+        self.assertEqual(grid.tile(0, 0), 0)
+        self.assertEqual(grid.tile(60, 10), 1)
+        self.assertEqual(grid.tile(10, 30), 2)
+        # The border of the extent belongs to the last tiles
+        self.assertEqual(grid.tile(100, 50), 3)
+
+        members = grid.members(
+            numpy.array([10.0, 40.0]), numpy.array([10.0, 10.0]),
+            numpy.array([20.0, 60.0]), numpy.array([20.0, 20.0]))
+        members = [(tile, list(indices)) for tile, indices in members]
+        self.assertEqual(members, [(0, [0, 1]), (1, [1])])
+
+    def test_associate_nodes_parallel(self):
+        """Test that associate_nodes_parallel gives the serial result."""
+        lines = generate_network(
+            5000, braiding=0.1, near_miss=0.2, near_miss_distance=0.5)
+        xs = []
+        ys = []
+        upstream = []
+        for line in lines:
+            xs.extend([line[0][0], line[-1][0]])
+            ys.extend([line[0][1], line[-1][1]])
+            upstream.extend([True, False])
+
+        pool = Pool(2)
+        try:
+            for threshold in [0, 0.4, 1, 15]:
+                expected = associate_nodes(xs, ys, upstream, threshold)
+                result = associate_nodes_parallel(
+                    pool, 9, xs, ys, upstream, threshold)
+                self.assertEqual(result[0], expected[0])
+                self.assertEqual(result[1], expected[1])
+                self.assertEqual(list(result[2]), list(expected[2]))
+                self.assertEqual(list(result[3]), list(expected[3]))
+        finally:
+            pool.terminate()
+
+    def test_identify_features_parallel(self):
+        """Test that identify_features_parallel gives the serial result."""
+        for path, threshold in [(SUNGAI_BARU_SHP, 1), (RIVER_TEST_SHP, 0)]:
+            layer = QgsVectorLayer(path, 'lines', 'ogr')
+            _, expected_layer = identify_features(
+                layer, threshold, lambda **kwargs: None)
+            _, output_layer = identify_features_parallel(
+                layer, threshold, processes=2)
+            self.assertEqual(
+                output_features(output_layer),
+                output_features(expected_layer))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# coding=utf-8
+"""Tests for the run report."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import logging
+import unittest
+
+from stream_report import RunReport, report_stage, STATM_PATH
+
+
+class ListHandler(logging.Handler):
+    """Logging handler keeping the messages in a list."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestStreamReport(unittest.TestCase):
+    """Test the run report."""
+
+    def test_stage(self):
+        """Test for RunReport.stage."""
+        report = RunReport()
+        with report.stage('first') as stage:
+            sum(range(100000))
+            stage.count('items', 100000)
+        with report.stage('second'):
+            pass
+
+        self.assertEqual(
+            [stage.name for stage in report.stages], ['first', 'second'])
+        first = report.get('first')
+        self.assertGreater(first.wall_time, 0)
+        self.assertGreaterEqual(first.cpu_time, 0)
+        self.assertEqual(first.counts['items'], 100000)
+        self.assertIsNone(report.get('third'))
+
+        if os.path.exists(STATM_PATH):
+            # Hold about 80 MiB until the end of the stage
+            with report.stage('allocate'):
+                data = bytearray(80 * 1024 * 1024)
+                data[::4096] = 'x' * len(data[::4096])
+            del data
+            self.assertGreater(
+                report.get('allocate').memory_delta, 60 * 1024)
+
+            # Memory freed within the stage only shows in its peak
+            with report.stage('allocate_and_free'):
+                data = bytearray(160 * 1024 * 1024)
+                data[::4096] = 'x' * len(data[::4096])
+                del data
+            stage = report.get('allocate_and_free')
+            self.assertGreater(stage.peak_memory, 60 * 1024)
+            self.assertLess(stage.memory_delta, 60 * 1024)
+
+        result = report.as_dict()
+        self.assertEqual(result['stages'][0]['name'], 'first')
+        self.assertEqual(result['stages'][0]['counts'], {'items': 100000})
+        self.assertIn('peak_memory', result['stages'][0])
+        self.assertIn('memory_delta', result['stages'][0])
+        self.assertIn('process_peak_memory', result['stages'][0])
+
+    def test_stage_error(self):
+        """Test that a stage is recorded when it raises."""
+        report = RunReport()
+
+        def failing():
+            with report.stage('failing'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, failing)
+        self.assertEqual(len(report.stages), 1)
+
+    def test_report_stage(self):
+        """Test for report_stage."""
+        with report_stage(None, 'ignored') as stage:
+            stage.count('items', 1)
+
+        report = RunReport()
+        with report_stage(report, 'recorded') as stage:
+            stage.count('items', 1)
+        self.assertEqual(report.get('recorded').counts['items'], 1)
+
+    def test_log(self):
+        """Test for RunReport.log."""
+        report = RunReport()
+        with report.stage('first') as stage:
+            stage.count('items', 3)
+        logger = logging.getLogger('test_stream_report')
+        handler = ListHandler()
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        report.log(logger)
+        logger.removeHandler(handler)
+
+        self.assertEqual(len(handler.messages), 1)
+        self.assertTrue(
+            handler.messages[0].startswith('Stage first: '),
+            handler.messages[0])
+        self.assertTrue(handler.messages[0].endswith(', items 3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
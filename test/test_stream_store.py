@@ -0,0 +1,99 @@
+# coding=utf-8
+"""Tests for the SQLite node store."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from stream_network import StreamNetwork
+from stream_store import NodeStore
+from stream_utilities import identify_features, store_network_nodes
+
+from test.synthetic_network import generate_network, create_network_layer
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def silent_callback(current, maximum, message=None):
+    """Progress callback that does nothing.
+
+    :param current: Current progress.
+    :type current: int
+
+    :param maximum: Maximum range (point at which task is complete.
+    :type maximum: int
+
+    :param message: Optional message to display in the progress bar
+    :type message: str, QString
+    """
+    pass
+
+
+def layer_features(layer):
+    """Return the attributes of all the features of a layer.
+
+    :param layer: A vector layer.
+    :type layer: QgsVectorLayer
+
+    :returns: List of the attributes of every feature.
+    :rtype: list
+    """
+    return [feature.attributes() for feature in layer.getFeatures()]
+
+
+class TestStreamStore(unittest.TestCase):
+    """Test the SQLite node store."""
+
+    def setUp(self):
+        """Create an empty directory for the stores."""
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        """Remove the directory."""
+        shutil.rmtree(self.directory)
+
+    def test_store_network_nodes(self):
+        """Test that the store finds the nodes found in memory."""
+        layer = create_network_layer(generate_network(100, braiding=0.2))
+        network = StreamNetwork(layer)
+        nodes = network.associate(1)
+
+        store = NodeStore(batch_size=7)
+        store_network_nodes(store, network, 1)
+        self.assertEqual(store.node_count, len(nodes))
+        for node in range(len(nodes)):
+            self.assertEqual(
+                store.neighbours(node), network.nearby_nodes(node))
+        x, y = nodes.xs[0], nodes.ys[0]
+        self.assertIn(0, [row[0] for row in store.nearby(x, y, 0)])
+
+        path = store.path
+        store.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_identify_features(self):
+        """Test that the output does not change with a store."""
+        layer = create_network_layer(generate_network(100, braiding=0.2))
+        _, expected_layer = identify_features(layer, 1, silent_callback)
+
+        path = os.path.join(self.directory, 'nodes.sqlite')
+        store = NodeStore(path, batch_size=7)
+        intermediate_layer, output_layer = identify_features(
+            layer, 1, silent_callback, intermediate_store=store)
+        self.assertEqual(
+            layer_features(output_layer), layer_features(expected_layer))
+        self.assertEqual(intermediate_layer.featureCount(), 200)
+        store.close()
+        self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,21 +30,33 @@ from stream_utilities import (
     str_to_list,
     add_layer_attribute,
     extract_nodes,
+    NodeArrays,
     create_nodes_layer,
     get_nearby_nodes,
+    NodeGrid,
+    associate_nodes,
     add_associated_nodes,
     check_associated_attributes,
+    classify_nodes,
+    identify_nodes,
     identify_wells,
     identify_sinks,
     identify_branches,
     identify_confluences,
     identify_pseudo_nodes,
     identify_watersheds,
+    find_self_intersections,
     identify_self_intersections,
     identify_segment_center,
     identify_features,
     console_progress_callback,
-    identify_intersections)
+    identify_intersections,
+    deduplicate_points,
+    cluster_points,
+    merge_duplicate_points,
+    CancellationToken,
+    ExtractionCancelled)
+from stream_report import RunReport
 
 from test.utilities_for_testing import get_qgis_app
 
@@ -300,6 +312,28 @@ class TestStreamUtilities(unittest.TestCase):
         assert len(nodes) == len(expected_nodes), (
             'Number of nodes should be %d' % len(expected_nodes))
 
+    def test_extract_nodes_columnar(self):
+        """Test for extracting nodes as NodeArrays."""
+        layer = self.sungai_layer
+        nodes = extract_nodes(layer=layer)
+        node_arrays = extract_nodes(layer=layer, columnar=True)
+        self.assertIsInstance(node_arrays, NodeArrays)
+        message = 'Number of nodes should be %d' % len(nodes)
+        self.assertEqual(len(node_arrays), len(nodes), message)
+        for i, node in enumerate(nodes):
+            self.assertEqual(node_arrays.line_ids[i], node[0])
+            self.assertEqual(node_arrays.start_x[i], node[1].x())
+            self.assertEqual(node_arrays.start_y[i], node[1].y())
+            self.assertEqual(node_arrays.end_x[i], node[2].x())
+            self.assertEqual(node_arrays.end_y[i], node[2].y())
+
+        line_ids, xs, ys, upstream = node_arrays.endpoints()
+        self.assertEqual(len(xs), 2 * len(nodes))
+        self.assertEqual(line_ids[1], nodes[0][0])
+        self.assertEqual(xs[1], nodes[0][2].x())
+        self.assertEqual(ys[1], nodes[0][2].y())
+        self.assertListEqual(upstream[:4].tolist(), [True, False] * 2)
+
     @unittest.expectedFailure
     def test_extract_nodes_dgn(self):
         """Test for extracting nodes using dgn dataset."""
@@ -370,6 +404,62 @@ class TestStreamUtilities(unittest.TestCase):
         self.assertItemsEqual(
             downstream_nodes, expected_downstream_nodes, message)
 
+    def test_node_grid(self):
+        """Test for NodeGrid."""
+        xs = [0, 0.5, 1.5, 1.0, 3]
+        ys = [0, 0.5, 0, 1.0, 3]
+        grid = NodeGrid(xs, ys, 1)
+        nearby = grid.nearby(0, 0)
+        expected_nearby = [0, 1, 3]
+        message = 'Expected %s but I got %s' % (expected_nearby, nearby)
+        self.assertEqual(nearby, expected_nearby, message)
+
+        nearby = grid.nearby(3, 2)
+        expected_nearby = [4]
+        message = 'Expected %s but I got %s' % (expected_nearby, nearby)
+        self.assertEqual(nearby, expected_nearby, message)
+
+        # With zero threshold only coincident points are nearby
+        grid = NodeGrid([1, 1, 1.5], [2, 2, 2], 0)
+        nearby = grid.nearby(1, 2)
+        expected_nearby = [0, 1]
+        message = 'Expected %s but I got %s' % (expected_nearby, nearby)
+        self.assertEqual(nearby, expected_nearby, message)
+
+    def test_node_grid_keyed(self):
+        """Test for NodeGrid.empty, add and remove."""
+        grid = NodeGrid.empty(1)
+        grid.add('a', 0, 0)
+        grid.add('b', 0.5, 1)
+        grid.add('c', 1.4, 1.5)
+        grid.add('d', 5, 5)
+        self.assertEqual(grid.nearby(0, 0), ['a', 'b'])
+        self.assertEqual(grid['c'], (1.4, 1.5))
+        self.assertEqual(grid.components(['a']), set(['a', 'b', 'c']))
+        self.assertEqual(grid.remove('b'), (0.5, 1))
+        self.assertEqual(grid.components(['a']), set(['a']))
+        self.assertNotIn('b', grid)
+
+        # With zero threshold only coincident points are nearby
+        grid = NodeGrid.empty(0)
+        grid.add('a', 1, 2)
+        grid.add('b', 1, 2)
+        grid.add('c', 1.5, 2)
+        self.assertEqual(grid.nearby(1, 2), ['a', 'b'])
+        self.assertEqual(grid.components(['c']), set(['c']))
+
+    def test_associate_nodes(self):
+        """Test for associate_nodes."""
+        xs = [0, 1, 1, 2, 1]
+        ys = [0, 0, 0, 0, 1]
+        upstream = [True, False, True, False, True]
+        up_nodes, down_nodes, up_num, down_num = associate_nodes(
+            xs, ys, upstream, 0.1)
+        self.assertEqual(up_nodes.lists(), [[], [2], [], [], []])
+        self.assertEqual(down_nodes.lists(), [[], [], [1], [], []])
+        self.assertEqual(up_num.tolist(), [1, 1, 1, 0, 1])
+        self.assertEqual(down_num.tolist(), [0, 1, 1, 1, 0])
+
     def test_check_associated_attributes(self):
         """Test for check_associated_attributes"""
         nodes_layer = get_temp_shapefile_layer(JAWA_NODES_SHP, 'nodes')
@@ -552,6 +642,53 @@ class TestStreamUtilities(unittest.TestCase):
                     watershed_value,
                     'Node %s Should not be a watershed' % node_id)
 
+    def test_classify_nodes(self):
+        """Test for classify_nodes."""
+        up_num = [1, 0, 2, 1, 1, 2, 2]
+        down_num = [0, 1, 1, 2, 1, 0, 2]
+        flags = classify_nodes(up_num, down_num)
+        expected_flags = {
+            'well': [1, 0, 0, 0, 0, 0, 0],
+            'sink': [0, 1, 0, 0, 0, 0, 0],
+            'branch': [0, 0, 1, 0, 0, 0, 0],
+            'confluence': [0, 0, 0, 1, 0, 0, 0],
+            'pseudo': [0, 0, 0, 0, 1, 0, 0],
+            'watershed': [0, 0, 0, 0, 0, 1, 0],
+            'unclear_bi': [0, 0, 0, 0, 0, 0, 1]
+        }
+        for attribute, expected_values in expected_flags.items():
+            values = flags[attribute].tolist()
+            message = 'Expected %s for %s but I got %s' % (
+                expected_values, attribute, values)
+            self.assertEqual(values, expected_values, message)
+
+    def test_identify_nodes(self):
+        """Test for identify_nodes method."""
+        nodes_layer = get_temp_shapefile_layer(JAWA_NODES_SHP, 'nodes')
+        add_associated_nodes(nodes_layer, THRESHOLD)
+        identify_nodes(nodes_layer)
+
+        id_index = nodes_layer.fieldNameIndex('id')
+        expected_nodes = {
+            'well': [0, 10],
+            'sink': [3, 7],
+            'branch': [4, 6, 9],
+            'confluence': [1, 2, 5],
+            'pseudo': [8, 11],
+            'watershed': [],
+        }
+        for attribute, expected_ids in expected_nodes.items():
+            attribute_index = nodes_layer.fieldNameIndex(attribute)
+            ids = [
+                feature.attributes()[id_index]
+                for feature in nodes_layer.getFeatures()
+                if feature.attributes()[attribute_index] == 1]
+            message = 'Expected %s for %s but I got %s' % (
+                expected_ids, attribute, ids)
+            self.assertItemsEqual(ids, expected_ids, message)
+
+        remove_temp_layer(nodes_layer.source())
+
     # noinspection PyArgumentList,PyCallByClass,PyTypeChecker
     def test_identify_self_intersections(self):
         """Test for identify_self_intersections."""
@@ -576,6 +713,21 @@ class TestStreamUtilities(unittest.TestCase):
             self.assertListEqual(
                 intersections, expected_intersections, message)
 
+    def test_find_self_intersections(self):
+        """Test for find_self_intersections."""
+        vertices = [(0, 0), (4, 4), (4, 0), (0, 4), (2, 6), (3, 5), (0, 2)]
+        intersections = find_self_intersections(vertices)
+        expected_intersections = [(2.0, 2.0), (1.0, 3.0)]
+        message = 'Expected %s but I got %s' % (
+            expected_intersections, intersections)
+        self.assertListEqual(intersections, expected_intersections, message)
+
+        # Parallel and touching segments are not intersections
+        vertices = [(0, 0), (2, 0), (2, 1), (0, 1), (1, 0)]
+        intersections = find_self_intersections(vertices)
+        message = 'Expected no intersection but I got %s' % intersections
+        self.assertListEqual(intersections, [], message)
+
     # noinspection PyArgumentList,PyCallByClass,PyTypeChecker
     def test_identify_segment_center(self):
         """Test for identify_segment_center."""
@@ -670,6 +822,67 @@ class TestStreamUtilities(unittest.TestCase):
 
         remove_temp_layer(sungai_layer.source())
 
+    def test_identify_features_cancelled(self):
+        """Test that identify_features stops when it is cancelled."""
+        sungai_layer = get_temp_shapefile_layer(
+            SUNGAI_BARU_SHP, 'sungai_baru')
+        cancel_token = CancellationToken()
+        cancel_token.cancel()
+        message = 'Expect ExtractionCancelled, but not found'
+        self.assertRaises(
+            ExtractionCancelled,
+            lambda: identify_features(
+                sungai_layer,
+                1,
+                console_progress_callback,
+                cancel_token=cancel_token),
+            message)
+
+        remove_temp_layer(sungai_layer.source())
+
+    def test_identify_features_report(self):
+        """Test the run report of identify_features."""
+        sungai_layer = get_temp_shapefile_layer(
+            SUNGAI_BARU_SHP, 'sungai_baru')
+        report = RunReport()
+        _, output_layer = identify_features(
+            sungai_layer, 1, console_progress_callback, report=report)
+
+        names = [stage.name for stage in report.stages]
+        expected_names = (
+            ['read_lines', 'associate_nodes'] +
+            ['rule_%s' % attribute for attribute in [
+                'well', 'sink', 'branch', 'confluence', 'pseudo',
+                'watershed', 'unclear_bi']] +
+            ['intermediate_layer', 'self_intersections', 'segment_centers',
+             'intersections', 'output_points', 'merge_duplicates',
+             'output_layer'])
+        self.assertEqual(names, expected_names)
+        self.assertEqual(report.get('rule_well').counts['nodes'], 1)
+        self.assertEqual(
+            report.get('output_layer').counts['features'],
+            output_layer.featureCount())
+
+        remove_temp_layer(sungai_layer.source())
+
+    def test_identify_features_without_intermediate(self):
+        """Test that the output does not need the intermediate layer."""
+        sungai_layer = get_temp_shapefile_layer(
+            SUNGAI_BARU_SHP, 'sungai_baru')
+        _, expected_layer = identify_features(
+            sungai_layer, 1, console_progress_callback)
+        intermediate_layer, output_layer = identify_features(
+            sungai_layer,
+            1,
+            console_progress_callback,
+            create_intermediate=False)
+        self.assertIsNone(intermediate_layer)
+        self.assertEqual(
+            [feature.attributes() for feature in output_layer.getFeatures()],
+            [feature.attributes() for feature in expected_layer.getFeatures()])
+
+        remove_temp_layer(sungai_layer.source())
+
     @unittest.expectedFailure
     def test_identify_features_dgn(self):
         """Test for identify_features on the dgn test dataset."""
@@ -748,14 +961,70 @@ class TestStreamUtilities(unittest.TestCase):
 
         remove_temp_layer(layer.source())
 
+    def test_deduplicate_points(self):
+        """Test for deduplicate_points."""
+        points = [(0, 0), (1, 1), (0, 0), (1.0004, 1), (2, 2), (1, 1)]
+        unique_points = deduplicate_points(points)
+        expected_points = [(0, 0), (1, 1), (1.0004, 1), (2, 2)]
+        message = 'Expected %s but I got %s' % (expected_points, unique_points)
+        self.assertListEqual(unique_points, expected_points, message)
+
+        unique_points = deduplicate_points(points, precision=0.001)
+        expected_points = [(0, 0), (1, 1), (2, 2)]
+        message = 'Expected %s but I got %s' % (expected_points, unique_points)
+        self.assertListEqual(unique_points, expected_points, message)
+
+        points = [QgsPoint(0, 0), QgsPoint(1, 1), QgsPoint(0, 0)]
+        unique_points = deduplicate_points(points)
+        message = 'Expected 2 points but I got %s' % unique_points
+        self.assertEqual(len(unique_points), 2, message)
+
+    def test_cluster_points(self):
+        """Test for cluster_points."""
+        xs = [0, 5, 0.5, 1.0, 5.2, 9]
+        ys = [0, 5, 0, 0, 5, 9]
+        clusters = cluster_points(xs, ys, 0.6)
+        # 0 - 2 - 3 is a chain, 3 is not within threshold of 0
+        expected_clusters = [0, 1, 0, 0, 1, 5]
+        message = 'Expected %s but I got %s' % (expected_clusters, clusters)
+        self.assertListEqual(clusters, expected_clusters, message)
+
+        clusters = cluster_points([1, 2, 1], [1, 2, 1], 0)
+        expected_clusters = [0, 1, 0]
+        message = 'Expected %s but I got %s' % (expected_clusters, clusters)
+        self.assertListEqual(clusters, expected_clusters, message)
+
+    def test_merge_duplicate_points(self):
+        """Test for merge_duplicate_points."""
+        points = [
+            (QgsPoint(0, 0), 'Well'),
+            (QgsPoint(5, 5), 'Sink'),
+            (QgsPoint(0.5, 0), 'Intersection'),
+            (QgsPoint(9, 9), 'Segment Center')]
+        merged_points = merge_duplicate_points(points, 1)
+        expected_points = [
+            (QgsPoint(0, 0), 'Unseparated'),
+            (QgsPoint(5, 5), 'Sink'),
+            (QgsPoint(9, 9), 'Segment Center')]
+        message = 'Expected %s but I got %s' % (expected_points, merged_points)
+        self.assertListEqual(merged_points, expected_points, message)
+
     def test_intersections(self):
         """Test identify_intersections."""
         line_intersect = os.path.join(DATA_TEST_DIR, 'lines.shp')
         line_layer = get_temp_shapefile_layer(line_intersect, 'lines')
 
-        intersections = identify_intersections(line_layer)
+        statistics = {}
+        intersections = identify_intersections(line_layer, statistics)
         self.assertEqual(len(intersections), 22, '%s' % len(intersections))
 
+        line_count = line_layer.featureCount()
+        pair_count = statistics['pruned_pairs'] + statistics['tested_pairs']
+        message = 'Every pair should be pruned or tested once, got %s' % (
+            statistics)
+        self.assertEqual(
+            pair_count, line_count * (line_count - 1) // 2, message)
+
         remove_temp_layer(line_layer.source())
 
     def test_identify_features_river_test(self):
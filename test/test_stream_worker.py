@@ -0,0 +1,55 @@
+# coding=utf-8
+"""Tests for the background extraction worker."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import unittest
+import threading
+
+from stream_worker import ExtractorWorker
+
+from test.synthetic_network import generate_network, create_network_layer
+from test.utilities_for_testing import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class TestStreamWorker(unittest.TestCase):
+    """Test the background extraction worker."""
+
+    def test_cancel_while_running(self):
+        """Test that cancelling the token from another thread stops run."""
+        layer = create_network_layer(generate_network(200))
+        worker = ExtractorWorker(layer, 1)
+        running = threading.Event()
+        cancelled = threading.Event()
+        results = []
+
+        def progress(current, maximum, message=None):
+            """Hold the extraction until it is cancelled."""
+            running.set()
+            cancelled.wait(10)
+
+        worker.progress.connect(progress)
+        worker.finished.connect(lambda *layers: results.append('finished'))
+        worker.cancelled.connect(lambda: results.append('cancelled'))
+        worker.error.connect(results.append)
+
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        self.assertTrue(running.wait(10))
+        # What the cancel button of the plugin does while run is executing
+        worker.cancel_token.cancel()
+        cancelled.set()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, ['cancelled'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# coding=utf-8
+"""Tests for the synthetic stream network generator."""
+
+__author__ = 'Ismail Sunni <ismail@linfiniti.com>'
+__revision__ = '$Format:%H$'
+__date__ = '17/04/2014'
+__license__ = "GPL"
+__copyright__ = ''
+
+import unittest
+
+from stream_geometry import find_self_intersections
+from test.synthetic_network import generate_network
+
+
+def lines_cross(line_1, line_2):
+    """Tell whether two lines cross, not counting touching ends.
+
+    :param line_1: The vertices of the first line.
+    :type line_1: list
+
+    :param line_2: The vertices of the second line.
+    :type line_2: list
+
+    :returns: True if a segment of a line crosses a segment of the other.
+    :rtype: bool
+    """
+    def side(a, b, c):
+        """Sign of the turn from a to b to c."""
+        turn = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+        return (turn > 0) - (turn < 0)
+
+    for a, b in zip(line_1, line_1[1:]):
+        for c, d in zip(line_2, line_2[1:]):
+            if (side(a, b, c) * side(a, b, d) < 0 and
+                    side(c, d, a) * side(c, d, b) < 0):
+                return True
+    return False
+
+
+class TestSyntheticNetwork(unittest.TestCase):
+    """Test the synthetic stream network generator."""
+
+    def test_generate_network(self):
+        """Test for generate_network."""
+        lines = generate_network(1000, vertices_per_line=5, seed=3)
+        self.assertEqual(len(lines), 1000)
+        for line in lines:
+            self.assertEqual(len(line), 5)
+        # Deterministic for the same seed only
+        self.assertEqual(
+            lines, generate_network(1000, vertices_per_line=5, seed=3))
+        self.assertNotEqual(
+            lines, generate_network(1000, vertices_per_line=5, seed=4))
+
+        # Without braiding or near misses every line ends on a lattice node
+        # that is the start of a line or on the outlet row.
+        starts = set(line[0] for line in lines)
+        for line in lines:
+            end = line[-1]
+            self.assertTrue(end in starts or end[1] == 0, end)
+
+    def test_generate_network_options(self):
+        """Test for generate_network with braiding and near misses."""
+        lines = generate_network(500)
+        starts = [line[0] for line in lines]
+        self.assertEqual(len(starts), len(set(starts)))
+
+        lines = generate_network(500, braiding=1.0)
+        starts = [line[0] for line in lines]
+        self.assertLess(len(set(starts)), len(starts))
+
+        lines = generate_network(
+            500, near_miss=1.0, near_miss_distance=0.5)
+        for line in lines:
+            self.assertEqual(line[-1][1] % 10, 0.5)
+
+        self.assertRaises(ValueError, generate_network, 10, 1)
+
+    def test_generate_network_crossings(self):
+        """Test for generate_network with crossings and self crossings."""
+        # Without crossings the networks do not change
+        self.assertEqual(
+            generate_network(200, braiding=0.1, seed=3),
+            generate_network(
+                200, braiding=0.1, crossing=0.0, self_crossing=0.0, seed=3))
+
+        lines = generate_network(200, vertices_per_line=2, self_crossing=1.0)
+        for line in lines:
+            self.assertEqual(len(line), 5)
+            self.assertEqual(len(find_self_intersections(line)), 1)
+
+        lines = generate_network(200, vertices_per_line=2, crossing=1.0)
+        crossing_count = 0
+        for line in lines:
+            self.assertEqual(len(line), 3)
+            self.assertEqual(find_self_intersections(line), [])
+            if any(lines_cross(line, other) for other in lines):
+                crossing_count += 1
+        # The lines swinging past the edge have no neighbour to cross
+        self.assertGreater(crossing_count, len(lines) // 2)
+
+
+if __name__ == '__main__':
+    unittest.main()